@@ -1,370 +1,4451 @@
-from flask import Flask, request, Response
+from flask import Flask, request, Response, send_file
 import requests
+import urllib3
 import json
 import urllib.parse
+import xml.etree.ElementTree as ET
+import calendar
 import os
+import zlib
+import sys
+import atexit
+import itertools
+import logging
+import hashlib
+import bisect
+from array import array
+import hmac
+import cProfile
+import pstats
+import io
+import re
+import queue
+import random
+import asyncio
+import multiprocessing
+import tempfile
+import socket
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED, wait as wait_futures
+from concurrent.futures.process import BrokenProcessPool
+from logging.handlers import QueueHandler, QueueListener
+from werkzeug.http import parse_accept_header
+
+try:
+    import brotli # Opzionale: compressione br verso i client e dagli upstream
+except ImportError:
+    brotli = None
+
+try:
+    import fcntl # Lock tra processi del refresher (assente su Windows)
+except ImportError:
+    fcntl = None
+
+try:
+    import aiohttp # Opzionale: modalità di servizio asincrona (ASYNC_SERVER)
+    from aiohttp import web
+except ImportError:
+    aiohttp = None
 
 app = Flask(__name__)
 
-def rewrite_m3u_links(m3u_content, base_url, api_password):
+# --- Configurazione (variabili d'ambiente) ---
+# Download paralleli delle playlist di una richiesta /proxy
+PARALLEL_DOWNLOADS = os.environ.get('PARALLEL_DOWNLOADS', 'false').lower() in ('1', 'true', 'yes', 'on')
+PARALLEL_DOWNLOADS_WORKERS = int(os.environ.get('PARALLEL_DOWNLOADS_WORKERS', 8)) # Download contemporanei per richiesta
+PARALLEL_DOWNLOADS_BUFFER_BYTES = int(os.environ.get('PARALLEL_DOWNLOADS_BUFFER_BYTES', 4 * 1024 * 1024)) # Read-ahead per playlist
+# Riscrittura su più core (process pool) per le playlist molto grandi
+SHARDED_REWRITE_THRESHOLD = int(os.environ.get('SHARDED_REWRITE_THRESHOLD', 0)) # Byte oltre i quali si usa il pool (es. 16 MB), 0 = disattivata
+# Processi per worker gunicorn: di default i core divisi tra i worker (GUNICORN_WORKERS, come in gunicorn.conf.py)
+SHARDED_REWRITE_WORKERS = int(os.environ.get(
+    'SHARDED_REWRITE_WORKERS', max(1, (os.cpu_count() or 1) // max(1, int(os.environ.get('GUNICORN_WORKERS', 4))))
+))
+SHARDED_REWRITE_SHARD_BYTES = int(os.environ.get('SHARDED_REWRITE_SHARD_BYTES', 1024 * 1024)) # Dimensione indicativa di un blocco
+SHARDED_REWRITE_MAX_INFLIGHT = int(os.environ.get('SHARDED_REWRITE_MAX_INFLIGHT', 0)) # Blocchi in lavorazione per playlist, 0 = 2 x processi
+# Regole di riscrittura configurabili (file JSON, ricaricato quando cambia)
+REWRITE_RULES_FILE = os.environ.get('REWRITE_RULES_FILE', '')
+REWRITE_RULES_RELOAD_INTERVAL = float(os.environ.get('REWRITE_RULES_RELOAD_INTERVAL', 5)) # Secondi tra i controlli del file
+# Sessioni keep-alive verso gli upstream
+UPSTREAM_POOL_MAXSIZE = int(os.environ.get('UPSTREAM_POOL_MAXSIZE', 10)) # Connessioni per host (default)
+UPSTREAM_POOL_SIZES = os.environ.get('UPSTREAM_POOL_SIZES', '') # Override per host: "host1=20,host2=5"
+UPSTREAM_DNS_CACHE_TTL = float(os.environ.get('UPSTREAM_DNS_CACHE_TTL', 0)) # Cache DNS delle sessioni upstream, secondi (0 = disattivata)
+UPSTREAM_DNS_CACHE_MAX_ENTRIES = int(os.environ.get('UPSTREAM_DNS_CACHE_MAX_ENTRIES', 1024)) # Host in cache, oltre si scarta il meno usato
+UPSTREAM_CHUNK_SIZE = int(os.environ.get('UPSTREAM_CHUNK_SIZE', 64 * 1024)) # Byte letti per volta dagli upstream
+UPSTREAM_CONNECT_TIMEOUT = float(os.environ.get('UPSTREAM_CONNECT_TIMEOUT', 10)) # Secondi per stabilire la connessione
+UPSTREAM_READ_TIMEOUT = float(os.environ.get('UPSTREAM_READ_TIMEOUT', 30)) # Secondi massimi di silenzio dell'upstream
+# Tempo massimo complessivo di una richiesta /proxy (tutte le definizioni); sotto il --timeout di gunicorn
+PROXY_DEADLINE = float(os.environ.get('PROXY_DEADLINE', 90)) # 0 = nessun limite
+# Circuit breaker per host: dopo N errori consecutivi l'upstream viene saltato per un periodo
+CIRCUIT_BREAKER_FAILURES = int(os.environ.get('CIRCUIT_BREAKER_FAILURES', 3)) # 0 = disattivato
+CIRCUIT_BREAKER_COOLDOWN = float(os.environ.get('CIRCUIT_BREAKER_COOLDOWN', 30)) # Secondi prima di un nuovo tentativo
+# Controllo di ammissione (per worker): oltre i limiti le richieste attendono in una breve coda, poi 429
+ADMISSION_MAX_MERGES = int(os.environ.get('ADMISSION_MAX_MERGES', 16)) # Generazioni /proxy e /epg contemporanee, 0 = illimitate
+ADMISSION_MAX_UPSTREAM_FETCHES = int(os.environ.get('ADMISSION_MAX_UPSTREAM_FETCHES', 64)) # Download upstream in corso, 0 = illimitati
+ADMISSION_QUEUE_SIZE = int(os.environ.get('ADMISSION_QUEUE_SIZE', 32)) # Richieste in attesa di un posto, oltre: rifiuto immediato
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get('ADMISSION_QUEUE_TIMEOUT', 5)) # Secondi massimi di attesa in coda
+ADMISSION_RETRY_AFTER = int(os.environ.get('ADMISSION_RETRY_AFTER', 5)) # Valore dell'header Retry-After delle risposte 429
+# Upstream lenti o instabili: richiesta duplicata (hedging) e tentativi ripetuti prima del primo byte
+UPSTREAM_HEDGE_AFTER = float(os.environ.get('UPSTREAM_HEDGE_AFTER', 0)) # Secondi senza risposta prima del duplicato, 0 = disattivato
+UPSTREAM_HEDGE_WORKERS = int(os.environ.get('UPSTREAM_HEDGE_WORKERS', 0)) # Thread per worker, 0 = 2 x download upstream ammessi
+UPSTREAM_RETRIES = int(os.environ.get('UPSTREAM_RETRIES', 0)) # Tentativi aggiuntivi su errori di rete e 5xx
+UPSTREAM_RETRY_BACKOFF = float(os.environ.get('UPSTREAM_RETRY_BACKOFF', 0.5)) # Attesa iniziale tra i tentativi (raddoppia)
+# Cache delle playlist upstream (TTL + GET condizionale)
+UPSTREAM_CACHE_ENABLED = os.environ.get('UPSTREAM_CACHE_ENABLED', 'false').lower() in ('1', 'true', 'yes', 'on')
+UPSTREAM_CACHE_TTL = float(os.environ.get('UPSTREAM_CACHE_TTL', 300)) # Validità senza ETag/Last-Modified
+UPSTREAM_CACHE_REVALIDATE_AFTER = float(os.environ.get('UPSTREAM_CACHE_REVALIDATE_AFTER', 30)) # Con validatori: rivalida dopo N secondi
+UPSTREAM_CACHE_MEMORY_BYTES = int(os.environ.get('UPSTREAM_CACHE_MEMORY_BYTES', 128 * 1024 * 1024)) # Limite LRU in memoria
+UPSTREAM_CACHE_MAX_ENTRY_BYTES = int(os.environ.get('UPSTREAM_CACHE_MAX_ENTRY_BYTES', 32 * 1024 * 1024)) # Voce più grande tenuta in memoria
+UPSTREAM_CACHE_DIR = os.environ.get('UPSTREAM_CACHE_DIR', '') # Spool su disco condiviso tra i worker (vuoto = disattivato)
+UPSTREAM_CACHE_DISK_BYTES = int(os.environ.get('UPSTREAM_CACHE_DISK_BYTES', 1024 * 1024 * 1024)) # Limite dello spool, 0 = illimitato
+# Coalescenza delle richieste /proxy identiche e stale-while-revalidate
+PROXY_COALESCING = os.environ.get('PROXY_COALESCING', 'false').lower() in ('1', 'true', 'yes', 'on')
+MERGED_CACHE_TTL = float(os.environ.get('MERGED_CACHE_TTL', 60)) # Secondi in cui il risultato è servito senza rigenerarlo
+MERGED_CACHE_STALE_TTL = float(os.environ.get('MERGED_CACHE_STALE_TTL', 600)) # Oltre il TTL: servito subito e rigenerato in background
+MERGED_CACHE_MAX_BYTES = int(os.environ.get('MERGED_CACHE_MAX_BYTES', 256 * 1024 * 1024)) # Dimensione massima dei risultati (memoria o file temporanei)
+MERGED_FLIGHT_MEMORY_BYTES = int(os.environ.get('MERGED_FLIGHT_MEMORY_BYTES', 8 * 1024 * 1024)) # Per generazione: oltre si usa un file temporaneo
+# Spool su disco dei playlist combinati: richieste ripetute o riprese (Range) servite dal file
+MERGED_SPOOL_DIR = os.environ.get('MERGED_SPOOL_DIR', '') # Vuoto = disattivato; condiviso tra i worker
+MERGED_SPOOL_TTL = float(os.environ.get('MERGED_SPOOL_TTL', 300)) # Secondi in cui il file sostituisce la generazione
+MERGED_SPOOL_MAX_BYTES = int(os.environ.get('MERGED_SPOOL_MAX_BYTES', 2 * 1024 * 1024 * 1024)) # Limite su disco, 0 = illimitato
+# Refresher in background: playlist combinati registrati, ricostruiti nello spool quando gli upstream cambiano
+REFRESH_REGISTRY_FILE = os.environ.get('REFRESH_REGISTRY_FILE', '') # JSON con le query string /proxy (vuoto = disattivato)
+REFRESH_INTERVAL = float(os.environ.get('REFRESH_INTERVAL', 300)) # Secondi tra i controlli degli upstream (default per voce)
+REFRESH_JITTER = float(os.environ.get('REFRESH_JITTER', 0.1)) # Variazione casuale dell'intervallo (frazione)
+REFRESH_CONCURRENCY = int(os.environ.get('REFRESH_CONCURRENCY', 2)) # Voci controllate/ricostruite contemporaneamente
+# Archivio dei canali (SQLite + FTS5) per le API JSON /api/channels, /api/groups e /api/search
+CHANNEL_STORE_PATH = os.environ.get('CHANNEL_STORE_PATH', '') # File SQLite condiviso tra i worker (vuoto = API disattivate)
+CHANNEL_STORE_TTL = float(os.environ.get('CHANNEL_STORE_TTL', 300)) # Secondi prima di riallineare i canali al playlist combinato
+CHANNEL_STORE_MAX_DATASETS = int(os.environ.get('CHANNEL_STORE_MAX_DATASETS', 50)) # Oltre: eliminati i dataset usati meno di recente
+CHANNEL_STORE_MAX_AGE = float(os.environ.get('CHANNEL_STORE_MAX_AGE', 24 * 3600)) # Dataset non richiesti da N secondi vengono eliminati
+# EPG (/epg): finestra temporale dei programmi inclusi, rispetto all'ora della richiesta
+EPG_PAST_HOURS = float(os.environ.get('EPG_PAST_HOURS', 6))
+EPG_FUTURE_HOURS = float(os.environ.get('EPG_FUTURE_HOURS', 48))
+# Compressione della risposta /proxy (Accept-Encoding: br se disponibile, altrimenti gzip)
+RESPONSE_COMPRESSION = os.environ.get('RESPONSE_COMPRESSION', 'true').lower() in ('1', 'true', 'yes', 'on')
+GZIP_LEVEL = int(os.environ.get('GZIP_LEVEL', 6))
+BROTLI_QUALITY = int(os.environ.get('BROTLI_QUALITY', 5))
+COMPRESSION_FLUSH_BYTES = int(os.environ.get('COMPRESSION_FLUSH_BYTES', 256 * 1024)) # Flush del compressore ogni N byte in ingresso
+# Modalità asincrona (aiohttp): un'unica event loop per processo serve molte /proxy contemporanee
+ASYNC_SERVER = os.environ.get('ASYNC_SERVER', 'false').lower() in ('1', 'true', 'yes', 'on')
+ASYNC_UPSTREAM_CONNECTIONS = int(os.environ.get('ASYNC_UPSTREAM_CONNECTIONS', 500)) # Connessioni upstream aperte per processo
+# Logging
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_SAMPLE_EVERY = max(1, int(os.environ.get('LOG_SAMPLE_EVERY', 1000))) # Eventi per-linea: uno ogni N messaggi (1 = tutti)
+# Metriche Prometheus (/metrics), aggregate tra i worker tramite snapshot su disco
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() in ('1', 'true', 'yes', 'on')
+METRICS_DIR = os.environ.get('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'm3u_proxy_metrics')) # Uno snapshot per worker
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 5)) # Secondi tra le scritture dello snapshot
+METRICS_MAX_HOSTS = int(os.environ.get('METRICS_MAX_HOSTS', 200)) # Oltre questo numero gli host finiscono in "other"
+# Tempi per fase di ogni richiesta /proxy (header Server-Timing + commento finale nel playlist).
+# Disattivato di default: il playlist resta invariato e gli header non attendono il primo blocco
+REQUEST_TIMING = os.environ.get('REQUEST_TIMING', 'false').lower() in ('1', 'true', 'yes', 'on')
+# Profilazione su richiesta (header X-Admin-Token + X-Profile: 1); vuoto = disattivata
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN', '')
+PROFILE_TOP_FUNCTIONS = int(os.environ.get('PROFILE_TOP_FUNCTIONS', 25)) # Funzioni riportate nel profilo
+
+# --- Logging ---
+# I messaggi passano da una coda in memoria a un thread dedicato che scrive su
+# stdout: il thread della richiesta non si blocca mai sulla pipe dei log.
+logger = logging.getLogger('m3u_proxy')
+_log_queue = queue.SimpleQueue()
+_log_handler = logging.StreamHandler(sys.stdout)
+_log_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(process)d] %(message)s'))
+_log_listener = None
+
+def _start_log_listener():
+    global _log_listener
+    _log_listener = QueueListener(_log_queue, _log_handler)
+    _log_listener.start()
+
+logger.addHandler(QueueHandler(_log_queue))
+logger.propagate = False
+_start_log_listener()
+if isinstance(logging.getLevelName(LOG_LEVEL), int):
+    logger.setLevel(LOG_LEVEL)
+else:
+    logger.setLevel(logging.INFO)
+    logger.warning("⚠️ LOG_LEVEL non valido (%r): uso INFO", LOG_LEVEL)
+atexit.register(lambda: _log_listener.stop())
+# Il thread di scrittura non sopravvive al fork: ogni worker gunicorn ne avvia uno
+os.register_at_fork(after_in_child=_start_log_listener)
+
+_log_sample_counters = {}
+
+def log_sampled(event, level, msg, *args):
+    """
+    Log per eventi ad alta frequenza (per linea/URL): scrive solo la prima
+    occorrenza e poi una ogni LOG_SAMPLE_EVERY, con il conteggio totale.
+    """
+    if not logger.isEnabledFor(level):
+        return
+    counter = _log_sample_counters.get(event)
+    if counter is None:
+        counter = _log_sample_counters.setdefault(event, itertools.count(1))
+    occurrence = next(counter)
+    if occurrence == 1 or occurrence % LOG_SAMPLE_EVERY == 0:
+        logger.log(level, msg + " [%s #%d]", *args, event, occurrence)
+
+
+def apply_header_directive(logical_line, current_ext_headers):
+    """
+    Interpreta una direttiva #EXTVLCOPT o #EXTHTTP (linea già ripulita dagli spazi).
+    Restituisce (is_header_tag, headers aggiornati): #EXTVLCOPT aggiunge un header,
+    #EXTHTTP sostituisce tutti quelli correnti.
+    """
+    if logical_line.startswith('#EXTVLCOPT:'):
+        try:
+            option_str = logical_line.split(':', 1)[1]
+            if '=' in option_str:
+                key_vlc, value_vlc = option_str.split('=', 1)
+                key_vlc = key_vlc.strip()
+                value_vlc = value_vlc.strip()
+
+                # Gestione speciale per http-header che contiene "Key: Value"
+                if key_vlc == 'http-header' and ':' in value_vlc:
+                    header_key, header_value = value_vlc.split(':', 1)
+                    header_key = header_key.strip()
+                    header_value = header_value.strip()
+                    current_ext_headers[header_key] = header_value
+                    log_sampled('header_directive', logging.DEBUG, "ℹ️ Trovato header da #EXTVLCOPT (http-header): %s", {header_key: header_value})
+                elif key_vlc.startswith('http-'):
+                    # Gestisce http-user-agent, http-referer etc.
+                    header_key = '-'.join(word.capitalize() for word in key_vlc[len('http-'):].split('-'))
+
+                    current_ext_headers[header_key] = value_vlc
+                    log_sampled('header_directive', logging.DEBUG, "ℹ️ Trovato header da #EXTVLCOPT: %s", {header_key: value_vlc})
+        except Exception as e:
+            log_sampled('header_directive_error', logging.WARNING, "⚠️ Errore nel parsing di #EXTVLCOPT '%s': %s", logical_line, e)
+        return True, current_ext_headers
+
+    if logical_line.startswith('#EXTHTTP:'):
+        try:
+            json_str = logical_line.split(':', 1)[1]
+            # Sostituisce tutti gli header correnti con quelli del JSON
+            current_ext_headers = json.loads(json_str)
+            log_sampled('header_directive', logging.DEBUG, "ℹ️ Trovati headers da #EXTHTTP: %s", current_ext_headers)
+        except Exception as e:
+            log_sampled('header_directive_error', logging.WARNING, "⚠️ Errore nel parsing di #EXTHTTP '%s': %s", logical_line, e)
+            current_ext_headers = {} # Resetta in caso di errore
+        return True, current_ext_headers
+
+    return False, current_ext_headers
+
+def format_header_params(headers):
+    """Formato richiesto: &h_NOMEHEADER=VALOREHEADER, con URL encoding di chiave e valore."""
+    return "".join([f"&h_{urllib.parse.quote(key)}={urllib.parse.quote(urllib.parse.quote(value))}" for key, value in headers.items()])
+
+# Regole di riscrittura predefinite, in ordine di priorità (la prima che corrisponde vince).
+# Tipi di match: "contains" (sottostringa), "host" (host o sottodominio),
+# "extension" (estensione dell'ultimo segmento del path), "regex" (espressione
+# regolare senza gruppi nominati).
+# Nel target: {base_url}, {api_password} e {url} (link originale).
+DEFAULT_REWRITE_RULES = [
+    {'name': 'Vavoo', 'contains': 'vavoo.to', 'target': '{base_url}/proxy/hls/manifest.m3u8?api_password={api_password}&d={url}'},
+    {'name': 'VixCloud', 'contains': 'vixsrc.to', 'target': '{base_url}/extractor/video?host=VixCloud&redirect_stream=true&api_password={api_password}&d={url}'},
+    {'name': 'M3U8', 'contains': '.m3u8', 'target': '{base_url}/proxy/hls/manifest.m3u8?api_password={api_password}&d={url}'},
+    {'name': 'MPD', 'contains': '.mpd', 'target': '{base_url}/proxy/mpd/manifest.m3u8?api_password={api_password}&d={url}'},
+    {'name': 'PHP', 'contains': '.php', 'target': '{base_url}/extractor/video?host=DLHD&redirect_stream=true&api_password={api_password}&d={url}'},
+]
+# Modalità senza password (TvProxy): ogni link passa per /proxy/m3u
+DEFAULT_NO_PASSWORD_TARGET = '{base_url}/proxy/m3u?url={url}'
+NO_PASSWORD_RULE_NAME = 'senza password'
+REWRITE_MATCH_TYPES = ('contains', 'host', 'extension', 'regex')
+
+class _RuleIndex:
+    """Indici delle regole per un tipo di link (str o bytes)."""
+
+    def __init__(self, convert):
+        self.scheme_sep = convert('://')
+        self.host_ends = [convert(c) for c in '/?#']
+        self.path_ends = [convert(c) for c in '?#']
+        self.userinfo_sep = convert('@')
+        self.port_sep = convert(':')
+        self.dot = convert('.')
+        self.slash = convert('/')
+        self.hosts = {} # dominio -> indice regola
+        self.extensions = {} # estensione -> indice regola
+        self.patterns = [] # (indice regola, espressione compilata) delle regole contains/regex, in ordine di priorità
+        self.separate = [] # Le regex che non possono stare nell'espressione unica (gruppi, flag globali)
+        self.combined = None # Le altre regole contains/regex in un'unica espressione
+        self.combined_rules = {} # lastindex del match -> indice della regola
+
+    def split_url(self, url):
+        # Restituisce (host in minuscolo, path) del link
+        scheme_end = url.find(self.scheme_sep)
+        if scheme_end == -1:
+            return None, None
+        host_start = scheme_end + 3
+        host_end = len(url)
+        for sep in self.host_ends:
+            pos = url.find(sep, host_start, host_end)
+            if pos != -1:
+                host_end = pos
+        host = url[host_start:host_end].rpartition(self.userinfo_sep)[2].partition(self.port_sep)[0].lower()
+        path_end = len(url)
+        for sep in self.path_ends:
+            pos = url.find(sep, host_end, path_end)
+            if pos != -1:
+                path_end = pos
+        return host, url[host_end:path_end]
+
+    def match(self, url):
+        best = None
+        if self.hosts or self.extensions:
+            host, path = self.split_url(url)
+            if host and self.hosts:
+                # Il dominio e tutti i domini padre (sub.cdn.example -> cdn.example -> example)
+                while host:
+                    rule_idx = self.hosts.get(host)
+                    if rule_idx is not None and (best is None or rule_idx < best):
+                        best = rule_idx
+                    host = host.partition(self.dot)[2]
+            if path and self.extensions:
+                last_segment = path.rpartition(self.slash)[2]
+                if self.dot in last_segment:
+                    rule_idx = self.extensions.get(last_segment.rpartition(self.dot)[2].lower())
+                    if rule_idx is not None and (best is None or rule_idx < best):
+                        best = rule_idx
+        if self.patterns:
+            # Una sola scansione per le regole dell'espressione unica: senza match (il caso comune)
+            # restano da verificare solo le regex separate. Il primo match dà un candidato e
+            # solo le regole con priorità più alta vanno ancora verificate una per una.
+            candidates = self.separate
+            if self.combined is not None:
+                found = self.combined.search(url)
+                if found is not None:
+                    rule_idx = self.combined_rules[found.lastindex]
+                    if best is None or rule_idx < best:
+                        best = rule_idx
+                    candidates = self.patterns
+            for rule_idx, pattern in candidates:
+                if best is not None and rule_idx >= best:
+                    break
+                if pattern.search(url):
+                    best = rule_idx
+                    break
+        return best
+
+class RewriteRuleSet:
+    """
+    Insieme di regole di riscrittura compilato in indici: le regole "host" ed
+    "extension" sono tabelle hash (una ricerca per dominio/estensione, a costo
+    costante rispetto al numero di regole), le "contains" e le "regex" sono
+    unite in un'unica espressione con un gruppo per regola (una scansione del
+    link). Le regex con gruppi propri o flag globali (es. (?i)) non possono
+    essere unite e sono verificate a parte. Vince la regola con priorità più
+    alta (la prima nella lista).
+    """
+
+    def __init__(self, rules, no_password_target=DEFAULT_NO_PASSWORD_TARGET, source='default'):
+        self.rules = []
+        self.no_password_target = no_password_target
+        self.source = source
+        self._str_index = _RuleIndex(lambda value: value)
+        self._bytes_index = _RuleIndex(lambda value: value.encode('utf-8'))
+        pattern_alternatives = []
+        for rule_idx, rule in enumerate(rules):
+            match_types = [key for key in REWRITE_MATCH_TYPES if key in rule]
+            if len(match_types) != 1:
+                raise ValueError(f"La regola #{rule_idx} deve avere esattamente un tipo di match tra {REWRITE_MATCH_TYPES}")
+            target = rule.get('target', '')
+            if '{url}' not in target:
+                raise ValueError(f"Il target della regola #{rule_idx} deve contenere {{url}}")
+            match_type = match_types[0]
+            value = rule[match_type]
+            name = rule.get('name') or f"{match_type}:{value}"
+            self.rules.append({'name': name, match_type: value, 'target': target})
+
+            for index, convert in ((self._str_index, lambda v: v), (self._bytes_index, lambda v: v.encode('utf-8'))):
+                if match_type == 'host':
+                    index.hosts.setdefault(convert(value.lower()), rule_idx)
+                elif match_type == 'extension':
+                    index.extensions.setdefault(convert(value.lstrip('.').lower()), rule_idx)
+            if match_type in ('contains', 'regex'):
+                pattern = re.escape(value) if match_type == 'contains' else value
+                try:
+                    compiled = re.compile(pattern)
+                except re.error as e:
+                    raise ValueError(f"Regex non valida nella regola #{rule_idx}: {e}") from e
+                # Nell'espressione unica solo i pattern senza gruppi (niente riferimenti
+                # all'indietro o nomi in conflitto) e senza flag globali
+                combinable = compiled.groups == 0 and compiled.flags == re.compile('').flags
+                pattern_alternatives.append((rule_idx, pattern, combinable))
+        if '{url}' not in no_password_target:
+            raise ValueError("no_password_target deve contenere {url}")
+
+        for index, convert in ((self._str_index, lambda v: v), (self._bytes_index, lambda v: v.encode('utf-8'))):
+            index.patterns = [(rule_idx, re.compile(convert(pattern))) for rule_idx, pattern, _ in pattern_alternatives]
+            index.separate = [
+                entry for entry, (_, _, combinable) in zip(index.patterns, pattern_alternatives) if not combinable
+            ]
+            combined = [(rule_idx, pattern) for rule_idx, pattern, combinable in pattern_alternatives if combinable]
+            if combined:
+                index.combined = re.compile(convert('|'.join(f"(?P<r{rule_idx}>{pattern})" for rule_idx, pattern in combined)))
+                index.combined_rules = {group_idx: int(name[1:]) for name, group_idx in index.combined.groupindex.items()}
+
+    def match(self, url):
+        """Indice della regola con priorità più alta che corrisponde al link (str o bytes), o None."""
+        if isinstance(url, bytes):
+            return self._bytes_index.match(url)
+        return self._str_index.match(url)
+
+    def bind(self, base_url, api_password, use_no_password_target=True):
+        return BoundRewriteRules(self, base_url, api_password, use_no_password_target)
+
+class BoundRewriteRules:
+    """
+    Regole con base_url e password già applicate ai target (prefisso/suffisso
+    precalcolati). Senza password si usa no_password_target per ogni link;
+    con use_no_password_target=False valgono comunque le regole, con la
+    password come testo (comportamento storico di rewrite_m3u_links).
+    """
+
+    def __init__(self, rule_set, base_url, api_password, use_no_password_target=True):
+        self.rule_set = rule_set
+        self.hits = {}
+        no_password = api_password is None and use_no_password_target
+
+        def split_target(target):
+            target = target.replace('{base_url}', base_url)
+            if not no_password:
+                target = target.replace('{api_password}', str(api_password))
+            prefix, suffix = target.split('{url}', 1)
+            return prefix, suffix, prefix.encode('utf-8'), suffix.encode('utf-8')
+
+        if no_password:
+            self._no_password_target = split_target(rule_set.no_password_target)
+            self._targets = None
+        else:
+            self._no_password_target = None
+            self._targets = [split_target(rule['target']) for rule in rule_set.rules]
+
+    def _target_for(self, url):
+        # (nome regola, target) oppure (None, None) se nessuna regola corrisponde
+        if self._no_password_target is not None:
+            return NO_PASSWORD_RULE_NAME, self._no_password_target
+        rule_idx = self.rule_set.match(url)
+        if rule_idx is None:
+            return None, None
+        return self.rule_set.rules[rule_idx]['name'], self._targets[rule_idx]
+
+    def rewrite(self, url):
+        """Riscrive un link (str). Restituisce (nome regola o None, link riscritto)."""
+        rule_name, target = self._target_for(url)
+        if target is None:
+            return None, url
+        self.hits[rule_name] = self.hits.get(rule_name, 0) + 1
+        return rule_name, target[0] + url + target[1]
+
+    def rewrite_bytes(self, url):
+        """Come rewrite, per link in bytes (motore a byte)."""
+        rule_name, target = self._target_for(url)
+        if target is None:
+            return None, url
+        self.hits[rule_name] = self.hits.get(rule_name, 0) + 1
+        return rule_name, target[2] + url + target[3]
+
+def load_rewrite_rules(path):
+    """
+    Carica le regole da un file JSON: una lista di regole oppure un oggetto
+    {"rules": [...], "no_password_target": "..."}.
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+    if isinstance(config, list):
+        return RewriteRuleSet(config, source=path)
+    return RewriteRuleSet(
+        config['rules'], config.get('no_password_target', DEFAULT_NO_PASSWORD_TARGET), source=path
+    )
+
+class RewriteRulesProvider:
+    """
+    Regole di riscrittura correnti. Se è configurato un file, viene ricaricato
+    automaticamente quando cambia (controllo ogni reload_interval secondi);
+    un file non valido lascia attive le regole precedenti.
+    """
+
+    def __init__(self, path=None, reload_interval=5):
+        self.path = path
+        self.reload_interval = reload_interval
+        self._rule_set = RewriteRuleSet(DEFAULT_REWRITE_RULES)
+        self._mtime = None
+        self._last_check = 0
+        self._lock = threading.Lock()
+        if path:
+            self._reload_if_changed()
+
+    def _reload_if_changed(self):
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError as e:
+            logger.warning("⚠️ File regole di riscrittura non accessibile (%s): %s", self.path, e)
+            return
+        if mtime == self._mtime:
+            return
+        self._mtime = mtime
+        try:
+            self._rule_set = load_rewrite_rules(self.path)
+            logger.info("🔁 Caricate %s regole di riscrittura da %s", len(self._rule_set.rules), self.path)
+        except (OSError, ValueError, KeyError, TypeError, re.error) as e:
+            logger.warning("⚠️ Regole di riscrittura non valide in %s, restano attive le precedenti: %s", self.path, e)
+
+    def get(self):
+        if self.path and time.monotonic() - self._last_check >= self.reload_interval:
+            with self._lock:
+                if time.monotonic() - self._last_check >= self.reload_interval:
+                    self._last_check = time.monotonic()
+                    self._reload_if_changed()
+        return self._rule_set
+
+    def set(self, rule_set):
+        """Sostituisce le regole a runtime (le richieste già avviate mantengono le loro)."""
+        self._rule_set = rule_set
+
+rewrite_rules = RewriteRulesProvider(REWRITE_RULES_FILE or None, REWRITE_RULES_RELOAD_INTERVAL)
+
+def rewrite_m3u_links(m3u_content, base_url, api_password):
+    """
+    Riscrive i link nel contenuto M3U secondo le regole specificate,
+    includendo gli headers da #EXTVLCOPT e #EXTHTTP.
+    """
+    lines = m3u_content.split('\n')
+    rewritten_lines = []
+    current_ext_headers = {} # Dizionario per conservare gli headers dalle direttive
+    # Nessuna modalità senza password qui: vale la riscrittura a regole come in origine
+    bound_rules = rewrite_rules.get().bind(base_url, api_password, use_no_password_target=False)
+    
+    for line in lines:
+        line = line.strip()
+        
+        is_header_tag, current_ext_headers = apply_header_directive(line, current_ext_headers)
+
+        if is_header_tag:
+            rewritten_lines.append(line)
+            continue
+        
+        # Se la linea contiene un URL (non inizia con # e non è vuota)
+        if line and not line.startswith('#') and ('http://' in line or 'https://' in line):
+            log_sampled('link', logging.DEBUG, "Processando link: %s...", line[:100])
+            
+            rule_name, processed_url = bound_rules.rewrite(line)
+            if rule_name is not None:
+                log_sampled('link_rewritten', logging.DEBUG, "✅ Riscritto %s: %s... -> %s...", rule_name, line[:50], processed_url[:50])
+            else:
+                # Link non modificato dalle regole di riscrittura specifiche
+                log_sampled('link_unchanged', logging.DEBUG, "⚠️ Link non modificato (pattern): %s...", line[:50])
+
+            # Applica gli headers da current_ext_headers, se presenti, a processed_url
+            if current_ext_headers:
+                header_params_str = format_header_params(current_ext_headers)
+                
+                if header_params_str: # Se sono stati formattati parametri header
+                    processed_url += header_params_str
+                    log_sampled('link_headers', logging.DEBUG, "➕ Aggiunti headers a URL: %s -> %s...", header_params_str, processed_url[:150])
+                
+                current_ext_headers = {} # Resetta gli headers dopo averli applicati a questa URL
+
+            rewritten_lines.append(processed_url)
+        else:
+            # Mantiene le linee di metadati (#EXTM3U, #EXTINF, etc.)
+            rewritten_lines.append(line)
+            # Non resettare current_exthttp_headers qui; devono persistere per la prossima URL se non ancora usati.
+    
+    return '\n'.join(rewritten_lines)
+
+def rewrite_m3u_links_streaming(m3u_lines_iterator, base_url, api_password):
+    """
+    Riscrive i link da un iteratore di linee M3U secondo le regole specificate,
+    includendo gli headers da #EXTVLCOPT e #EXTHTTP. Yields rewritten lines.
+    """
+    current_ext_headers = {} # Dizionario per conservare gli headers dalle direttive
+    bound_rules = rewrite_rules.get().bind(base_url, api_password)
+    
+    for line_with_newline in m3u_lines_iterator:
+        line_content = line_with_newline.rstrip('\n')
+        logical_line = line_content.strip()
+        
+        is_header_tag, current_ext_headers = apply_header_directive(logical_line, current_ext_headers)
+
+        if is_header_tag:
+            yield line_with_newline
+            continue
+        
+        if logical_line and not logical_line.startswith('#') and \
+           ('http://' in logical_line or 'https://' in logical_line):
+            log_sampled('link', logging.DEBUG, "Processando link: %s...", logical_line[:100])
+            
+            rule_name, processed_url_content = bound_rules.rewrite(logical_line)
+            if rule_name is not None:
+                log_sampled('link_rewritten', logging.DEBUG, "✅ Riscritto %s: %s... -> %s...", rule_name, logical_line[:50], processed_url_content[:50])
+            else:
+                # Link non modificato dalle regole, ma gli header potrebbero essere aggiunti
+                log_sampled('link_unchanged', logging.DEBUG, "⚠️ Link non modificato (pattern): %s...", logical_line[:50])
+            # Applica gli header raccolti, indipendentemente dalla modalità
+            if current_ext_headers:
+                header_params_str = format_header_params(current_ext_headers)
+                processed_url_content += header_params_str
+                log_sampled('link_headers', logging.DEBUG, "➕ Aggiunti headers a URL: %s -> %s...", header_params_str, processed_url_content[:150])
+                current_ext_headers = {}
+            
+            yield processed_url_content + '\n'
+        else:
+            yield line_with_newline
+            
+# Linee da elaborare nel percorso a byte: direttive header, linee con un URL
+# (non commenti) e linee vuote o di soli spazi (rimosse). Tutto il resto
+# (#EXTINF, #EXTGRP, ...) viene copiato così com'è. Il pattern inizia con '\n'
+# letterale, così la ricerca salta direttamente da un inizio linea al successivo.
+_M3U_ACTIVE_LINE_RE = re.compile(
+    rb'\n[ \t\x0b\x0c]*(?:(#EXTVLCOPT:|#EXTHTTP:)[^\n]*|((?=[^#\s])[^\n]*?https?://[^\n]*)|(?=\n))'
+)
+# Linea link (chiude il canale), senza CR isolati che la dividerebbero in più linee
+_M3U_URL_LINE_RE = re.compile(rb'[ \t\x0b\x0c]*(?=[^#\s])[^\r\n]*?https?://[^\r\n]*\r?$')
+
+def normalize_m3u_newlines(data):
+    """Fine linea LF, CRLF o CR (come bytes.splitlines e requests.iter_lines): tutte LF."""
+    return data.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+
+STREAM_TYPES = ('m3u8', 'mpd', 'php') # Stesso ordine delle regole di default
+FILTER_OPTION_KEYS = ('group', 'exclude_group', 'tvg_id', 'exclude_tvg_id', 'name', 'exclude_name', 'type', 'exclude_type')
+_EXTINF_ATTR_RE = re.compile(rb'([A-Za-z0-9_-]+)="([^"]*)"')
+_EXTINF_NAME_RE = re.compile(rb'^#EXTINF:[^,"]*(?:"[^"]*"[^,"]*)*,(.*)$')
+
+def stream_type(url):
+    """Tipo di stream di un link (bytes): 'm3u8', 'mpd', 'php' oppure 'other'."""
+    lowered = url.lower()
+    for candidate in STREAM_TYPES:
+        if b'.' + candidate.encode('ascii') in lowered:
+            return candidate
+    return 'other'
+
+class EntryFilter:
+    """
+    Filtro dei canali di una playlist (include/exclude) per group-title,
+    tvg-id, nome (regex, senza distinzione di maiuscole) e tipo di stream.
+    Un canale passa se soddisfa tutti i filtri "include" indicati e nessuno
+    dei filtri "exclude".
+    """
+
+    def __init__(self, groups=None, exclude_groups=None, tvg_ids=None, exclude_tvg_ids=None,
+                 name=None, exclude_name=None, types=None, exclude_types=None):
+        self.groups = groups
+        self.exclude_groups = exclude_groups
+        self.tvg_ids = tvg_ids
+        self.exclude_tvg_ids = exclude_tvg_ids
+        self.name = name
+        self.exclude_name = exclude_name
+        self.types = types
+        self.exclude_types = exclude_types
+        self.needs_extinf = any(value is not None for value in (groups, exclude_groups, tvg_ids, exclude_tvg_ids, name, exclude_name))
+
+    @classmethod
+    def from_options(cls, options):
+        """Crea il filtro dalle opzioni della definizione; None se non ci sono filtri."""
+        options = options or {}
+        if not any(key in options for key in FILTER_OPTION_KEYS):
+            return None
+
+        def values(key):
+            if key not in options:
+                return None
+            return {value.strip().lower() for value in options[key].split(',') if value.strip()}
+
+        def pattern(key):
+            if key not in options:
+                return None
+            try:
+                return re.compile(options[key], re.IGNORECASE)
+            except re.error as e:
+                raise ValueError(f"filtro '{key}' non valido: {e}")
+
+        for key in ('type', 'exclude_type'):
+            unknown = (values(key) or set()) - set(STREAM_TYPES) - {'other'}
+            if unknown:
+                raise ValueError(f"filtro '{key}' non valido: {', '.join(sorted(unknown))} (ammessi: {', '.join(STREAM_TYPES)}, other)")
+
+        return cls(
+            groups=values('group'), exclude_groups=values('exclude_group'),
+            tvg_ids=values('tvg_id'), exclude_tvg_ids=values('exclude_tvg_id'),
+            name=pattern('name'), exclude_name=pattern('exclude_name'),
+            types=values('type'), exclude_types=values('exclude_type'),
+        )
+
+    def accepts(self, extinf_line, group_line, url):
+        """extinf_line / group_line (#EXTGRP) possono mancare (None); tutti i valori sono bytes."""
+        if self.types is not None or self.exclude_types is not None:
+            url_type = stream_type(url)
+            if self.types is not None and url_type not in self.types:
+                return False
+            if self.exclude_types is not None and url_type in self.exclude_types:
+                return False
+        if not self.needs_extinf:
+            return True
+
+        attributes, name = {}, ''
+        if extinf_line is not None:
+            attributes = {key.lower(): value for key, value in _EXTINF_ATTR_RE.findall(extinf_line)}
+            name_match = _EXTINF_NAME_RE.match(extinf_line)
+            if name_match:
+                name = name_match.group(1).decode('utf-8', errors='replace').strip()
+        group = attributes.get(b'group-title')
+        if group is None and group_line is not None:
+            group = group_line.split(b':', 1)[1]
+        group = group.decode('utf-8', errors='replace').strip().lower() if group is not None else None
+        tvg_id = attributes.get(b'tvg-id')
+        tvg_id = tvg_id.decode('utf-8', errors='replace').strip().lower() if tvg_id is not None else None
+
+        checks = (
+            (self.groups, self.exclude_groups, group),
+            (self.tvg_ids, self.exclude_tvg_ids, tvg_id),
+        )
+        for include, exclude, value in checks:
+            if include is not None and value not in include:
+                return False
+            if exclude is not None and value is not None and value in exclude:
+                return False
+        if self.name is not None and not self.name.search(name):
+            return False
+        if self.exclude_name is not None and self.exclude_name.search(name):
+            return False
+        return True
+
+class CompactHashSet:
+    """
+    Insieme di hash a 64 bit in un array('Q') a indirizzamento aperto:
+    8 byte per slot invece di un oggetto int + voce di set per elemento.
+    Lo 0 indica uno slot vuoto (l'hash 0 viene rimappato su 1).
+    """
+
+    MAX_LOAD = 0.7
+
+    def __init__(self, capacity=1024):
+        self._capacity = max(8, 1 << (capacity - 1).bit_length())
+        self._slots = array('Q', bytes(8 * self._capacity))
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def nbytes(self):
+        return self._slots.itemsize * len(self._slots)
+
+    def _insert(self, slots, mask, value):
+        index = value & mask
+        while True:
+            current = slots[index]
+            if current == 0:
+                slots[index] = value
+                return True
+            if current == value:
+                return False
+            index = (index + 1) & mask
+
+    def _grow(self):
+        old_slots = self._slots
+        self._capacity *= 2
+        self._slots = array('Q', bytes(8 * self._capacity))
+        mask = self._capacity - 1
+        for value in old_slots:
+            if value:
+                self._insert(self._slots, mask, value)
+
+    def add(self, value):
+        """Aggiunge l'hash; restituisce False se era già presente."""
+        value = value or 1
+        if self._insert(self._slots, self._capacity - 1, value):
+            self._size += 1
+            if self._size > self._capacity * self.MAX_LOAD:
+                self._grow()
+            return True
+        return False
+
+DEDUP_MODES = ('url', 'tvg_id')
+_TVG_ID_RE = re.compile(rb'tvg-id="([^"]*)"', re.IGNORECASE)
+
+class EntryDeduplicator:
+    """
+    Rimozione dei canali duplicati tra tutte le playlist di una richiesta.
+    La chiave è l'URL upstream normalizzato oppure il tvg-id (per i canali
+    senza tvg-id si usa l'URL); si conserva solo un hash a 64 bit per chiave.
+    """
+
+    def __init__(self, mode):
+        mode = mode.strip().lower().replace('-', '_')
+        if mode not in DEDUP_MODES:
+            raise ValueError(f"modalità dedup non valida: {mode} (ammesse: {', '.join(DEDUP_MODES)})")
+        self.mode = mode
+        self.needs_extinf = mode == 'tvg_id'
+        self.removed = 0
+        self._seen = CompactHashSet()
+
+    @staticmethod
+    def normalize_url(url):
+        # Schema e host senza distinzione di maiuscole, frammento ignorato
+        url = url.strip().split(b'#', 1)[0]
+        scheme_end = url.find(b'://')
+        if scheme_end == -1:
+            return url
+        path_start = url.find(b'/', scheme_end + 3)
+        if path_start == -1:
+            return url.lower()
+        return url[:path_start].lower() + url[path_start:]
+
+    def is_duplicate(self, extinf_line, url):
+        key = None
+        if self.needs_extinf and extinf_line is not None:
+            tvg_id = _TVG_ID_RE.search(extinf_line)
+            if tvg_id and tvg_id.group(1).strip():
+                key = b'tvg:' + tvg_id.group(1).strip().lower()
+        if key is None:
+            key = b'url:' + self.normalize_url(url)
+        if self._seen.add(int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'little')):
+            return False
+        self.removed += 1
+        return True
+
+class M3UChunkRewriter:
+    """
+    Motore di riscrittura a byte, incrementale: riceve blocchi grezzi dal
+    download (feed) e restituisce blocchi riscritti di pari dimensione.
+    Solo le linee URL e le direttive #EXTVLCOPT/#EXTHTTP vengono esaminate;
+    i tratti intermedi sono copiati in un'unica operazione. Il risultato è lo
+    stesso di rewrite_m3u_links_streaming sulle linee di decode_m3u_lines
+    (linee vuote o di soli spazi rimosse, fine linea CRLF e CR -> LF).
+    """
+
+    def __init__(self, base_url, api_password, rule_set=None, entry_filter=None, deduplicator=None):
+        self.rules = (rule_set or rewrite_rules.get()).bind(base_url, api_password)
+        self.entry_filter = entry_filter
+        self.deduplicator = deduplicator
+        self.current_ext_headers = {}
+        self.urls_seen = 0
+        self.urls_rewritten = 0
+        self.entries_dropped = 0
+        self.duplicates_removed = 0
+        self._groups_entries = entry_filter is not None or deduplicator is not None
+        self._needs_extinf = (entry_filter is not None and entry_filter.needs_extinf) or (deduplicator is not None and deduplicator.needs_extinf)
+        self._pending = b''
+        self._entry_block = [] # Con filtro/dedup: linee del canale in corso (fino al link)
+        self._header_params_cache = {} # Le stesse direttive si ripetono su molti canali
+
+    def summary(self):
+        summary = f"{self.urls_rewritten}/{self.urls_seen} link riscritti, regole applicate: {self.rules.hits}"
+        if self.entry_filter is not None:
+            summary += f", canali filtrati: {self.entries_dropped}"
+        if self.deduplicator is not None:
+            summary += f", duplicati rimossi: {self.duplicates_removed}"
+        return summary
+
+    def _filter_entries(self, data):
+        """
+        Con filtro o dedup attivi: raggruppa le linee per canale (direttive fino
+        al link) e scarta i canali esclusi o già visti prima della riscrittura.
+        Le linee di un canale non ancora completo restano in attesa del blocco
+        successivo.
+        """
+        output = []
+        block = self._entry_block
+        for line in data.split(b'\n'):
+            stripped = line.strip()
+            if not stripped:
+                continue
+            if stripped.startswith(b'#'):
+                if not block and stripped.startswith(b'#EXTM3U'):
+                    output.append(line) # Header del playlist, fuori da ogni canale
+                else:
+                    block.append(line)
+                continue
+            extinf_line = group_line = None
+            if self._needs_extinf:
+                for block_line in block:
+                    block_line = block_line.strip()
+                    if block_line.startswith(b'#EXTINF'):
+                        extinf_line = block_line
+                    elif block_line.startswith(b'#EXTGRP:'):
+                        group_line = block_line
+            if self.entry_filter is not None and not self.entry_filter.accepts(extinf_line, group_line, stripped):
+                self.entries_dropped += 1
+            elif self.deduplicator is not None and self.deduplicator.is_duplicate(extinf_line, stripped):
+                self.duplicates_removed += 1
+            else:
+                output.extend(block)
+                output.append(line)
+            block.clear()
+        if not output:
+            return b''
+        output.append(b'')
+        return b'\n'.join(output)
+
+    def _rewrite_url(self, url):
+        self.urls_seen += 1
+        rule_name, url = self.rules.rewrite_bytes(url)
+        if rule_name is not None:
+            self.urls_rewritten += 1
+        if self.current_ext_headers:
+            try:
+                cache_key = tuple(self.current_ext_headers.items())
+                header_params = self._header_params_cache.get(cache_key)
+            except TypeError: # Valori non hashable da #EXTHTTP
+                cache_key = header_params = None
+            if header_params is None:
+                header_params = format_header_params(self.current_ext_headers).encode('utf-8')
+                if cache_key is not None and len(self._header_params_cache) < 1024:
+                    self._header_params_cache[cache_key] = header_params
+            url += header_params
+            self.current_ext_headers = {}
+        return url
+
+    def _rewrite_complete_lines(self, data):
+        # data termina sempre con '\n' (fine linea già normalizzati): si lavora solo su linee complete
+        if not data.startswith(b'\n'):
+            data = b'\n' + data # '\n' iniziale per il pattern, escluso dall'output
+
+        view = memoryview(data)
+        parts = []
+        last_end = 1
+        for match in _M3U_ACTIVE_LINE_RE.finditer(data):
+            if match.group(1) is not None:
+                logical_line = match.group(0).decode('utf-8', errors='replace').strip()
+                _, self.current_ext_headers = apply_header_directive(logical_line, self.current_ext_headers)
+                continue
+            start, end = match.span()
+            parts.append(view[last_end:start + 1])
+            if match.group(2) is None:
+                last_end = end + 1 # Linea vuota o di soli spazi, insieme al suo '\n'
+                continue
+            parts.append(self._rewrite_url(match.group(2).rstrip()))
+            last_end = end
+        if not parts:
+            return data[1:]
+        parts.append(view[last_end:])
+        return b''.join(parts)
+
+    def feed(self, chunk):
+        """Elabora un blocco grezzo; restituisce le linee complete riscritte (anche b'')."""
+        data = self._pending + chunk if self._pending else chunk
+        held = b''
+        if b'\r' in data:
+            if data.endswith(b'\r'):
+                data, held = data[:-1], b'\r' # Il LF di un CRLF può arrivare con il blocco successivo
+            data = normalize_m3u_newlines(data)
+        last_newline = data.rfind(b'\n')
+        if last_newline == -1:
+            self._pending = data + held
+            return b''
+        self._pending = data[last_newline + 1:] + held
+        data = data[:last_newline + 1]
+        if self._groups_entries:
+            data = self._filter_entries(data)
+            if not data:
+                return b''
+        return self._rewrite_complete_lines(data)
+
+    def flush(self):
+        """Elabora l'ultima linea (se priva di terminatore) a fine stream."""
+        data = normalize_m3u_newlines(self._pending)
+        self._pending = b''
+        if self._groups_entries:
+            data = self._filter_entries(data + b'\n')
+            if self._entry_block:
+                # Linee finali senza link: un canale incompleto (#EXTINF) viene
+                # scartato, le altre direttive passano invariate
+                if any(line.strip().startswith(b'#EXTINF') for line in self._entry_block):
+                    self.entries_dropped += 1
+                else:
+                    data += b'\n'.join(self._entry_block) + b'\n'
+                self._entry_block = []
+            return self._rewrite_complete_lines(data) if data else b''
+        if not data.strip():
+            return b''
+        return self._rewrite_complete_lines(data + b'\n')
+
+def rewrite_m3u_chunks(chunks, base_url, api_password, rewriter=None):
+    """
+    Versione a byte di rewrite_m3u_links_streaming: riscrive un flusso di
+    blocchi grezzi e restituisce blocchi riscritti (uno per blocco in ingresso).
+    Si può passare un M3UChunkRewriter già creato per leggerne poi i contatori.
+    """
+    rewriter = rewriter or M3UChunkRewriter(base_url, api_password)
+    for chunk in chunks:
+        rewritten = rewriter.feed(chunk)
+        if rewritten:
+            yield rewritten
+    rewritten = rewriter.flush()
+    if rewritten:
+        yield rewritten
+    logger.info("✅ Riscrittura completata: %s", rewriter.summary())
+
+_shard_executor = None
+_shard_executor_lock = threading.Lock()
+# Processo del pool di riscrittura (avviato con forkserver/spawn): importa l'app solo per le funzioni
+_IS_REWRITE_POOL_PROCESS = multiprocessing.parent_process() is not None
+
+def _shard_mp_context():
+    # forkserver (o spawn dove non disponibile): i processi non nascono da un fork del worker,
+    # che ha già thread attivi (log, metriche, refresher, richieste) e i loro lock
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+
+def _get_shard_executor():
+    global _shard_executor
+    with _shard_executor_lock:
+        if _shard_executor is None:
+            _shard_executor = ProcessPoolExecutor(max_workers=max(1, SHARDED_REWRITE_WORKERS), mp_context=_shard_mp_context())
+            logger.info("🧩 Avviato il pool di riscrittura (%s processi)", max(1, SHARDED_REWRITE_WORKERS))
+        return _shard_executor
+
+def start_shard_executor():
+    """
+    Avvia in anticipo il pool di riscrittura (se SHARDED_REWRITE_THRESHOLD > 0)
+    e attende il primo processo: l'import dell'app nei processi del pool non
+    pesa così sulla prima playlist grande. Chiamata dall'hook post_worker_init
+    di gunicorn.conf.py; senza, il pool nasce alla prima playlist che lo usa.
+    """
+    if SHARDED_REWRITE_THRESHOLD <= 0:
+        return None
+    executor = _get_shard_executor()
+    executor.submit(int).result()
+    return executor
+
+def _discard_shard_executor(executor):
+    # Un pool rotto (processo terminato) viene sostituito alla richiesta successiva
+    global _shard_executor
+    with _shard_executor_lock:
+        if _shard_executor is executor:
+            _shard_executor = None
+    executor.shutdown(wait=False, cancel_futures=True)
+
+def _reset_shard_executor_after_fork():
+    global _shard_executor, _shard_executor_lock
+    _shard_executor = None
+    _shard_executor_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_reset_shard_executor_after_fork)
+atexit.register(lambda: _shard_executor is not None and _shard_executor.shutdown(wait=False, cancel_futures=True))
+
+def _rewrite_shard(rule_set, base_url, api_password, options, data):
+    """
+    Riscrive un blocco di canali completi in un processo del pool.
+    Restituisce (bytes riscritti, link visti, link riscritti, canali filtrati, regole applicate).
+    """
+    rewriter = M3UChunkRewriter(base_url, api_password, rule_set, EntryFilter.from_options(options))
+    rewritten = rewriter.feed(data) + rewriter.flush()
+    return rewritten, rewriter.urls_seen, rewriter.urls_rewritten, rewriter.entries_dropped, rewriter.rules.hits
+
+def _last_entry_boundary(data):
+    # Posizione subito dopo l'ultima linea link completa (0 se non ce n'è)
+    end = data.rfind(b'\n')
+    while end != -1:
+        start = data.rfind(b'\n', 0, end) + 1
+        if _M3U_URL_LINE_RE.match(data, start, end):
+            return end + 1
+        end = start - 1
+    return 0
+
+def _first_entry_boundary(data):
+    # Posizione subito dopo la prima linea link completa (0 se non ce n'è)
+    start = 0
+    while True:
+        end = data.find(b'\n', start)
+        if end == -1:
+            return 0
+        if _M3U_URL_LINE_RE.match(data, start, end):
+            return end + 1
+        start = end + 1
+
+class ShardedChunkRewriter:
+    """
+    M3UChunkRewriter che, superati SHARDED_REWRITE_THRESHOLD byte, riscrive
+    la playlist su più core: i dati sono tagliati in blocchi subito dopo una
+    linea link (lo stato delle direttive #EXTVLCOPT/#EXTHTTP si azzera a ogni
+    link, quindi ogni blocco è indipendente), riscritti nel process pool e
+    restituiti nell'ordine originale. Al massimo max_inflight blocchi sono in
+    lavorazione contemporaneamente. L'output è identico a quello di
+    M3UChunkRewriter; la deduplicazione richiede uno stato condiviso e non è
+    supportata.
+    """
+
+    def __init__(self, base_url, api_password, options=None, rule_set=None,
+                 threshold=None, shard_bytes=None, max_inflight=None):
+        self.base_url = base_url
+        self.api_password = api_password
+        self.options = options
+        self.rule_set = rule_set or rewrite_rules.get()
+        self.local = M3UChunkRewriter(base_url, api_password, self.rule_set, EntryFilter.from_options(options))
+        self.threshold = SHARDED_REWRITE_THRESHOLD if threshold is None else threshold
+        self.shard_bytes = shard_bytes or SHARDED_REWRITE_SHARD_BYTES
+        self.max_inflight = max_inflight or SHARDED_REWRITE_MAX_INFLIGHT or 2 * max(1, SHARDED_REWRITE_WORKERS)
+        self.shards = 0
+        self._bytes_seen = 0
+        self._sharding = False
+        self._buffer = b''
+        self._inflight = deque() # (future, blocco), in ordine di playlist
+
+    @property
+    def rules(self):
+        return self.local.rules
+
+    def summary(self):
+        summary = self.local.summary()
+        if self.shards:
+            summary += f", blocchi riscritti in parallelo: {self.shards}"
+        return summary
+
+    def _split(self, chunk):
+        # Restituisce (dati da riscrivere localmente, blocchi per il pool)
+        if not self._sharding:
+            self._bytes_seen += len(chunk)
+            if self._bytes_seen < self.threshold:
+                return chunk, []
+            # Passaggio al pool al primo confine di canale: fin lì riscrive il
+            # motore locale, che resta così senza stato in sospeso
+            self._sharding = True
+            data = self.local._pending + chunk
+            self.local._pending = b''
+            boundary = _first_entry_boundary(data)
+            if not boundary:
+                self._sharding = False # Nessun link completo: si riprova col blocco successivo
+                return data, []
+            chunk = data[boundary:]
+            data = data[:boundary]
+            log_sampled('sharded_rewrite', logging.INFO, "🧩 Playlist oltre %d byte: riscrittura nel process pool", self.threshold)
+        else:
+            data = b''
+        self._buffer += chunk
+        shards = []
+        if len(self._buffer) >= self.shard_bytes:
+            boundary = _last_entry_boundary(self._buffer)
+            if boundary:
+                shards.append(self._buffer[:boundary])
+                self._buffer = self._buffer[boundary:]
+        return data, shards
+
+    def _submit(self, shard):
+        executor = _get_shard_executor()
+        try:
+            future = executor.submit(_rewrite_shard, self.rule_set, self.base_url, self.api_password, self.options, shard)
+        except (BrokenProcessPool, RuntimeError) as e:
+            logger.warning("⚠️ Pool di riscrittura non disponibile, blocco riscritto localmente: %s", e)
+            _discard_shard_executor(executor)
+            future = None
+        self._inflight.append((future, executor, shard))
+        self.shards += 1
+
+    def _merge(self, result):
+        rewritten, urls_seen, urls_rewritten, entries_dropped, hits = result
+        self.local.urls_seen += urls_seen
+        self.local.urls_rewritten += urls_rewritten
+        self.local.entries_dropped += entries_dropped
+        for rule_name, count in hits.items():
+            self.local.rules.hits[rule_name] = self.local.rules.hits.get(rule_name, 0) + count
+        return rewritten
+
+    def _rewrite_here(self, shard):
+        return self._merge(_rewrite_shard(self.rule_set, self.base_url, self.api_password, self.options, shard))
+
+    def _broken_pool_result(self, executor, shard, error):
+        logger.warning("⚠️ Processo di riscrittura terminato, blocco riscritto localmente: %s", error)
+        _discard_shard_executor(executor)
+        return self._rewrite_here(shard)
+
+    def _result(self):
+        future, executor, shard = self._inflight.popleft()
+        if future is None:
+            return self._rewrite_here(shard)
+        try:
+            return self._merge(future.result())
+        except BrokenProcessPool as e:
+            return self._broken_pool_result(executor, shard, e)
+
+    def _ready(self):
+        return self._inflight and self._inflight[0][0] is not None and self._inflight[0][0].done()
+
+    def _tail(self):
+        # Ultima parte della playlist (più corta di un blocco): riscritta qui
+        buffer, self._buffer = self._buffer, b''
+        return self._rewrite_here(buffer)
+
+    def _local_output(self, data, final=False):
+        output = self.local.feed(data) if data else b''
+        if final:
+            output += self.local.flush()
+        return output
+
+    def feed(self, chunk):
+        """Come M3UChunkRewriter.feed; in modalità pool restituisce i blocchi già pronti."""
+        data, shards = self._split(chunk)
+        output = [self._local_output(data)]
+        for shard in shards:
+            while len(self._inflight) >= self.max_inflight:
+                output.append(self._result())
+            self._submit(shard)
+        while self._ready():
+            output.append(self._result())
+        return b''.join(output)
+
+    def flush(self):
+        """Attende i blocchi in lavorazione e riscrive la parte finale."""
+        if not self._sharding:
+            return self._local_output(b'', final=True)
+        output = []
+        while self._inflight:
+            output.append(self._result())
+        output.append(self._tail())
+        return b''.join(output)
+
+class UpstreamSessionPool:
+    """
+    Sessioni HTTP keep-alive condivise (per worker) verso gli upstream.
+    Una sessione per host, ciascuna con il proprio pool di connessioni, così
+    le richieste successive allo stesso provider riusano TCP/TLS già aperti.
+    """
+
+    def __init__(self, default_maxsize, host_maxsizes=None):
+        self.default_maxsize = default_maxsize
+        self.host_maxsizes = host_maxsizes or {}
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def _pool_maxsize(self, host):
+        return self.host_maxsizes.get(host, self.default_maxsize)
+
+    def get_session(self, url):
+        parsed = urllib.parse.urlsplit(url)
+        host_key = f"{parsed.scheme}://{parsed.netloc}".lower()
+        session = self._sessions.get(host_key)
+        if session is not None:
+            return session
+        with self._lock:
+            session = self._sessions.get(host_key)
+            if session is None:
+                pool_maxsize = self._pool_maxsize((parsed.hostname or '').lower())
+                adapter = UpstreamHTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize)
+                session = requests.Session()
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._sessions[host_key] = session
+                logger.info("🔌 Nuova sessione upstream per %s (pool_maxsize=%s)", host_key, pool_maxsize)
+        return session
+
+    def reset(self):
+        """Scarta tutte le sessioni (usato dopo il fork dei worker)."""
+        with self._lock:
+            self._sessions = {}
+
+    def stats(self):
+        """Statistiche di riuso delle connessioni: hit = richieste servite da connessioni già aperte."""
+        stats = {}
+        with self._lock:
+            sessions = list(self._sessions.items())
+        for host_key, session in sessions:
+            requests_count = 0
+            connections_count = 0
+            for adapter in set(session.adapters.values()):
+                for pool_key in list(adapter.poolmanager.pools.keys()):
+                    pool = adapter.poolmanager.pools.get(pool_key)
+                    if pool is None:
+                        continue
+                    requests_count += pool.num_requests
+                    connections_count += pool.num_connections
+            stats[host_key] = {
+                'requests': requests_count,
+                'pool_hits': max(0, requests_count - connections_count),
+                'pool_misses': connections_count,
+            }
+        return stats
+
+def _parse_host_sizes(value):
+    # "host1=20,host2=5" -> {'host1': 20, 'host2': 5}
+    sizes = {}
+    for item in value.split(','):
+        if '=' in item:
+            host, size = item.split('=', 1)
+            sizes[host.strip().lower()] = int(size)
+    return sizes
+
+upstream_sessions = UpstreamSessionPool(UPSTREAM_POOL_MAXSIZE, _parse_host_sizes(UPSTREAM_POOL_SIZES))
+
+class DNSCache:
+    """
+    Cache LRU con TTL delle risoluzioni DNS usata solo dalle sessioni upstream
+    (UpstreamHTTPAdapter): il resto del processo continua a usare
+    socket.getaddrinfo. Al massimo max_entries host, gli altri vengono scartati.
+    """
+
+    def __init__(self, ttl, max_entries=1024):
+        self.ttl = ttl
+        self.max_entries = max(1, max_entries)
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict() # (host, porta) -> (scadenza, indirizzi)
+        self._lock = threading.Lock()
+
+    def resolve(self, host, port):
+        """Indirizzi IP di host (nell'ordine di getaddrinfo, senza duplicati)."""
+        key = (host, port)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+        infos = socket.getaddrinfo(host, port, urllib3.util.connection.allowed_gai_family(), socket.SOCK_STREAM)
+        addresses = list(dict.fromkeys(info[4][0] for info in infos))
+        with self._lock:
+            self.misses += 1
+            self._entries[key] = (now + self.ttl, addresses)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return addresses
+
+    def invalidate(self, host, port):
+        with self._lock:
+            self._entries.pop((host, port), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries = OrderedDict()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries)}
+
+class _CachedDNSConnectionMixin:
+    # Connessione urllib3 che risolve l'host tramite dns_cache e prova gli
+    # indirizzi in ordine; SNI e verifica del certificato usano sempre il nome
+    def _new_conn(self):
+        if dns_cache is None:
+            return super()._new_conn()
+        host = self._dns_host
+        try:
+            addresses = dns_cache.resolve(host, self.port)
+        except OSError as e:
+            raise urllib3.exceptions.NewConnectionError(self, f"Failed to resolve '{host}': {e}") from e
+        error = None
+        for address in addresses:
+            self._dns_host = address
+            try:
+                return super()._new_conn()
+            except (urllib3.exceptions.NewConnectionError, urllib3.exceptions.ConnectTimeoutError) as e:
+                error = e
+            finally:
+                self._dns_host = host
+        # Nessun indirizzo raggiungibile: al prossimo tentativo si risolve di nuovo
+        dns_cache.invalidate(host, self.port)
+        if error is None:
+            raise urllib3.exceptions.NewConnectionError(self, f"Failed to resolve '{host}': no addresses")
+        raise error
+
+class _CachedDNSHTTPConnection(_CachedDNSConnectionMixin, urllib3.connection.HTTPConnection):
+    pass
+
+class _CachedDNSHTTPSConnection(_CachedDNSConnectionMixin, urllib3.connection.HTTPSConnection):
+    pass
+
+class _CachedDNSHTTPConnectionPool(urllib3.HTTPConnectionPool):
+    ConnectionCls = _CachedDNSHTTPConnection
+
+class _CachedDNSHTTPSConnectionPool(urllib3.HTTPSConnectionPool):
+    ConnectionCls = _CachedDNSHTTPSConnection
+
+class UpstreamHTTPAdapter(requests.adapters.HTTPAdapter):
+    """HTTPAdapter delle sessioni upstream: connessioni con la cache DNS (se attiva)."""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _CachedDNSHTTPConnectionPool, 'https': _CachedDNSHTTPSConnectionPool,
+        }
+
+dns_cache = None
+if UPSTREAM_DNS_CACHE_TTL > 0:
+    dns_cache = DNSCache(UPSTREAM_DNS_CACHE_TTL, UPSTREAM_DNS_CACHE_MAX_ENTRIES)
+
+def _reset_upstream_state_after_fork():
+    # Ogni worker gunicorn deve avere le proprie connessioni (mai condivise tra processi)
+    upstream_sessions.reset()
+    if dns_cache is not None:
+        dns_cache.clear()
+
+os.register_at_fork(after_in_child=_reset_upstream_state_after_fork)
+
+UPSTREAM_REQUEST_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+    'Accept': '*/*',
+    'Accept-Language': 'en-US,en;q=0.9',
+    'Accept-Encoding': 'gzip, deflate, br' if brotli is not None else 'gzip, deflate',
+    'Connection': 'keep-alive'
+}
+
+class UpstreamCacheEntry:
+    """Playlist upstream in cache: validatori HTTP, età e corpo (in memoria o su disco)."""
+
+    __slots__ = ('url', 'etag', 'last_modified', 'fetched_at', 'size', 'body', 'path', 'file')
+
+    def __init__(self, url, etag, last_modified, fetched_at, size, body=None, path=None, file=None):
+        self.url = url
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched_at = fetched_at
+        self.size = size
+        self.body = body # bytes, solo per le voci in memoria
+        self.path = path # file di spool su disco
+        self.file = file # Spool aperto da lookup, posizionato dopo i metadati
+
+    def has_validators(self):
+        return bool(self.etag or self.last_modified)
+
+    def is_fresh(self, now=None):
+        # Con ETag/Last-Modified si rivalida dopo UPSTREAM_CACHE_REVALIDATE_AFTER,
+        # altrimenti la voce resta valida per UPSTREAM_CACHE_TTL.
+        age = (now or time.time()) - self.fetched_at
+        if self.has_validators():
+            return age < UPSTREAM_CACHE_REVALIDATE_AFTER
+        return age < UPSTREAM_CACHE_TTL
+
+    def conditional_headers(self):
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+    def iter_chunks(self, chunk_size=None):
+        """
+        Restituisce il corpo a blocchi, senza caricarlo tutto (per lo spool su disco).
+        Le voci su disco leggono dal file aperto da lookup: se nel frattempo il
+        file viene sostituito o eliminato (limite su disco) la lettura prosegue.
+        """
+        chunk_size = chunk_size or UPSTREAM_CHUNK_SIZE
+        if self.body is not None:
+            for offset in range(0, len(self.body), chunk_size):
+                yield self.body[offset:offset + chunk_size]
+            return
+        with self.file as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+    def close(self):
+        # Voce su disco non servita (es. sostituita da un nuovo download)
+        if self.file is not None:
+            self.file.close()
+
+class UpstreamCache:
+    """
+    Cache delle playlist upstream, indicizzata per URL.
+    LRU in memoria limitata in byte, più uno spool opzionale su disco condiviso
+    da tutti i worker gunicorn. Ogni file di spool contiene una riga JSON di
+    metadati seguita dal corpo; la data di modifica del file indica l'ultimo
+    download o rivalidazione.
+    """
+
+    def __init__(self, memory_bytes, max_entry_bytes, directory=None, disk_bytes=0):
+        self.memory_bytes = memory_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.directory = directory
+        self.disk_bytes = disk_bytes
+        self._entries = OrderedDict()
+        self._memory_used = 0
+        self._disk_used = None # Stima dei byte su disco (di tutti i worker), ricalcolata a ogni pulizia
+        self._lock = threading.Lock()
+        self.counters = {'hits': 0, 'misses': 0, 'revalidated': 0, 'stored': 0}
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def _spool_path(self, url):
+        return os.path.join(self.directory, hashlib.sha256(url.encode('utf-8')).hexdigest() + '.m3u')
+
+    def count(self, counter):
+        with self._lock:
+            self.counters[counter] += 1
+
+    def lookup(self, url):
+        """Restituisce la voce più recente per l'URL (memoria o disco), anche se scaduta."""
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is not None:
+                self._entries.move_to_end(url)
+        if not self.directory:
+            return entry
+        path = self._spool_path(url)
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            return entry
+        # Un altro worker può aver scaricato o rivalidato la playlist più di recente
+        if entry is not None and entry.fetched_at >= mtime:
+            return entry
+        # Il file resta aperto fino alla lettura del corpo: la pulizia del disco non lo invalida
+        try:
+            f = open(path, 'rb')
+        except OSError:
+            return entry
+        try:
+            mtime = os.fstat(f.fileno()).st_mtime
+            meta = json.loads(f.readline())
+        except (OSError, ValueError):
+            f.close()
+            return entry
+        return UpstreamCacheEntry(url, meta.get('etag'), meta.get('last_modified'), mtime, meta.get('size', 0), path=path, file=f)
+
+    def touch(self, entry):
+        """Segna la voce come appena rivalidata (risposta 304)."""
+        now = time.time()
+        entry.fetched_at = now
+        if entry.path:
+            try:
+                os.utime(entry.path, (now, now))
+            except OSError:
+                pass
+
+    def writer(self, url, response_headers):
+        return UpstreamCacheWriter(self, url, response_headers.get('ETag'), response_headers.get('Last-Modified'))
+
+    def _store(self, entry):
+        with self._lock:
+            self.counters['stored'] += 1
+            previous = self._entries.pop(entry.url, None)
+            if previous is not None and previous.body is not None:
+                self._memory_used -= previous.size
+            if entry.body is not None:
+                self._entries[entry.url] = entry
+                self._memory_used += entry.size
+                # Evizione LRU finché si rientra nel limite di memoria
+                while self._memory_used > self.memory_bytes and self._entries:
+                    _, evicted = self._entries.popitem(last=False)
+                    self._memory_used -= evicted.size
+        if self.directory and self.disk_bytes and entry.path:
+            self._account_disk(entry.size)
+
+    def _account_disk(self, size):
+        # La directory viene letta alla prima scrittura e quando la stima supera il
+        # limite; la lettura conta anche i file scritti nel frattempo dagli altri worker
+        with self._lock:
+            if self._disk_used is not None:
+                self._disk_used += size
+                if self._disk_used <= self.disk_bytes:
+                    return
+        total = self._prune_disk()
+        with self._lock:
+            self._disk_used = total
+
+    DISK_PRUNE_TARGET = 0.9 # Frazione del limite a cui scende la pulizia: margine prima della successiva
+
+    def _prune_disk(self):
+        """Elimina i file di spool meno recenti oltre il limite su disco; restituisce i byte rimasti."""
+        try:
+            names = [name for name in os.listdir(self.directory) if name.endswith('.m3u')]
+        except OSError:
+            return None
+        files = []
+        for name in names:
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue # Eliminato da un altro worker
+            files.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in files)
+        if total <= self.disk_bytes:
+            return total
+        for _, size, path in sorted(files):
+            if total <= self.disk_bytes * self.DISK_PRUNE_TARGET:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+        return total
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats['memory_entries'] = len(self._entries)
+            stats['memory_bytes'] = self._memory_used
+        stats['disk_spool'] = self.directory or None
+        return stats
+
+class UpstreamCacheWriter:
+    """Copia i blocchi scaricati nella cache; la voce viene pubblicata solo a download completato."""
+
+    def __init__(self, cache, url, etag, last_modified):
+        self.cache = cache
+        self.url = url
+        self.etag = etag
+        self.last_modified = last_modified
+        self.size = 0
+        self._buffer = bytearray() if cache.memory_bytes > 0 else None
+        self._file = None
+        if cache.directory:
+            self._file = tempfile.NamedTemporaryFile(dir=cache.directory, prefix='.tmp-', delete=False)
+            # Metadati a larghezza fissa in testa al file: la dimensione finale è nota solo alla fine
+            self._meta_width = len(self._meta_json(0)) + 20
+            self._file.write(self._meta_line(0))
+
+    def _meta_json(self, size):
+        return json.dumps({'url': self.url, 'etag': self.etag, 'last_modified': self.last_modified, 'size': size}).encode('utf-8')
+
+    def _meta_line(self, size):
+        return self._meta_json(size).ljust(self._meta_width) + b'\n'
+
+    def write(self, chunk):
+        self.size += len(chunk)
+        if self._buffer is not None:
+            self._buffer += chunk
+            if len(self._buffer) > self.cache.max_entry_bytes:
+                self._buffer = None # Troppo grande per la memoria, resta solo su disco
+        if self._file is not None:
+            self._file.write(chunk)
+
+    def commit(self):
+        path = None
+        if self._file is not None:
+            self._file.seek(0)
+            self._file.write(self._meta_line(self.size))
+            self._file.close()
+            path = self.cache._spool_path(self.url)
+            os.replace(self._file.name, path)
+            self._file = None
+        body = bytes(self._buffer) if self._buffer is not None else None
+        self._buffer = None
+        if body is None and path is None:
+            return
+        self.cache._store(UpstreamCacheEntry(
+            self.url, self.etag, self.last_modified, time.time(), self.size, body=body, path=path
+        ))
+
+    def discard(self):
+        self._buffer = None
+        if self._file is not None:
+            self._file.close()
+            try:
+                os.remove(self._file.name)
+            except OSError:
+                pass
+            self._file = None
+
+upstream_cache = None
+if UPSTREAM_CACHE_ENABLED:
+    upstream_cache = UpstreamCache(
+        UPSTREAM_CACHE_MEMORY_BYTES, UPSTREAM_CACHE_MAX_ENTRY_BYTES,
+        directory=UPSTREAM_CACHE_DIR or None, disk_bytes=UPSTREAM_CACHE_DISK_BYTES
+    )
+
+class UpstreamDecoder:
+    """
+    Decompressione incrementale del corpo upstream secondo Content-Encoding
+    (gzip, deflate e, se disponibile il modulo brotli, br). I blocchi vengono
+    letti compressi dal socket e decompressi qui, uno alla volta. Con una
+    codifica sconosciuta il corpo è inoltrato invariato.
+    """
+
+    def __init__(self, content_encoding):
+        self.encoding = (content_encoding or '').strip().lower()
+        self._deflate_raw_fallback = False
+        if self.encoding in ('', 'identity'):
+            self._decompressor = None
+        elif self.encoding in ('gzip', 'x-gzip'):
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif self.encoding == 'deflate':
+            # Alcuni server inviano deflate "raw" senza header zlib
+            self._decompressor = zlib.decompressobj(zlib.MAX_WBITS)
+            self._deflate_raw_fallback = True
+        elif self.encoding == 'br' and brotli is not None:
+            self._decompressor = brotli.Decompressor()
+        else:
+            # Codifica sconosciuta (o br senza il modulo brotli): il corpo passa così com'è
+            log_sampled('upstream_unknown_encoding', logging.WARNING,
+                        "⚠️ Content-Encoding upstream non supportato (%s): corpo inoltrato senza decompressione", content_encoding)
+            self._decompressor = None
+
+    def decompress(self, data):
+        if self._decompressor is None:
+            return data
+        if self.encoding == 'br':
+            return self._decompressor.process(data)
+        try:
+            output = self._decompressor.decompress(data)
+        except zlib.error:
+            if not self._deflate_raw_fallback:
+                raise
+            self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            output = self._decompressor.decompress(data)
+        self._deflate_raw_fallback = False
+        # gzip con più membri concatenati
+        while self._decompressor.eof and self._decompressor.unused_data:
+            unused_data = self._decompressor.unused_data
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            output += self._decompressor.decompress(unused_data)
+        return output
+
+    def flush(self):
+        if self._decompressor is None or self.encoding == 'br':
+            return b''
+        return self._decompressor.flush()
+
+def iter_decoded_response(response, chunk_size=None):
+    """Legge la risposta compressa a blocchi grandi e la decomprime in streaming."""
+    decoder = UpstreamDecoder(response.headers.get('Content-Encoding'))
+    for raw_chunk in response.raw.stream(chunk_size or UPSTREAM_CHUNK_SIZE, decode_content=False):
+        chunk = decoder.decompress(raw_chunk)
+        if chunk:
+            yield chunk
+    tail = decoder.flush()
+    if tail:
+        yield tail
+
+class UpstreamUnavailable(Exception):
+    """Upstream saltato perché il circuit breaker del suo host è aperto."""
+
+class DeadlineExceeded(Exception):
+    """Il tempo massimo della richiesta /proxy è esaurito."""
+
+class AdmissionRejected(Exception):
+    """Limite di ammissione raggiunto: coda piena o attesa scaduta."""
+
+class AdmissionLimiter:
+    """
+    Limite di operazioni contemporanee per worker. Quando tutti i posti sono
+    occupati fino a max_waiting richieste attendono al massimo wait_timeout
+    secondi; oltre, la richiesta viene rifiutata (AdmissionRejected) invece di
+    accumulare lavoro che il worker non riesce a smaltire.
+    """
+
+    def __init__(self, name, limit, max_waiting, wait_timeout):
+        self.name = name
+        self.limit = limit
+        self.max_waiting = max_waiting
+        self.wait_timeout = wait_timeout
+        self.reset()
+
+    def reset(self):
+        # Anche dopo il fork: la condizione ereditata potrebbe essere bloccata da un thread del padre
+        self._condition = threading.Condition()
+        self._active = 0
+        self._waiting = 0
+        self._counters = {'admitted': 0, 'queued': 0, 'rejected': 0}
+
+    def try_acquire(self):
+        """Occupa un posto solo se è libero subito (senza coda né conteggio dei rifiuti)."""
+        with self._condition:
+            if self._active >= self.limit:
+                return False
+            self._active += 1
+            self._counters['admitted'] += 1
+            return True
+
+    def acquire(self):
+        """Occupa un posto, attendendo in coda se necessario; AdmissionRejected se non è possibile."""
+        with self._condition:
+            if self._active < self.limit:
+                self._active += 1
+                self._counters['admitted'] += 1
+                return
+            if self._waiting >= self.max_waiting or self.wait_timeout <= 0:
+                self._counters['rejected'] += 1
+                raise AdmissionRejected(f"limite {self.name} raggiunto ({self.limit} attivi, {self._waiting} in coda)")
+            self._waiting += 1
+            self._counters['queued'] += 1
+            try:
+                admitted = self._condition.wait_for(lambda: self._active < self.limit, self.wait_timeout)
+            finally:
+                self._waiting -= 1
+            if not admitted:
+                self._counters['rejected'] += 1
+                raise AdmissionRejected(f"limite {self.name} raggiunto (nessun posto libero dopo {self.wait_timeout:.0f}s di attesa)")
+            self._active += 1
+            self._counters['admitted'] += 1
+
+    async def acquire_async(self):
+        """Versione per l'event loop: l'attesa in coda avviene in un thread."""
+        if self.try_acquire():
+            return
+        waiter = asyncio.ensure_future(asyncio.to_thread(self.acquire))
+        try:
+            await asyncio.shield(waiter)
+        except asyncio.CancelledError:
+            # Il thread in coda non si può interrompere: se ottiene il posto lo restituisce subito
+            waiter.add_done_callback(self._release_abandoned)
+            raise
+
+    def _release_abandoned(self, waiter):
+        if not waiter.cancelled() and waiter.exception() is None:
+            self.release()
+
+    def release(self):
+        with self._condition:
+            self._active -= 1
+            self._condition.notify()
+
+    def stats(self):
+        with self._condition:
+            return {'limit': self.limit, 'active': self._active, 'waiting': self._waiting, **self._counters}
+
+class AdmissionSlot:
+    """
+    Posto di un AdmissionLimiter condiviso da più detentori (es. la risposta
+    e il completamento in background dello spool): torna libero quando
+    l'ultimo detentore lo rilascia.
+    """
+
+    def __init__(self, limiter):
+        self._limiter = limiter
+        self._holders = 1
+        self._lock = threading.Lock()
+
+    def retain(self):
+        with self._lock:
+            self._holders += 1
+
+    def release(self):
+        with self._lock:
+            self._holders -= 1
+            if self._holders:
+                return
+        self._limiter.release()
+
+def _create_admission_limiter(name, limit):
+    if limit <= 0:
+        return None
+    limiter = AdmissionLimiter(name, limit, ADMISSION_QUEUE_SIZE, ADMISSION_QUEUE_TIMEOUT)
+    os.register_at_fork(after_in_child=limiter.reset)
+    return limiter
+
+merge_admission = _create_admission_limiter('generazioni', ADMISSION_MAX_MERGES)
+upstream_admission = _create_admission_limiter('download upstream', ADMISSION_MAX_UPSTREAM_FETCHES)
+
+def admission_rejected_message(error):
+    logger.warning("🚦 Richiesta rifiutata (429): %s", error)
+    return f"Servizio sovraccarico: {error}. Riprovare tra {ADMISSION_RETRY_AFTER}s"
+
+def admission_rejected_response(error):
+    return Response(
+        admission_rejected_message(error), status=429, mimetype='text/plain',
+        headers={'Retry-After': str(ADMISSION_RETRY_AFTER)}
+    )
+
+class CircuitBreaker:
+    """
+    Circuit breaker per host (per worker). Dopo failure_threshold errori
+    consecutivi (rete, timeout, 5xx) l'host viene saltato per cooldown
+    secondi; poi una sola richiesta di prova decide se richiuderlo.
+    """
+
+    def __init__(self, failure_threshold, cooldown):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._hosts = {} # host -> {'failures': n, 'opened_at': t|None, 'probe_at': t|None}
+        self._lock = threading.Lock()
+
+    def allow(self, host):
+        """True se si può contattare l'host; in stato semiaperto lascia passare una prova."""
+        with self._lock:
+            state = self._hosts.get(host)
+            if state is None or state['opened_at'] is None:
+                return True
+            now = time.monotonic()
+            if now - state['opened_at'] < self.cooldown:
+                return False
+            # Semiaperto: una prova alla volta (rinnovata se quella precedente non è mai terminata)
+            if state['probe_at'] is not None and now - state['probe_at'] < self.cooldown:
+                return False
+            state['probe_at'] = now
+            return True
+
+    def retry_after(self, host):
+        with self._lock:
+            state = self._hosts.get(host)
+            if state is None or state['opened_at'] is None:
+                return 0
+            return max(0, self.cooldown - (time.monotonic() - state['opened_at']))
+
+    def record_success(self, host):
+        with self._lock:
+            state = self._hosts.pop(host, None)
+        if state is not None and state['opened_at'] is not None:
+            logger.info("🟢 Circuit breaker chiuso per %s: upstream di nuovo raggiungibile", host)
+
+    def record_failure(self, host):
+        with self._lock:
+            state = self._hosts.setdefault(host, {'failures': 0, 'opened_at': None, 'probe_at': None})
+            state['failures'] += 1
+            state['probe_at'] = None
+            if state['failures'] < self.failure_threshold:
+                return
+            was_open = state['opened_at'] is not None
+            state['opened_at'] = time.monotonic()
+        if not was_open:
+            logger.warning("🔴 Circuit breaker aperto per %s dopo %s errori consecutivi (pausa %.0fs)", host, self.failure_threshold, self.cooldown)
+
+    def reset(self):
+        with self._lock:
+            self._hosts = {}
+
+    def stats(self):
+        with self._lock:
+            now = time.monotonic()
+            return {
+                host: {
+                    'failures': state['failures'],
+                    'open': state['opened_at'] is not None and now - state['opened_at'] < self.cooldown,
+                }
+                for host, state in self._hosts.items()
+            }
+
+circuit_breaker = None
+if CIRCUIT_BREAKER_FAILURES > 0:
+    circuit_breaker = CircuitBreaker(CIRCUIT_BREAKER_FAILURES, CIRCUIT_BREAKER_COOLDOWN)
+    os.register_at_fork(after_in_child=circuit_breaker.reset)
+
+def _remaining_time(deadline):
+    if deadline is None:
+        return None
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise DeadlineExceeded("Tempo massimo della richiesta esaurito (PROXY_DEADLINE)")
+    return remaining
+
+def _upstream_timeout(deadline):
+    # (connect, read) limitati dal tempo rimasto alla richiesta
+    remaining = _remaining_time(deadline)
+    if remaining is None:
+        return UPSTREAM_CONNECT_TIMEOUT, UPSTREAM_READ_TIMEOUT
+    return min(UPSTREAM_CONNECT_TIMEOUT, remaining), min(UPSTREAM_READ_TIMEOUT, remaining)
+
+_hedge_executor = None
+_hedge_executor_lock = threading.Lock()
+
+def _hedge_pool_size():
+    # Richiesta originale e duplicato per ogni download upstream ammesso (ADMISSION_MAX_UPSTREAM_FETCHES);
+    # senza limite, per i download paralleli di ogni generazione ammessa
+    if UPSTREAM_HEDGE_WORKERS > 0:
+        return UPSTREAM_HEDGE_WORKERS
+    fetches = ADMISSION_MAX_UPSTREAM_FETCHES or PARALLEL_DOWNLOADS_WORKERS * max(1, ADMISSION_MAX_MERGES)
+    return 2 * fetches
+
+def _get_hedge_executor():
+    global _hedge_executor
+    with _hedge_executor_lock:
+        if _hedge_executor is None:
+            _hedge_executor = ThreadPoolExecutor(max_workers=_hedge_pool_size(), thread_name_prefix='m3u-hedge')
+        return _hedge_executor
+
+def _reset_hedge_executor_after_fork():
+    global _hedge_executor, _hedge_executor_lock
+    _hedge_executor = None
+    _hedge_executor_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_reset_hedge_executor_after_fork)
+
+def _close_losing_response(future):
+    if future.exception() is None:
+        future.result().close()
+
+def _send_upstream_request(session, url, headers, deadline):
+    return session.get(url, headers=headers, timeout=_upstream_timeout(deadline), verify=False, stream=True)
+
+def _hedged_upstream_request(session, url, headers, deadline):
+    """
+    Invia la richiesta e, se gli header non arrivano entro UPSTREAM_HEDGE_AFTER
+    secondi, ne invia una seconda: vince la prima risposta, l'altra viene chiusa.
+    """
+    executor = _get_hedge_executor()
+    primary = executor.submit(_send_upstream_request, session, url, headers, deadline)
+    done, _ = wait_futures([primary], timeout=UPSTREAM_HEDGE_AFTER)
+    if done:
+        return primary.result()
+    remaining = _remaining_time(deadline)
+    if remaining is not None and remaining <= UPSTREAM_HEDGE_AFTER:
+        return primary.result()
+    log_sampled('upstream_hedge', logging.INFO, "🪃 Nessuna risposta da %s dopo %.1fs: richiesta duplicata", url, UPSTREAM_HEDGE_AFTER)
+    pending = {primary, executor.submit(_send_upstream_request, session, url, headers, deadline)}
+    last_error = None
+    while pending:
+        done, pending = wait_futures(pending, return_when=FIRST_COMPLETED)
+        winner = None
+        for future in done:
+            try:
+                response = future.result()
+            except requests.RequestException as e:
+                last_error = e
+                continue
+            if winner is None:
+                winner = response
+            else:
+                response.close() # Risposte arrivate insieme: si tiene la prima
+        if winner is not None:
+            for other in pending:
+                other.add_done_callback(_close_losing_response)
+            return winner
+    raise last_error
+
+def open_upstream_response(url, headers, deadline=None):
+    """
+    Apre la risposta upstream (header ricevuti, corpo in streaming), con
+    hedging e fino a UPSTREAM_RETRIES tentativi aggiuntivi su errori di rete
+    e risposte 5xx, sempre entro il tempo rimasto alla richiesta.
+    """
+    session = upstream_sessions.get_session(url)
+    attempts = 1 + max(0, UPSTREAM_RETRIES)
+    for attempt in range(attempts):
+        last_attempt = attempt == attempts - 1
+        try:
+            if UPSTREAM_HEDGE_AFTER > 0:
+                response = _hedged_upstream_request(session, url, headers, deadline)
+            else:
+                response = _send_upstream_request(session, url, headers, deadline)
+        except requests.RequestException as e:
+            if last_attempt:
+                raise
+            error = str(e)
+        else:
+            if response.status_code < 500 or last_attempt:
+                return response
+            response.close()
+            error = f"HTTP {response.status_code}"
+        time.sleep(_retry_backoff(attempt, attempts, url, error, deadline))
+
+def _retry_backoff(attempt, attempts, url, error, deadline):
+    """Attesa prima del prossimo tentativo; DeadlineExceeded se non rientra nel tempo rimasto."""
+    backoff = UPSTREAM_RETRY_BACKOFF * (2 ** attempt)
+    remaining = _remaining_time(deadline)
+    if remaining is not None and remaining <= backoff:
+        raise DeadlineExceeded(f"Tempo massimo della richiesta esaurito dopo {attempt + 1} tentativi ({error})")
+    logger.warning("🔁 Tentativo %s/%s fallito per %s (%s): nuovo tentativo tra %.1fs", attempt + 1, attempts, url, error, backoff)
+    return backoff
+
+# Passi di fetch_upstream_chunks condivisi con la versione asincrona
+
+def _serve_cached_entry(url, entry):
+    """True se la voce in cache è ancora valida e va servita senza contattare il provider."""
+    if entry is None or not entry.is_fresh():
+        return False
+    upstream_cache.count('hits')
+    logger.info("📦 Cache hit per %s (%s bytes)", url, entry.size)
+    return True
+
+def _upstream_host(url):
+    """host[:porta] dell'upstream; UpstreamUnavailable se il circuit breaker è aperto."""
+    host = urllib.parse.urlsplit(url).netloc.rpartition('@')[2].lower()
+    if circuit_breaker is not None and not circuit_breaker.allow(host):
+        raise UpstreamUnavailable(f"upstream {host} non raggiungibile (circuit breaker aperto, nuovo tentativo tra {circuit_breaker.retry_after(host):.0f}s)")
+    return host
+
+def _upstream_request_headers(entry):
+    # GET condizionale (If-None-Match / If-Modified-Since) se la voce in cache è scaduta
+    headers = dict(UPSTREAM_REQUEST_HEADERS)
+    if entry is not None:
+        headers.update(entry.conditional_headers())
+    return headers
+
+def _record_upstream_failure(host):
+    if circuit_breaker is not None:
+        circuit_breaker.record_failure(host)
+
+def _record_upstream_status(host, status):
+    if circuit_breaker is not None:
+        if status >= 500:
+            circuit_breaker.record_failure(host)
+        else:
+            circuit_breaker.record_success(host)
+
+def _revalidate_cached_entry(url, entry):
+    """Risposta 304: la voce in cache resta valida per un altro TTL."""
+    upstream_cache.touch(entry)
+    upstream_cache.count('revalidated')
+    logger.info("📦 Playlist non modificata (304), servita dalla cache: %s", url)
+
+def fetch_upstream_chunks(url, timing=None, deadline=None):
+    """
+    Restituisce il corpo della playlist upstream a blocchi di byte.
+    Se la cache è attiva serve le voci ancora valide senza contattare il
+    provider, altrimenti effettua una GET condizionale (If-None-Match /
+    If-Modified-Since) e salva in cache la nuova versione mentre la trasmette.
+    Se indicato, timing['connect'] riceve il tempo fino agli header di risposta;
+    deadline (time.monotonic()) limita connessione e lettura del corpo.
+    """
+    started_at = time.monotonic()
+    entry = upstream_cache.lookup(url) if upstream_cache is not None else None
+    if _serve_cached_entry(url, entry):
+        yield from entry.iter_chunks()
+        return
+
+    host = _upstream_host(url)
+
+    # Posto tra i download upstream del worker, tenuto fino alla fine del corpo
+    if upstream_admission is not None:
+        upstream_admission.acquire()
+    try:
+        # verify=False is generally not recommended for production
+        try:
+            response = open_upstream_response(url, _upstream_request_headers(entry), deadline)
+        except requests.RequestException:
+            _record_upstream_failure(host)
+            raise
+        with response:
+            if timing is not None:
+                timing['connect'] = time.monotonic() - started_at
+            logger.info("Status code %s da %s", response.status_code, url)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Headers risposta (prime parti): %s", {k: v[:100] for k, v in response.headers.items()}) # Log snippet of headers
+            _record_upstream_status(host, response.status_code)
+            if response.status_code == 304 and entry is not None:
+                _revalidate_cached_entry(url, entry)
+                yield from entry.iter_chunks()
+                return
+            response.raise_for_status()
+
+            writer = None
+            if upstream_cache is not None:
+                upstream_cache.count('misses')
+                writer = upstream_cache.writer(url, response.headers)
+            try:
+                for chunk in iter_decoded_response(response):
+                    if deadline is not None and time.monotonic() > deadline:
+                        raise DeadlineExceeded(f"Tempo massimo della richiesta esaurito durante il download da {host}")
+                    if writer is not None:
+                        writer.write(chunk)
+                    yield chunk
+                if writer is not None:
+                    writer.commit()
+                    writer = None
+            except (requests.RequestException, urllib3.exceptions.HTTPError):
+                # Upstream che si blocca o chiude la connessione a metà corpo
+                _record_upstream_failure(host)
+                raise
+            finally:
+                # Download interrotto o fallito: la voce parziale non va in cache
+                if writer is not None:
+                    writer.discard()
+    finally:
+        if entry is not None:
+            entry.close()
+        if upstream_admission is not None:
+            upstream_admission.release()
+
+def iter_lines_from_chunks(chunks):
+    """
+    Divide un flusso di blocchi di byte in linee (senza terminatore). Come
+    requests.iter_lines (bytes.splitlines) le linee finiscono con LF, CRLF o CR.
+    """
+    pending = b''
+    for chunk in chunks:
+        if pending:
+            chunk = pending + chunk
+        held = b''
+        if chunk.endswith(b'\r'):
+            chunk, held = chunk[:-1], b'\r' # Il LF di un CRLF può arrivare con il blocco successivo
+        lines = chunk.splitlines(keepends=True)
+        pending = lines.pop() if lines and not lines[-1].endswith((b'\n', b'\r')) else b''
+        pending += held
+        for line in lines:
+            yield line.rstrip(b'\r\n')
+    if pending:
+        yield pending.rstrip(b'\r')
+
+def download_m3u_playlist_chunks(url, timing=None, deadline=None):
+    """Scarica la playlist upstream come blocchi di byte grezzi (UPSTREAM_CHUNK_SIZE)."""
+    try:
+        logger.info("Scaricamento (streaming) da: %s", url)
+        yield from fetch_upstream_chunks(url, timing, deadline)
+
+    except (requests.RequestException, urllib3.exceptions.HTTPError) as e:
+        logger.error("Errore download (streaming): %s", e)
+        raise Exception(f"Errore nel download (streaming) della playlist: {str(e)}")
+    except (UpstreamUnavailable, DeadlineExceeded, AdmissionRejected) as e:
+        logger.warning("⏭️ Playlist saltata %s: %s", url, e)
+        raise
+    except Exception as e:
+        logger.error("Errore generico durante lo streaming del download da %s: %s", url, e)
+        raise
+
+def decode_m3u_lines(chunks):
+    """Linee di testo (con '\n') di un flusso di blocchi, per rewrite_m3u_links_streaming."""
+    for line_bytes in iter_lines_from_chunks(chunks):
+        # Explicitly skip empty (or whitespace-only) lines
+        if line_bytes.strip():
+            yield line_bytes.decode('utf-8', errors='replace') + '\n'
+
+def download_m3u_playlist_streaming(url):
+    yield from decode_m3u_lines(download_m3u_playlist_chunks(url))
+
+DEFINITION_OPTION_KEYS = FILTER_OPTION_KEYS
+_DEFINITION_OPTION_SEPARATOR_RE = re.compile(r'(\||%7[cC])') # Alcuni client codificano '|' come %7C
+
+def split_definition_options(playlist_url):
+    """
+    Separa le opzioni in coda all'URL della playlist: 'url|chiave=valore|...'.
+    Sono considerate opzioni solo le parti finali con una chiave nota (un '|'
+    nell'URL stesso resta invariato); i valori sono decodificati (%XX).
+    """
+    parts = _DEFINITION_OPTION_SEPARATOR_RE.split(playlist_url) # [url, sep, opzione, sep, opzione...]
+    options = {}
+    while len(parts) > 2:
+        key, separator, value = parts[-1].partition('=')
+        key = key.strip().lower()
+        if not separator or key not in DEFINITION_OPTION_KEYS:
+            break
+        options.setdefault(key, urllib.parse.unquote(value))
+        del parts[-2:]
+    return ''.join(parts), options
+
+REQUEST_OPTION_KEYS = ('dedup', 'epg')
+
+def split_request_options(segments):
+    """
+    Separa dai segmenti della query string (divisi da ';') le opzioni della
+    richiesta, es. 'dedup=url': segmenti senza '&' con una chiave nota.
+    Restituisce (definizioni, opzioni).
+    """
+    definitions = []
+    options = {}
+    for segment in segments:
+        key, separator, value = segment.partition('=')
+        key = key.strip().lower()
+        if separator and '&' not in segment and key in REQUEST_OPTION_KEYS:
+            options[key] = urllib.parse.unquote(value)
+        else:
+            definitions.append(segment)
+    return definitions, options
+
+def create_request_deduplicator(request_options):
+    """
+    EntryDeduplicator per l'opzione 'dedup' della richiesta. Restituisce
+    (deduplicator o None, marcatore '# SKIPPED' se l'opzione non è valida).
+    """
+    if 'dedup' not in request_options:
+        return None, None
+    try:
+        return EntryDeduplicator(request_options['dedup']), None
+    except ValueError as e:
+        logger.warning("Opzione dedup ignorata: %s", e)
+        return None, f"# SKIPPED Invalid Option: dedup={request_options['dedup']} ({e})\n".encode('utf-8')
+
+def dedup_summary_line(deduplicator):
+    logger.info("🧹 Deduplicazione (%s): %s canali duplicati rimossi", deduplicator.mode, deduplicator.removed)
+    return f"# DEDUP {deduplicator.removed} duplicate entries removed (key: {deduplicator.mode})\n".encode('utf-8')
+
+def parse_playlist_definition(definition):
+    """
+    Separa una definizione 'dominio[:password]&url_playlist[|opzione=valore...]'
+    nelle sue parti. Restituisce (base_url, api_password, playlist_url, opzioni);
+    api_password è None in modalità senza password.
+    """
+    creds_part, playlist_url_str = definition.split('&', 1)
+
+    api_password = None
+    base_url_part = creds_part
+
+    # Heuristics to distinguish domain:port or scheme:// from domain:password
+    if ':' in creds_part:
+        possible_base, possible_pass = creds_part.rsplit(':', 1)
+
+        # A password is assumed if the part after the last colon is not a port (all digits)
+        # and does not start with '//' (which would mean we split a URL scheme like http://)
+        if not possible_pass.startswith('//') and not possible_pass.isdigit():
+            base_url_part = possible_base
+            api_password = possible_pass
+
+    playlist_url_str, options = split_definition_options(playlist_url_str)
+    return base_url_part.rstrip('/'), api_password, playlist_url_str, options
+
+TTFB_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+DOWNLOAD_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+def _new_host_metrics():
+    return {
+        'requests': 0, 'errors': 0, 'bytes': 0, 'lines': 0, 'active': 0, 'rule_hits': {},
+        'ttfb': {'buckets': [0] * len(TTFB_BUCKETS), 'sum': 0.0, 'count': 0},
+        'download': {'buckets': [0] * len(DOWNLOAD_BUCKETS), 'sum': 0.0, 'count': 0},
+    }
+
+def _observe(histogram, bounds, value):
+    for bucket_idx, bound in enumerate(bounds):
+        if value <= bound:
+            histogram['buckets'][bucket_idx] += 1
+            break
+    histogram['sum'] += value
+    histogram['count'] += 1
+
+class UpstreamMetrics:
+    """
+    Metriche per host upstream: TTFB e durata dei download (istogrammi),
+    byte e linee lette, regole applicate, errori e stream attivi.
+    Ogni worker aggiorna i propri contatori in memoria (una volta per
+    playlist, mai per blocco) e li scrive periodicamente in un file JSON
+    in METRICS_DIR (nome: pid e istante di avvio del processo, così un pid
+    riutilizzato non eredita lo snapshot di un altro processo); /metrics
+    somma gli snapshot dei worker vivi e i totali dei worker terminati,
+    accumulati in retired.json: i contatori non diminuiscono quando
+    gunicorn ricicla un worker.
+    """
+
+    RETIRED_FILE = 'retired.json'
+
+    def __init__(self, directory=None, flush_interval=5, max_hosts=200):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.max_hosts = max_hosts
+        self._hosts = {}
+        self._lock = threading.Lock()
+        self._flusher = None
+        self._process_id = _process_start_id(os.getpid())
+        # Snapshot finale all'uscita del processo (anche dei worker: l'handler è ereditato)
+        atexit.register(self.write_snapshot)
+
+    def reset_after_fork(self):
+        # Il worker parte da zero: i contatori del master non sono suoi
+        self._hosts = {}
+        self._lock = threading.Lock()
+        self._flusher = None
+        self._process_id = _process_start_id(os.getpid())
+
+    def _host_metrics(self, host):
+        host_metrics = self._hosts.get(host)
+        if host_metrics is None:
+            if len(self._hosts) >= self.max_hosts:
+                host = 'other'
+            host_metrics = self._hosts.setdefault(host, _new_host_metrics())
+        return host_metrics
+
+    def stream_started(self, host):
+        with self._lock:
+            host_metrics = self._host_metrics(host)
+            host_metrics['requests'] += 1
+            host_metrics['active'] += 1
+        self._ensure_flusher()
+
+    def first_byte(self, host, seconds):
+        with self._lock:
+            _observe(self._host_metrics(host)['ttfb'], TTFB_BUCKETS, seconds)
+
+    def stream_finished(self, host, seconds, size, lines, rule_hits, failed):
+        with self._lock:
+            host_metrics = self._host_metrics(host)
+            host_metrics['active'] -= 1
+            host_metrics['bytes'] += size
+            host_metrics['lines'] += lines
+            for rule_name, hits in rule_hits.items():
+                host_metrics['rule_hits'][rule_name] = host_metrics['rule_hits'].get(rule_name, 0) + hits
+            if failed:
+                host_metrics['errors'] += 1
+            elif seconds is not None:
+                _observe(host_metrics['download'], DOWNLOAD_BUCKETS, seconds)
+
+    def snapshot(self):
+        with self._lock:
+            return json.loads(json.dumps(self._hosts))
+
+    def _snapshot_path(self):
+        return os.path.join(self.directory, f"{self._process_id}.json")
+
+    def write_snapshot(self):
+        if not self.directory or not self._hosts:
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'pid': os.getpid(), 'hosts': self.snapshot()}, f)
+            os.replace(tmp_path, self._snapshot_path())
+        except OSError as e:
+            log_sampled('metrics_write_error', logging.WARNING, "⚠️ Impossibile scrivere lo snapshot delle metriche: %s", e)
+
+    def _ensure_flusher(self):
+        if self._flusher is not None or not self.directory:
+            return
+        with self._lock:
+            if self._flusher is not None:
+                return
+            self._flusher = threading.Thread(target=self._flush_loop, name='metrics-flush', daemon=True)
+            self._flusher.start()
+
+    def _flush_loop(self):
+        while True:
+            self.write_snapshot()
+            time.sleep(self.flush_interval)
+
+    @staticmethod
+    def _merge_hosts(merged, hosts, counters_only=False):
+        for host, host_metrics in hosts.items():
+            target = merged.setdefault(host, _new_host_metrics())
+            for key in ('requests', 'errors', 'bytes', 'lines') + (() if counters_only else ('active',)):
+                target[key] += host_metrics.get(key, 0)
+            for rule_name, hits in host_metrics.get('rule_hits', {}).items():
+                target['rule_hits'][rule_name] = target['rule_hits'].get(rule_name, 0) + hits
+            for key in ('ttfb', 'download'):
+                histogram = host_metrics.get(key)
+                if histogram and len(histogram['buckets']) == len(target[key]['buckets']):
+                    target[key]['buckets'] = [a + b for a, b in zip(target[key]['buckets'], histogram['buckets'])]
+                    target[key]['sum'] += histogram['sum']
+                    target[key]['count'] += histogram['count']
+        return merged
+
+    def _read_hosts(self, path):
+        try:
+            with open(path) as f:
+                return json.load(f)['hosts']
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _retire(self, path):
+        """Aggiunge ai totali dei worker terminati lo snapshot finale di un worker."""
+        # Il rename è atomico: un solo processo acquisisce lo snapshot anche con più /metrics in parallelo
+        claimed = f"{path}.{os.getpid()}.retiring"
+        try:
+            os.rename(path, claimed)
+        except OSError:
+            return
+        hosts = self._read_hosts(claimed)
+        retired_path = os.path.join(self.directory, self.RETIRED_FILE)
+        try:
+            with open(os.path.join(self.directory, 'retired.lock'), 'a') as lock_file:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                if hosts:
+                    retired = self._merge_hosts(self._read_hosts(retired_path) or {}, hosts, counters_only=True)
+                    fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+                    with os.fdopen(fd, 'w') as f:
+                        json.dump({'hosts': retired}, f)
+                    os.replace(tmp_path, retired_path)
+            os.remove(claimed)
+        except OSError as e:
+            log_sampled('metrics_retire_error', logging.WARNING, "⚠️ Impossibile accumulare le metriche di un worker terminato: %s", e)
+
+    def aggregate(self):
+        """Somma lo snapshot di questo worker a quelli degli altri worker vivi e ai totali di quelli terminati."""
+        merged = {}
+        snapshots = [self.snapshot()]
+        retired = None
+        if self.directory:
+            self.write_snapshot()
+            try:
+                names = os.listdir(self.directory)
+            except OSError:
+                names = []
+            for name in names:
+                process_id = name[:-5]
+                pid, _, started = process_id.partition('-')
+                if not name.endswith('.json') or not pid.isdigit() or process_id == self._process_id:
+                    continue
+                path = os.path.join(self.directory, name)
+                if _process_start_id(int(pid)) != process_id:
+                    # Worker terminato (o riavviato da gunicorn, anche con lo stesso pid)
+                    self._retire(path)
+                    continue
+                hosts = self._read_hosts(path)
+                if hosts is not None:
+                    snapshots.append(hosts)
+            retired = self._read_hosts(os.path.join(self.directory, self.RETIRED_FILE))
+        for hosts in snapshots:
+            self._merge_hosts(merged, hosts)
+        if retired:
+            self._merge_hosts(merged, retired, counters_only=True)
+        return merged, len(snapshots)
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def _process_start_id(pid):
+    """
+    Identificativo 'pid-avvio' di un processo in esecuzione (avvio in tick dal
+    boot, da /proc), o None se il processo non esiste. Senza /proc vale solo il pid.
+    """
+    try:
+        with open(f'/proc/{pid}/stat', 'rb') as f:
+            stat = f.read()
+        # Il campo 2 (nome) può contenere spazi: i campi successivi partono dopo l'ultima ')'
+        return f"{pid}-{int(stat[stat.rindex(b')') + 2:].split()[19])}"
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, IndexError):
+        return f"{pid}-0" if _pid_alive(pid) else None
+
+def _prometheus_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def render_prometheus_metrics(hosts, workers):
+    """Formato di esposizione testuale di Prometheus (version 0.0.4)."""
+    lines = [
+        '# HELP m3u_proxy_workers Worker con uno snapshot delle metriche.',
+        '# TYPE m3u_proxy_workers gauge',
+        f'm3u_proxy_workers {workers}',
+    ]
+    simple_metrics = (
+        ('requests', 'm3u_proxy_upstream_requests_total', 'counter', 'Download di playlist avviati.'),
+        ('errors', 'm3u_proxy_upstream_errors_total', 'counter', 'Download di playlist falliti.'),
+        ('bytes', 'm3u_proxy_upstream_bytes_total', 'counter', 'Byte (decompressi) letti dagli upstream.'),
+        ('lines', 'm3u_proxy_upstream_lines_total', 'counter', 'Linee lette dagli upstream.'),
+        ('active', 'm3u_proxy_upstream_active_streams', 'gauge', 'Download in corso.'),
+    )
+    for key, name, metric_type, help_text in simple_metrics:
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {metric_type}')
+        for host, host_metrics in sorted(hosts.items()):
+            lines.append(f'{name}{{host="{_prometheus_label(host)}"}} {host_metrics[key]}')
+
+    lines.append('# HELP m3u_proxy_upstream_rule_hits_total Link riscritti per regola.')
+    lines.append('# TYPE m3u_proxy_upstream_rule_hits_total counter')
+    for host, host_metrics in sorted(hosts.items()):
+        for rule_name, hits in sorted(host_metrics['rule_hits'].items()):
+            lines.append(f'm3u_proxy_upstream_rule_hits_total{{host="{_prometheus_label(host)}",rule="{_prometheus_label(rule_name)}"}} {hits}')
+
+    histograms = (
+        ('ttfb', 'm3u_proxy_upstream_ttfb_seconds', TTFB_BUCKETS, 'Tempo al primo byte della playlist upstream.'),
+        ('download', 'm3u_proxy_upstream_download_seconds', DOWNLOAD_BUCKETS, 'Durata dei download completati.'),
+    )
+    for key, name, bounds, help_text in histograms:
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} histogram')
+        for host, host_metrics in sorted(hosts.items()):
+            label = f'host="{_prometheus_label(host)}"'
+            histogram = host_metrics[key]
+            cumulative = 0
+            for bound, count in zip(bounds, histogram['buckets']):
+                cumulative += count
+                lines.append(f'{name}_bucket{{{label},le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_bucket{{{label},le="+Inf"}} {histogram["count"]}')
+            lines.append(f'{name}_sum{{{label}}} {histogram["sum"]:.6f}')
+            lines.append(f'{name}_count{{{label}}} {histogram["count"]}')
+    return '\n'.join(lines) + '\n'
+
+upstream_metrics = None
+if METRICS_ENABLED:
+    upstream_metrics = UpstreamMetrics(METRICS_DIR, METRICS_FLUSH_INTERVAL, METRICS_MAX_HOSTS)
+    os.register_at_fork(after_in_child=upstream_metrics.reset_after_fork)
+
+def _metrics_host(url):
+    try:
+        return (urllib.parse.urlsplit(url).hostname or 'unknown').lower()
+    except ValueError:
+        return 'unknown'
+
+def create_playlist_rewriter(base_url, api_password, options=None, deduplicator=None):
+    """Motore di riscrittura per una playlist: con il pool (ShardedChunkRewriter) se abilitato e senza dedup."""
+    if SHARDED_REWRITE_THRESHOLD > 0 and deduplicator is None:
+        return ShardedChunkRewriter(base_url, api_password, options)
+    return M3UChunkRewriter(
+        base_url, api_password, entry_filter=EntryFilter.from_options(options), deduplicator=deduplicator
+    )
+
+def open_playlist_segment(base_url, api_password, playlist_url, timing=None, deadline=None, options=None, deduplicator=None):
+    """
+    Avvia download e riscrittura (streaming) di una singola playlist.
+    Restituisce l'iteratore dei blocchi riscritti (bytes). Se indicato, timing
+    riceve i secondi spesi nelle fasi connect, ttfb, download e rewrite;
+    options sono le opzioni della definizione (filtri dei canali) e
+    deduplicator (EntryDeduplicator) è condiviso tra le playlist della richiesta.
+    """
+    rewriter = create_playlist_rewriter(base_url, api_password, options, deduplicator)
+    if upstream_metrics is None and timing is None:
+        return rewrite_m3u_chunks(download_m3u_playlist_chunks(playlist_url, deadline=deadline), base_url, api_password, rewriter)
+    return _instrumented_playlist_segment(playlist_url, timing, deadline, rewriter)
+
+class PlaylistSegmentMeter:
+    """
+    Misure del download di una playlist (byte, linee, attesa dell'upstream,
+    TTFB) per i tempi per fase e le metriche per host, usate sia da
+    open_playlist_segment sia dalla versione asincrona.
+    """
+
+    def __init__(self, playlist_url, timing=None):
+        self.host = _metrics_host(playlist_url)
+        self.timing = timing
+        self.fetch_timing = {} if timing is None else timing # Riceve connect da fetch_upstream_chunks
+        self.started_at = time.monotonic()
+        self.bytes = self.lines = 0
+        self.upstream_time = 0.0
+        self.finished_at = None
+        if upstream_metrics is not None:
+            upstream_metrics.stream_started(self.host)
+
+    def received(self, chunk, wait_started):
+        """Registra un blocco dell'upstream (None a fine corpo) atteso da wait_started."""
+        now = time.monotonic()
+        self.upstream_time += now - wait_started
+        if chunk is None:
+            self.finished_at = now
+            return
+        if not self.bytes:
+            ttfb = now - self.started_at
+            self.fetch_timing['ttfb'] = ttfb - self.fetch_timing.get('connect', 0.0)
+            if upstream_metrics is not None:
+                upstream_metrics.first_byte(self.host, ttfb)
+        self.bytes += len(chunk)
+        self.lines += chunk.count(b'\n')
+
+    def finish(self, rewrite_time, rule_hits, failed):
+        if self.timing is not None:
+            self.timing['download'] = max(0.0, self.upstream_time - self.timing.get('connect', 0.0) - self.timing.get('ttfb', 0.0))
+            self.timing['rewrite'] = rewrite_time
+        if upstream_metrics is not None:
+            # Un client che si disconnette non è un errore, ma il download non è completo
+            duration = self.finished_at - self.started_at if self.finished_at is not None else None
+            upstream_metrics.stream_finished(self.host, duration, self.bytes, self.lines, rule_hits, failed)
+
+def _instrumented_playlist_segment(playlist_url, timing, deadline, rewriter):
+    meter = PlaylistSegmentMeter(playlist_url, timing)
+
+    def measured_chunks():
+        upstream = download_m3u_playlist_chunks(playlist_url, meter.fetch_timing, deadline)
+        try:
+            while True:
+                wait_started = time.monotonic()
+                chunk = next(upstream, None)
+                meter.received(chunk, wait_started)
+                if chunk is None:
+                    break
+                yield chunk
+        finally:
+            upstream.close()
+
+    failed = False
+    segment_time = 0.0
+    rewritten = rewrite_m3u_chunks(measured_chunks(), None, None, rewriter=rewriter)
+    try:
+        while True:
+            step_started = time.monotonic()
+            chunk = next(rewritten, None)
+            segment_time += time.monotonic() - step_started
+            if chunk is None:
+                break
+            yield chunk
+    except Exception:
+        failed = True
+        raise
+    finally:
+        rewritten.close()
+        # Il tempo nel generatore di riscrittura, meno l'attesa dell'upstream
+        meter.finish(max(0.0, segment_time - meter.upstream_time), rewriter.rules.hits, failed)
+
+_PREFETCH_DONE = object() # Sentinella: la playlist è stata letta completamente
+
+class PlaylistPrefetcher:
+    """
+    Scarica e riscrive in parallelo le playlist di una richiesta /proxy.
+    Ogni playlist ha un buffer limitato (read-ahead): quando è pieno il download
+    si sospende finché il consumatore non lo svuota, quindi la memoria resta
+    limitata anche con playlist enormi.
+    """
+
+    def __init__(self, segments, max_workers=None, buffer_bytes=None, timings=None, deadline=None):
+        # segments: {definition_idx: (base_url, api_password, playlist_url, opzioni)}
+        # timings (opzionale): {definition_idx: dict dei tempi per fase}
+        timings = timings or {}
+        self._deadline = deadline
+        max_workers = max_workers or PARALLEL_DOWNLOADS_WORKERS
+        buffer_bytes = buffer_bytes or PARALLEL_DOWNLOADS_BUFFER_BYTES
+        max_chunks = max(1, buffer_bytes // UPSTREAM_CHUNK_SIZE)
+
+        self._stop_event = threading.Event()
+        self._buffers = {}
+        self._executor = ThreadPoolExecutor(
+            max_workers=max(1, min(max_workers, len(segments))),
+            thread_name_prefix='m3u-prefetch'
+        )
+        # Le playlist vengono sottomesse in ordine: con un pool limitato le prime
+        # partono subito e sono anche le prime ad essere consumate.
+        for definition_idx, segment in segments.items():
+            buffer = queue.Queue(maxsize=max_chunks)
+            self._buffers[definition_idx] = buffer
+            self._executor.submit(self._produce, buffer, *segment, timings.get(definition_idx))
+
+    def _put(self, buffer, item):
+        # Attende spazio nel buffer, ma rinuncia se la richiesta è stata chiusa
+        while not self._stop_event.is_set():
+            try:
+                buffer.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _produce(self, buffer, base_url, api_password, playlist_url, options, timing=None):
+        if self._stop_event.is_set():
+            return
+        chunks_iter = None
+        try:
+            chunks_iter = open_playlist_segment(base_url, api_password, playlist_url, timing, self._deadline, options)
+            for chunk in chunks_iter:
+                if not self._put(buffer, chunk):
+                    return
+            self._put(buffer, _PREFETCH_DONE)
+        except Exception as e:
+            # I blocchi già letti sono nel buffer: l'errore viene gestito dal consumatore
+            self._put(buffer, e)
+        finally:
+            if chunks_iter is not None:
+                chunks_iter.close()
+
+    def chunks(self, definition_idx):
+        """Restituisce, in ordine, i blocchi riscritti della playlist indicata."""
+        buffer = self._buffers[definition_idx]
+        while True:
+            item = buffer.get()
+            if item is _PREFETCH_DONE:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def close(self):
+        """Interrompe i download ancora in corso (es. client disconnesso)."""
+        self._stop_event.set()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+def _strip_extm3u_header(chunk):
+    # Rimuove l'header #EXTM3U se è la prima linea del blocco (playlist successive alla prima)
+    if not chunk.lstrip().startswith(b'#EXTM3U'):
+        return chunk
+    newline = chunk.find(b'\n')
+    return b'' if newline == -1 else chunk[newline + 1:]
+
+TIMING_PHASES = ('parse', 'connect', 'ttfb', 'download', 'rewrite', 'write')
+
+class RequestTrace:
+    """
+    Tempi per fase di una richiesta /proxy, per ogni definizione: parsing
+    delle credenziali, connessione, TTFB upstream, download, riscrittura e
+    scrittura verso il client (tempo in cui il generatore resta sospeso).
+    """
+
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.definitions = {} # definition_idx -> {'host': ..., fase: secondi}
+        self.cache_status = None
+        self.write = 0.0 # Scrittura verso il client misurata fuori dal generatore (coalescenza)
+
+    def timing_for(self, definition_idx, playlist_url=None):
+        timing = self.definitions.get(definition_idx)
+        if timing is None:
+            timing = self.definitions[definition_idx] = {'host': _metrics_host(playlist_url) if playlist_url else None}
+        return timing
+
+    def add(self, definition_idx, phase, seconds):
+        timing = self.timing_for(definition_idx)
+        timing[phase] = timing.get(phase, 0.0) + seconds
+
+    def phase_totals(self, wall_clock=False):
+        """
+        Secondi per fase, sommati su tutte le definizioni. Con wall_clock i
+        tempi delle definizioni eseguite in parallelo (che si sovrappongono)
+        sono riportati al tempo reale trascorso: ogni fase riceve la sua quota
+        e la somma delle fasi non supera la durata della richiesta.
+        """
+        totals = dict.fromkeys(TIMING_PHASES, 0.0)
+        for timing in self.definitions.values():
+            for phase in TIMING_PHASES:
+                totals[phase] += timing.get(phase, 0.0)
+        totals['write'] += self.write
+        if wall_clock:
+            busy = sum(totals.values())
+            elapsed = time.monotonic() - self.started_at
+            if busy > elapsed > 0:
+                totals = {phase: seconds * elapsed / busy for phase, seconds in totals.items()}
+        return totals
+
+    def server_timing_header(self):
+        """Header Server-Timing (durate in ms, tempo reale) con le fasi concluse finora."""
+        entries = [f'{phase};dur={seconds * 1000:.1f}' for phase, seconds in self.phase_totals(wall_clock=True).items() if seconds]
+        if self.cache_status:
+            entries.append(f'cache;desc="{self.cache_status}"')
+        entries.append(f'total;dur={(time.monotonic() - self.started_at) * 1000:.1f}')
+        return ', '.join(entries)
+
+    def comment_lines(self):
+        """Riepilogo da accodare al playlist: una linea '# TIMING' per definizione più il totale."""
+        lines = []
+        for definition_idx, timing in sorted(self.definitions.items()):
+            phases = ' '.join(f'{phase}={timing[phase] * 1000:.1f}ms' for phase in TIMING_PHASES if phase in timing)
+            lines.append(f"# TIMING [{definition_idx}] {timing.get('host') or '-'} {phases}\n")
+        cache = f" cache={self.cache_status}" if self.cache_status else ''
+        write = f" write={self.write * 1000:.1f}ms" if self.write else ''
+        lines.append(f"# TIMING total={(time.monotonic() - self.started_at) * 1000:.1f}ms{write}{cache}\n")
+        return ''.join(lines).encode('utf-8')
+
+class CombinedPlaylistMerge:
+    """
+    Stato dell'unione delle playlist di una richiesta, condiviso da
+    generate_combined_playlist e dalla versione asincrona: opzioni della
+    richiesta, definizioni analizzate, un solo header #EXTM3U, contatori e
+    marcatori '# SKIPPED' / '# ERROR' / '# DEDUP'.
+    """
+
+    LOG_INTERVAL_BYTES = 10 * 1024 * 1024 # Log every 10MB
+
+    def __init__(self, playlist_definitions, stats=None, trace=None):
+        self.playlist_definitions, request_options = split_request_options(playlist_definitions)
+        self.deduplicator, self.option_error = create_request_deduplicator(request_options)
+        self.stats = stats
+        self.started_at = time.monotonic()
+        self.deadline = self.started_at + PROXY_DEADLINE if PROXY_DEADLINE > 0 else None
+        self.total_bytes = 0
+        self.total_lines = 0
+        self.failed_playlists = 0
+        self.playlist_lines = 0 # Linee della playlist corrente
+        self._header_handled = False # Tracks if the main #EXTM3U header context is done
+        self._playlist_had_lines = False
+        self._last_log_milestone = 0
+
+        self.parsed_definitions = {}
+        self.timings = {}
+        for definition_idx, definition in enumerate(self.playlist_definitions):
+            if '&' in definition:
+                parse_started = time.monotonic()
+                parsed = self.parsed_definitions[definition_idx] = parse_playlist_definition(definition)
+                if trace is not None:
+                    self.timings[definition_idx] = trace.timing_for(definition_idx, parsed[2])
+                    trace.add(definition_idx, 'parse', time.monotonic() - parse_started)
+
+    def skipped(self, definition_idx, definition):
+        logger.warning("[%s] Skipping invalid playlist definition (manca '&'): %s", definition_idx, definition)
+        return f"# SKIPPED Invalid Definition: {definition}\n".encode('utf-8')
+
+    def start_playlist(self):
+        self._playlist_had_lines = False
+        self.playlist_lines = 0
+
+    def accept(self, definition_idx, chunk):
+        """Blocco riscritto da inviare (b'' se vuoto): #EXTM3U resta solo nella prima playlist con contenuto."""
+        if not self._playlist_had_lines:
+            self._playlist_had_lines = True
+            if self._header_handled:
+                # Skip #EXTM3U if it's the first line of a subsequent segment
+                chunk = _strip_extm3u_header(chunk)
+        self.playlist_lines += chunk.count(b'\n')
+        self.total_bytes += len(chunk)
+        if self.total_bytes // self.LOG_INTERVAL_BYTES > self._last_log_milestone:
+            self._last_log_milestone = self.total_bytes // self.LOG_INTERVAL_BYTES
+            logger.info("ℹ️ [%s] Total data yielded: %.2f MB. Current playlist lines: %s", definition_idx, self.total_bytes / (1024 * 1024), self.playlist_lines)
+        return chunk
+
+    def failed(self, definition_idx, playlist_url, error):
+        logger.error("💥 [%s] Error processing playlist %s (after ~%s lines yielded for it): %s", definition_idx, playlist_url, self.playlist_lines, error)
+        self.failed_playlists += 1
+        if self.stats is not None:
+            self.stats['errors'] = self.stats.get('errors', 0) + 1
+        return f"# ERROR processing playlist {playlist_url}: {str(error)}\n".encode('utf-8')
+
+    def finish_playlist(self, definition_idx, playlist_url):
+        logger.info("✅ [%s] Finished processing playlist %s. Lines processed in this segment: %s", definition_idx, playlist_url, self.playlist_lines)
+        self.total_lines += self.playlist_lines
+        if self._playlist_had_lines:
+            # The first playlist with content provides the main header (if any):
+            # subsequent playlists skip their #EXTM3U.
+            self._header_handled = True
+
+    def trailer(self):
+        """Marcatori finali: opzione della richiesta non valida e riepilogo della deduplicazione."""
+        if self.option_error is not None:
+            yield self.option_error
+        if self.deduplicator is not None:
+            if self.stats is not None:
+                self.stats['duplicates'] = self.deduplicator.removed
+            yield dedup_summary_line(self.deduplicator)
+        logger.info("🏁 Playlist combinata completata: %s definizioni, %s in errore, "
+                    "%s linee, %.2f MB in %.2fs",
+                    len(self.playlist_definitions), self.failed_playlists, self.total_lines, self.total_bytes / (1024 * 1024), time.monotonic() - self.started_at)
+
+def generate_combined_playlist(playlist_definitions, stats=None, trace=None, parallel=None):
+    """
+    Unisce in streaming le playlist definite in playlist_definitions, mantenendo
+    l'ordine delle definizioni e un solo header #EXTM3U. Restituisce blocchi di byte.
+    Con PARALLEL_DOWNLOADS attivo (o parallel=True) tutti i download partono subito.
+    Tutte le definizioni condividono il tempo massimo PROXY_DEADLINE: quelle che
+    non rientrano terminano con il marcatore '# ERROR processing playlist'.
+    Con l'opzione 'dedup=url|tvg_id' i canali duplicati tra tutte le playlist
+    vengono rimossi (il primo vince, quindi i download restano sequenziali).
+    Se indicato, stats['errors'] conta le playlist fallite e trace (RequestTrace)
+    riceve i tempi per fase di ogni definizione.
+    """
+    merge = CombinedPlaylistMerge(playlist_definitions, stats, trace)
+    parsed_definitions = merge.parsed_definitions
+
+    if parallel is None:
+        parallel = PARALLEL_DOWNLOADS
+    if merge.deduplicator is not None and parallel:
+        # L'ordine delle definizioni decide quale copia resta: niente riscrittura in parallelo
+        logger.info("🧹 Deduplicazione attiva: download sequenziali")
+        parallel = False
+    prefetcher = None
+    if parallel and len(parsed_definitions) > 1:
+        logger.info("⚡ Download paralleli attivi per %s playlist (max %s contemporanei)", len(parsed_definitions), PARALLEL_DOWNLOADS_WORKERS)
+        prefetcher = PlaylistPrefetcher(parsed_definitions, timings=merge.timings, deadline=merge.deadline)
+
+    try:
+        for definition_idx, definition in enumerate(merge.playlist_definitions):
+            if definition_idx not in parsed_definitions:
+                yield merge.skipped(definition_idx, definition)
+                continue
+
+            base_url_part, api_password, playlist_url_str, options = parsed_definitions[definition_idx]
+
+            if api_password is not None:
+                logger.info("[%s] Base URL: %s, Password: %s", definition_idx, base_url_part, '*' * len(api_password))
+            else:
+                # Nessuna password fornita (o la parte dopo ':' era una porta/scheme)
+                logger.info("[%s] Base URL: %s, Modalità senza password.", definition_idx, base_url_part)
+
+            logger.info("[%s] Processing Playlist (streaming): %s", definition_idx, playlist_url_str)
+
+            merge.start_playlist()
+            try:
+                if prefetcher is not None:
+                    rewritten_chunks_iter = prefetcher.chunks(definition_idx)
+                else:
+                    rewritten_chunks_iter = open_playlist_segment(
+                        base_url_part, api_password, playlist_url_str, merge.timings.get(definition_idx), merge.deadline, options, merge.deduplicator
+                    )
+                logger.debug("[%s] Download stream initiated for %s", definition_idx, playlist_url_str)
+
+                for chunk in rewritten_chunks_iter:
+                    chunk = merge.accept(definition_idx, chunk)
+                    if not chunk:
+                        continue
+                    if trace is None:
+                        yield chunk
+                    else:
+                        write_started = time.monotonic()
+                        yield chunk
+                        trace.add(definition_idx, 'write', time.monotonic() - write_started)
+
+            except Exception as e:
+                yield merge.failed(definition_idx, playlist_url_str, e)
+
+            merge.finish_playlist(definition_idx, playlist_url_str)
+
+        yield from merge.trailer()
+    finally:
+        if prefetcher is not None:
+            prefetcher.close()
+
+def admitted_combined_playlist(playlist_definitions, stats=None, trace=None, slot=None):
+    """
+    generate_combined_playlist per le generazioni fuori da una richiesta /proxy
+    (flight condivise, refresher, dataset dei canali): occupa un posto di
+    merge_admission come le richieste, attendendo in coda se necessario
+    (AdmissionRejected se il worker resta saturo). slot è l'AdmissionSlot già
+    ottenuto dalla richiesta che avvia la generazione, tenuto fino alla fine.
+    """
+    if slot is not None:
+        slot.retain()
+    elif merge_admission is not None:
+        merge_admission.acquire()
+        slot = AdmissionSlot(merge_admission)
+    try:
+        yield from generate_combined_playlist(playlist_definitions, stats=stats, trace=trace)
+    finally:
+        if slot is not None:
+            slot.release()
+
+class MergedPlaylistFlight:
+    """
+    Una singola generazione del playlist combinato, eseguita in background e
+    condivisa da tutti i client che chiedono la stessa query string: ognuno
+    legge i blocchi già prodotti e attende i successivi. Oltre
+    MERGED_FLIGHT_MEMORY_BYTES i blocchi passano in un file temporaneo, letto
+    dai client per posizione (os.pread).
+    """
+
+    def __init__(self, key, playlist_definitions, on_finished=None, slot=None):
+        self.key = key
+        self.chunks = []
+        self._chunk_ends = [] # Offset di fine di ogni blocco in memoria
+        self._file = None
+        self.size = 0
+        self.stats = {'errors': 0}
+        self.trace = RequestTrace() if REQUEST_TIMING else None
+        self.done = False
+        self.error = None
+        self.completed_at = None
+        self._on_finished = on_finished
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(
+            target=self._run, args=(playlist_definitions, slot), name='m3u-flight', daemon=True
+        )
+        self._thread.start()
+
+    def _publish(self, chunk):
+        with self._condition:
+            if self._file is None and self.size + len(chunk) > MERGED_FLIGHT_MEMORY_BYTES:
+                self._spill()
+            if self._file is not None:
+                self._file.write(chunk)
+                self._file.flush() # Visibile subito ai lettori (pread)
+            else:
+                self.chunks.append(chunk)
+                self._chunk_ends.append(self.size + len(chunk))
+            self.size += len(chunk)
+            self._condition.notify_all()
+
+    def _spill(self):
+        # Chiamato con il lock: i blocchi già prodotti passano nel file temporaneo
+        self._file = tempfile.TemporaryFile()
+        for chunk in self.chunks:
+            self._file.write(chunk)
+        self.chunks = []
+        self._chunk_ends = []
+        logger.info("💾 Generazione condivisa oltre %s byte, prosegue su file temporaneo: %s", MERGED_FLIGHT_MEMORY_BYTES, self.key[:100])
+
+    def _run(self, playlist_definitions, slot):
+        try:
+            for chunk in admitted_combined_playlist(playlist_definitions, stats=self.stats, trace=self.trace, slot=slot):
+                self._publish(chunk)
+        except Exception as e:
+            logger.error("💥 Errore nella generazione condivisa di %s: %s", self.key[:100], e)
+            self.error = e
+        finally:
+            with self._condition:
+                self.done = True
+                self.completed_at = time.time()
+                self._condition.notify_all()
+            if self._on_finished is not None:
+                self._on_finished(self)
+
+    def is_cacheable(self):
+        # Un risultato con playlist in errore non va riproposto agli altri client
+        return self.error is None and self.stats['errors'] == 0
+
+    def iter_chunks(self):
+        """Restituisce tutti i blocchi dall'inizio, attendendo quelli non ancora prodotti."""
+        position = 0 # Byte già restituiti
+        while True:
+            with self._condition:
+                while position >= self.size and not self.done:
+                    self._condition.wait()
+                end = self.size
+                finished = self.done
+                spilled = self._file
+                if spilled is None:
+                    new_chunks = self.chunks[bisect.bisect_right(self._chunk_ends, position):]
+            if spilled is None:
+                for chunk in new_chunks:
+                    position += len(chunk)
+                    yield chunk
+            else:
+                while position < end:
+                    chunk = os.pread(spilled.fileno(), min(end - position, UPSTREAM_CHUNK_SIZE), position)
+                    position += len(chunk)
+                    yield chunk
+            if finished and position >= end:
+                return
+
+class MergedPlaylistCache:
+    """
+    Coalescenza (single-flight) e stale-while-revalidate per /proxy.
+    Richieste identiche e contemporanee condividono un'unica generazione; un
+    risultato completato resta valido per fresh_ttl secondi e, per altri
+    stale_ttl secondi, viene servito subito mentre si rigenera in background.
+    """
+
+    def __init__(self, fresh_ttl, stale_ttl, max_bytes):
+        self.fresh_ttl = fresh_ttl
+        self.stale_ttl = stale_ttl
+        self.max_bytes = max_bytes
+        self._flights = {} # Generazioni in corso, per query string
+        self._completed = OrderedDict() # Risultati completati (LRU)
+        self._completed_bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, playlist_definitions, slot=None):
+        """
+        Restituisce (generazione che serve la richiesta, stato cache) per la
+        query string indicata. Una nuova generazione (MISS o rigenerazione in
+        background per STALE) tiene fino alla fine slot, il posto della richiesta.
+        """
+        with self._lock:
+            self._purge_expired()
+            completed = self._completed.get(key)
+            inflight = self._flights.get(key)
+            if completed is not None:
+                age = time.time() - completed.completed_at
+                if age < self.fresh_ttl:
+                    self._completed.move_to_end(key)
+                    return completed, 'HIT'
+                if age < self.fresh_ttl + self.stale_ttl:
+                    self._completed.move_to_end(key)
+                    if inflight is None:
+                        logger.info("🔄 Rigenerazione in background (stale-while-revalidate): %s", key[:100])
+                        self._start_flight(key, playlist_definitions, slot)
+                    return completed, 'STALE'
+            if inflight is not None:
+                logger.info("🤝 Richiesta unita alla generazione in corso: %s", key[:100])
+                return inflight, 'COALESCED'
+            return self._start_flight(key, playlist_definitions, slot), 'MISS'
+
+    def _purge_expired(self):
+        # Chiamato con il lock: risultati oltre fresh_ttl + stale_ttl non più servibili
+        now = time.time()
+        expired = [key for key, flight in self._completed.items() if now - flight.completed_at >= self.fresh_ttl + self.stale_ttl]
+        for key in expired:
+            self._completed_bytes -= self._completed.pop(key).size
+
+    def _start_flight(self, key, playlist_definitions, slot=None):
+        flight = MergedPlaylistFlight(key, playlist_definitions, on_finished=self._flight_finished, slot=slot)
+        self._flights[key] = flight
+        return flight
+
+    def _flight_finished(self, flight):
+        with self._lock:
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+            self._purge_expired()
+            if not flight.is_cacheable() or flight.size > self.max_bytes or self.fresh_ttl + self.stale_ttl <= 0:
+                return
+            previous = self._completed.pop(flight.key, None)
+            if previous is not None:
+                self._completed_bytes -= previous.size
+            self._completed[flight.key] = flight
+            self._completed_bytes += flight.size
+            while self._completed_bytes > self.max_bytes and self._completed:
+                _, evicted = self._completed.popitem(last=False)
+                self._completed_bytes -= evicted.size
+
+merged_playlists = None
+if PROXY_COALESCING:
+    merged_playlists = MergedPlaylistCache(MERGED_CACHE_TTL, MERGED_CACHE_STALE_TTL, MERGED_CACHE_MAX_BYTES)
+
+class SpooledPlaylist:
+    """
+    Playlist combinato su disco: il file è nominato con lo SHA-256 del
+    contenuto, l'ETag deriva dal tag assegnato alla generazione (già inviato
+    nella risposta che ha prodotto il file, così i client possono riprendere
+    il download con If-Range).
+    """
+
+    __slots__ = ('key', 'digest', 'size', 'created', 'path', 'tag')
+
+    def __init__(self, key, digest, size, created, path, tag=None):
+        self.key = key
+        self.digest = digest
+        self.size = size
+        self.created = created
+        self.path = path
+        self.tag = tag or digest[:32]
+
+    def etag(self, encoding=None):
+        return self.tag + ('-' + encoding if encoding else '')
+
+def spool_stream_etag(tag, encoding=None):
+    """
+    ETag (tra virgolette) della risposta /proxy generata mentre viene scritta
+    nello spool. Senza compressione coincide con quello del file in spool; le
+    varianti compresse in streaming non sono identiche byte per byte a quelle
+    dello spool e hanno un ETag proprio (un If-Range porta a una risposta completa).
+    """
+    return f'"{tag}"' if encoding is None else f'"{tag}-{encoding}-stream"'
+
+class MergedPlaylistSpool:
+    """
+    Spool su disco dell'output di /proxy, condiviso tra i worker. Mentre il
+    playlist viene inviato al client, una copia è scritta in un file nominato
+    con l'hash del contenuto (stesso contenuto, stesso file ed ETag); un
+    indice per query string punta all'ultimo file completato. Per ttl secondi
+    le richieste con la stessa query string sono servite dal file (Range,
+    ETag/304, sendfile) senza rigenerare il playlist. Se il client si
+    disconnette la generazione prosegue in background, così chi riprende il
+    download trova il file completo.
+    """
+
+    def __init__(self, directory, ttl, max_bytes=0):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._index_dir = os.path.join(directory, 'index')
+        self._recording = set() # Query string in scrittura in questo worker
+        self._lock = threading.Lock()
+        self.counters = {'hits': 0, 'misses': 0, 'stored': 0, 'discarded': 0}
+        os.makedirs(self._index_dir, exist_ok=True)
+
+    def _index_path(self, key):
+        return os.path.join(self._index_dir, hashlib.sha256(key.encode('utf-8')).hexdigest() + '.json')
+
+    def blob_path(self, digest):
+        return os.path.join(self.directory, digest + '.m3u')
+
+    def count(self, counter):
+        with self._lock:
+            self.counters[counter] += 1
+
+    def read_meta(self, key):
+        """Voce dell'indice per la query string (anche scaduta), o None."""
+        try:
+            with open(self._index_path(key), 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return meta if meta.get('key') == key else None
+
+    def write_meta(self, meta):
+        with tempfile.NamedTemporaryFile('w', dir=self.directory, prefix='.tmp-', suffix='.json', delete=False, encoding='utf-8') as f:
+            json.dump(meta, f)
+        os.replace(f.name, self._index_path(meta['key']))
+
+    def lookup(self, key):
+        """Restituisce il SpooledPlaylist ancora valido per la query string, o None."""
+        meta = self.read_meta(key)
+        # 'expires' è impostato dal refresher in background, altrimenti vale il ttl
+        if meta is None or time.time() >= meta.get('expires', meta.get('created', 0) + self.ttl):
+            self.count('misses')
+            return None
+        path = self.blob_path(meta['digest'])
+        if not os.path.exists(path): # Rimosso dal limite su disco
+            self.count('misses')
+            return None
+        self.count('hits')
+        return SpooledPlaylist(key, meta['digest'], meta.get('size', 0), meta['created'], path, meta.get('etag'))
+
+    def gzip_path(self, spooled):
+        """Variante gzip del file (creata alla prima richiesta che la accetta), o None se non disponibile."""
+        path = spooled.path + '.gz'
+        if os.path.exists(path):
+            return path
+        try:
+            with open(spooled.path, 'rb') as source, tempfile.NamedTemporaryFile(dir=self.directory, prefix='.tmp-', delete=False) as target:
+                compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+                for chunk in iter(lambda: source.read(UPSTREAM_CHUNK_SIZE), b''):
+                    target.write(compressor.compress(chunk))
+                target.write(compressor.flush())
+            os.replace(target.name, path) # Più worker possono crearla insieme: vince l'ultima, identica
+        except OSError as e:
+            logger.warning("⚠️ Variante gzip dello spool non disponibile (%s): %s", spooled.path, e)
+            return None
+        return path
+
+    @staticmethod
+    def new_tag():
+        """Tag di una nuova generazione (base dell'ETag del file che ne risulta)."""
+        return os.urandom(16).hex()
+
+    def writer(self, key, tag=None):
+        """Writer per la query string, o None se questo worker la sta già scrivendo."""
+        with self._lock:
+            if key in self._recording:
+                return None
+            self._recording.add(key)
+        try:
+            return MergedSpoolWriter(self, key, tag)
+        except OSError as e:
+            logger.warning("⚠️ Spool del playlist non disponibile: %s", e)
+            self._release(key)
+            return None
+
+    def _release(self, key):
+        with self._lock:
+            self._recording.discard(key)
+
+    def finish(self, writer, stats=None):
+        """Pubblica il file completato; un risultato con playlist in errore viene scartato."""
+        try:
+            if stats is not None and stats.get('errors'):
+                writer.discard()
+                self.count('discarded')
+                return
+            writer.commit()
+            self.count('stored')
+        except OSError as e:
+            logger.warning("⚠️ Errore nello spool del playlist: %s", e)
+            writer.discard()
+        finally:
+            self._release(writer.key)
+        if self.max_bytes:
+            self._prune()
+
+    def abort(self, writer):
+        writer.discard()
+        self._release(writer.key)
+
+    def _drain(self, writer, chunks, stats, slot=None):
+        try:
+            for chunk in chunks:
+                writer.write(chunk)
+        except Exception as e:
+            logger.warning("⚠️ Generazione in background per lo spool interrotta: %s", e)
+            self.abort(writer)
+            return
+        finally:
+            chunks.close()
+            if slot is not None:
+                slot.release()
+        logger.info("💾 Spool completato in background: %s", writer.key[:100])
+        self.finish(writer, stats)
+
+    def record(self, key, chunks, stats=None, slot=None, tag=None):
+        """
+        Inoltra i blocchi del playlist copiandoli nello spool. Se il client si
+        disconnette, i blocchi restanti vengono scritti da un thread in background,
+        che tiene occupato fino alla fine l'eventuale AdmissionSlot della generazione.
+        """
+        writer = self.writer(key, tag)
+        if writer is None:
+            yield from chunks
+            return
+        if slot is not None:
+            slot.retain()
+        detached = False
+        try:
+            for chunk in chunks:
+                writer.write(chunk)
+                yield chunk
+        except GeneratorExit:
+            threading.Thread(
+                target=self._drain, args=(writer, chunks, stats, slot), name='m3u-spool', daemon=True
+            ).start()
+            detached = True
+            raise
+        except BaseException:
+            self.abort(writer)
+            raise
+        finally:
+            if slot is not None and not detached:
+                slot.release()
+        self.finish(writer, stats)
+
+    def _prune(self):
+        # Elimina i file meno recenti oltre il limite su disco e gli indici scaduti
+        now = time.time()
+        try:
+            files = [os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                     if name.endswith('.m3u') or name.endswith('.m3u.gz')]
+            files = [(os.path.getmtime(path), os.path.getsize(path), path) for path in files]
+            index_files = [os.path.join(self._index_dir, name) for name in os.listdir(self._index_dir)]
+        except OSError:
+            return
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+        for path in index_files:
+            try:
+                if now - os.path.getmtime(path) < self.ttl:
+                    continue
+                with open(path, 'r', encoding='utf-8') as f:
+                    expires = json.load(f).get('expires', 0)
+                if now >= expires: # Le voci del refresher possono durare più del ttl
+                    os.remove(path)
+            except (OSError, ValueError):
+                pass
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats['recording'] = len(self._recording)
+        stats['directory'] = self.directory
+        return stats
+
+class MergedSpoolWriter:
+    """File temporaneo con l'hash del contenuto calcolato durante la scrittura."""
+
+    def __init__(self, spool, key, tag=None):
+        self.spool = spool
+        self.key = key
+        self.tag = tag or spool.new_tag()
+        self.size = 0
+        self.meta = {} # Campi aggiuntivi per l'indice (es. scadenza impostata dal refresher)
+        self._hash = hashlib.sha256()
+        self._file = tempfile.NamedTemporaryFile(dir=spool.directory, prefix='.tmp-', delete=False)
+
+    def write(self, chunk):
+        self.size += len(chunk)
+        self._hash.update(chunk)
+        self._file.write(chunk)
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+    def commit(self):
+        self._file.close()
+        digest = self._hash.hexdigest()
+        path = self.spool.blob_path(digest)
+        if os.path.exists(path):
+            os.remove(self._file.name) # Contenuto già presente (stesso hash)
+        else:
+            os.replace(self._file.name, path)
+        self._file = None
+        self.spool.write_meta({
+            **self.meta, 'key': self.key, 'digest': digest, 'etag': self.tag, 'size': self.size, 'created': time.time()
+        })
+        logger.info("💾 Playlist combinato salvato nello spool: %s (%.2f MB)", digest[:16], self.size / (1024 * 1024))
+        return digest
+
+    def discard(self):
+        if self._file is not None:
+            self._file.close()
+            try:
+                os.remove(self._file.name)
+            except OSError:
+                pass
+            self._file = None
+
+merged_spool = None
+if MERGED_SPOOL_DIR:
+    merged_spool = MergedPlaylistSpool(MERGED_SPOOL_DIR, MERGED_SPOOL_TTL, MERGED_SPOOL_MAX_BYTES)
+
+def spooled_playlist_variant(spooled, accept_encodings, ranged=False):
+    """
+    (file da inviare, encoding) per il playlist in spool: gzip se accettato,
+    altrimenti il file originale. Le richieste con Range ricevono sempre il
+    file originale: gli offset si riferiscono al contenuto non compresso.
+    """
+    if RESPONSE_COMPRESSION and not ranged and accept_encodings.quality('gzip') > 0:
+        gzip_path = merged_spool.gzip_path(spooled)
+        if gzip_path is not None:
+            return gzip_path, 'gzip'
+    return spooled.path, None
+
+class PlaylistRefresher:
+    """
+    Mantiene pronti nello spool i playlist combinati elencati nel registro
+    (file JSON: query string /proxy, oppure {"query": ..., "interval": secondi}).
+    Ogni voce viene controllata a intervalli con una variazione casuale
+    (jitter): il playlist combinato viene rigenerato (un download per
+    upstream) e pubblicato solo se l'hash del contenuto è cambiato (upstream o
+    regole di riscrittura); altrimenti si prolunga la validità della versione
+    in spool. Tra i worker gunicorn un solo processo fa da scheduler (lock su
+    file nello spool); gli altri servono i file già pronti.
+    """
+
+    LOCK_RETRY_SECONDS = 30 # Attesa tra i tentativi di diventare scheduler
+
+    def __init__(self, registry_path, spool, interval, jitter, concurrency):
+        self.registry_path = registry_path
+        self.spool = spool
+        self.interval = interval
+        self.jitter = jitter
+        self.concurrency = max(1, concurrency)
+        self.is_scheduler = False
+        self._entries = {} # query string -> stato della voce
+        self._mtime = None
+        self._lock = threading.Lock()
+        self._lock_file = None
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='m3u-refresher', daemon=True)
+        self._thread.start()
+
+    def reset_after_fork(self):
+        # Lo scheduler resta al processo padre (es. gunicorn --preload o i processi
+        # del pool di riscrittura): il figlio chiude solo la sua copia del lock
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+        self.is_scheduler = False
+        self._entries = {}
+        self._mtime = None
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def _acquire_scheduler_lock(self):
+        if fcntl is None:
+            return True
+        lock_file = open(os.path.join(self.spool.directory, 'refresher.lock'), 'a')
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        return True
+
+    def _next_run(self, interval):
+        return time.time() + interval * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def _load_registry(self):
+        try:
+            mtime = os.path.getmtime(self.registry_path)
+        except OSError as e:
+            if self._mtime is not False:
+                logger.warning("⚠️ Registro del refresher non accessibile (%s): %s", self.registry_path, e)
+                self._mtime = False
+            return
+        if mtime == self._mtime:
+            return
+        self._mtime = mtime
+        try:
+            with open(self.registry_path, 'r', encoding='utf-8') as f:
+                items = json.load(f)
+            registry = {}
+            for item in items:
+                if isinstance(item, str):
+                    item = {'query': item}
+                query = item['query'].strip()
+                if query:
+                    registry[query] = float(item.get('interval', self.interval))
+        except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+            logger.warning("⚠️ Registro del refresher non valido (%s), resta attivo il precedente: %s", self.registry_path, e)
+            return
+        with self._lock:
+            entries = {}
+            for query, interval in registry.items():
+                entry = self._entries.get(query)
+                if entry is None:
+                    # Prima esecuzione sparsa nella finestra di jitter
+                    entry = {'interval': interval, 'next_run': time.time() + random.uniform(0, interval * self.jitter),
+                             'running': False, 'checks': 0, 'builds': 0, 'failures': 0, 'last_check': None, 'last_error': None}
+                entry['interval'] = interval
+                entries[query] = entry
+            self._entries = entries
+        logger.info("🗓️ Registro del refresher caricato: %s playlist combinati", len(registry))
+
+    def _run(self):
+        while not self._acquire_scheduler_lock():
+            time.sleep(self.LOCK_RETRY_SECONDS)
+        self.is_scheduler = True
+        logger.info("🗓️ Refresher attivo in questo processo (registro: %s)", self.registry_path)
+        executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='m3u-refresh')
+        while True:
+            self._load_registry()
+            now = time.time()
+            with self._lock:
+                due = [(query, entry) for query, entry in self._entries.items() if not entry['running'] and entry['next_run'] <= now]
+                for _, entry in due:
+                    entry['running'] = True
+            for query, entry in due:
+                executor.submit(self._refresh, query, entry)
+            time.sleep(1)
+
+    def _refresh(self, query, entry):
+        built = False
+        error = None
+        try:
+            # Validità oltre il prossimo controllo: se lo scheduler si ferma, la voce scade
+            expires = time.time() + max(self.spool.ttl, 2 * entry['interval'])
+            built = self._rebuild(query, expires)
+        except Exception as e:
+            error = str(e)
+            logger.warning("⚠️ Refresh fallito per %s, resta la versione precedente: %s", query[:100], e)
+        finally:
+            with self._lock:
+                entry['checks'] += 1
+                entry['last_check'] = time.time()
+                entry['builds'] += built
+                entry['failures'] += error is not None
+                entry['last_error'] = error
+                entry['next_run'] = self._next_run(entry['interval'])
+                entry['running'] = False
+
+    def _rebuild(self, query, expires):
+        """
+        Genera il playlist combinato (un solo download per upstream) e lo
+        confronta con la versione in spool tramite l'hash del contenuto, che
+        dipende dai dati upstream e dalle regole di riscrittura. Restituisce
+        True se è stata pubblicata una nuova versione.
+        """
+        writer = self.spool.writer(query)
+        if writer is None:
+            raise RuntimeError("playlist già in scrittura nello spool da una richiesta")
+        writer.meta.update(expires=expires)
+        stats = {'errors': 0}
+        try:
+            for chunk in admitted_combined_playlist(query.split(';'), stats=stats):
+                writer.write(chunk)
+        except BaseException:
+            self.spool.abort(writer)
+            raise
+        if stats['errors']:
+            self.spool.abort(writer)
+            raise RuntimeError(f"{stats['errors']} playlist in errore, versione non pubblicata")
+        meta = self.spool.read_meta(query)
+        if meta is not None and meta.get('digest') == writer.hexdigest() and os.path.exists(self.spool.blob_path(meta['digest'])):
+            # Contenuto invariato: resta il file pubblicato (con il suo ETag), se ne prolunga la validità
+            self.spool.abort(writer)
+            meta['expires'] = expires
+            self.spool.write_meta(meta)
+            logger.info("🗓️ Upstream invariati, playlist in spool ancora valido: %s", query[:100])
+            return False
+        logger.info("🔁 Upstream cambiati, nuova versione del playlist combinato: %s", query[:100])
+        self.spool.finish(writer, stats)
+        return True
+
+    def stats(self):
+        with self._lock:
+            entries = {
+                query[:100]: {key: value for key, value in entry.items() if key != 'running'}
+                for query, entry in self._entries.items()
+            }
+        return {'scheduler': self.is_scheduler, 'registry': self.registry_path, 'entries': entries}
+
+refresher = None
+if REFRESH_REGISTRY_FILE and not _IS_REWRITE_POOL_PROCESS:
+    if merged_spool is None:
+        logger.warning("⚠️ REFRESH_REGISTRY_FILE richiede MERGED_SPOOL_DIR: refresher disattivato")
+    else:
+        refresher = PlaylistRefresher(REFRESH_REGISTRY_FILE, merged_spool, REFRESH_INTERVAL, REFRESH_JITTER, REFRESH_CONCURRENCY)
+        # Ogni processo che importa l'app (es. ogni worker gunicorn) compete per il ruolo di scheduler
+        refresher.start()
+        os.register_at_fork(after_in_child=refresher.reset_after_fork)
+
+def iter_playlist_channels(chunks):
+    """
+    Estrae i canali dall'output riscritto del playlist combinato. Restituisce
+    dizionari con name, group, logo, tvg_id, url (riscritto), headers (dalle
+    direttive #EXTVLCOPT/#EXTHTTP) e block (le linee grezze del canale).
+    """
+    block = []
+    extinf_line = group_line = None
+    headers = {}
+    for line in iter_lines_from_chunks(chunks):
+        stripped = line.strip()
+        if not stripped or stripped.startswith(b'#EXTM3U') or (stripped.startswith(b'# ') and not block):
+            continue # Header e commenti del proxy (# SKIPPED, # DEDUP, ...) fuori dai canali
+        block.append(stripped)
+        if stripped.startswith(b'#'):
+            if stripped.startswith(b'#EXTINF'):
+                extinf_line = stripped
+            elif stripped.startswith(b'#EXTGRP:'):
+                group_line = stripped
+            else:
+                _, headers = apply_header_directive(stripped.decode('utf-8', errors='replace'), headers)
+            continue
+        attributes, name = {}, ''
+        if extinf_line is not None:
+            attributes = {key.lower(): value.decode('utf-8', errors='replace') for key, value in _EXTINF_ATTR_RE.findall(extinf_line)}
+            name_match = _EXTINF_NAME_RE.match(extinf_line)
+            if name_match:
+                name = name_match.group(1).decode('utf-8', errors='replace').strip()
+        group = attributes.get(b'group-title')
+        if group is None and group_line is not None:
+            group = group_line.split(b':', 1)[1].decode('utf-8', errors='replace').strip()
+        yield {
+            'name': name, 'group': group, 'logo': attributes.get(b'tvg-logo'), 'tvg_id': attributes.get(b'tvg-id'),
+            'url': stripped.decode('utf-8', errors='replace'), 'headers': headers, 'block': b'\n'.join(block),
+        }
+        block = []
+        extinf_line = group_line = None
+        headers = {}
+
+class ChannelStore:
+    """
+    Archivio SQLite dei canali dei playlist combinati, per le API JSON.
+    Ogni insieme di definizioni (la query string di /proxy) è un dataset con
+    i suoi canali, indicizzati per posizione e gruppo; i nomi sono in un
+    indice FTS5 per la ricerca. Un dataset più vecchio di ttl viene servito
+    subito e riallineato in background: se il playlist non è cambiato (hash
+    del contenuto) si aggiorna solo la data, altrimenti si inseriscono e
+    rimuovono solo i canali cambiati. Il file è condiviso tra i worker (WAL).
+    I dataset non più richiesti (nessun riallineamento da max_age secondi) e
+    quelli oltre max_datasets (i meno recenti) vengono eliminati.
+    """
+
+    MAX_PAGE_SIZE = 1000
+    WRITE_BATCH = 1000 # Righe per executemany durante l'aggiornamento
+
+    def __init__(self, path, ttl, max_datasets=0, max_age=0):
+        self.path = path
+        self.ttl = ttl
+        self.max_datasets = max_datasets
+        self.max_age = max_age
+        self.fts = True
+        self._local = threading.local()
+        self._building = {} # Chiave del dataset -> Event, ricostruzioni in corso in questo worker
+        self._lock = threading.Lock()
+        self._create_schema()
+
+    def reset_after_fork(self):
+        # Le connessioni SQLite non vanno condivise con il processo padre
+        self._local = threading.local()
+        self._building = {}
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.row_factory = sqlite3.Row
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def _create_schema(self):
+        connection = self._connection()
+        connection.executescript("""
+            CREATE TABLE IF NOT EXISTS datasets (
+                id INTEGER PRIMARY KEY, key TEXT UNIQUE NOT NULL, digest TEXT,
+                refreshed_at REAL NOT NULL DEFAULT 0, channel_count INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS channels (
+                id INTEGER PRIMARY KEY, dataset_id INTEGER NOT NULL, uid INTEGER NOT NULL, position INTEGER NOT NULL,
+                name TEXT, grp TEXT, logo TEXT, tvg_id TEXT, url TEXT NOT NULL, headers TEXT
+            );
+            CREATE INDEX IF NOT EXISTS channels_position ON channels(dataset_id, position);
+            CREATE INDEX IF NOT EXISTS channels_group ON channels(dataset_id, grp, position);
+            CREATE INDEX IF NOT EXISTS channels_uid ON channels(dataset_id, uid);
+        """)
+        try:
+            connection.executescript("""
+                CREATE VIRTUAL TABLE IF NOT EXISTS channels_fts USING fts5(
+                    name, content='channels', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+                );
+                CREATE TRIGGER IF NOT EXISTS channels_ai AFTER INSERT ON channels BEGIN
+                    INSERT INTO channels_fts(rowid, name) VALUES (new.id, new.name);
+                END;
+                CREATE TRIGGER IF NOT EXISTS channels_ad AFTER DELETE ON channels BEGIN
+                    INSERT INTO channels_fts(channels_fts, rowid, name) VALUES ('delete', old.id, old.name);
+                END;
+            """)
+        except sqlite3.OperationalError as e:
+            # SQLite senza FTS5: la ricerca usa LIKE (più lenta sui dataset grandi)
+            logger.warning("⚠️ FTS5 non disponibile, ricerca canali senza indice full-text: %s", e)
+            self.fts = False
+
+    def _dataset(self, key):
+        return self._connection().execute('SELECT * FROM datasets WHERE key = ?', (key,)).fetchone()
+
+    def dataset(self, key):
+        """
+        Dataset per la query string, costruito al primo uso (attesa) e
+        riallineato in background quando più vecchio di ttl. None se la
+        costruzione, avviata da un'altra richiesta, non è riuscita.
+        """
+        dataset = self._dataset(key)
+        if dataset is not None:
+            if time.time() - dataset['refreshed_at'] >= self.ttl:
+                self._start_refresh(key, background=True)
+            return dataset
+        self._start_refresh(key, background=False)
+        return self._dataset(key)
+
+    def _start_refresh(self, key, background):
+        with self._lock:
+            event = self._building.get(key)
+            owner = event is None
+            if owner:
+                event = self._building[key] = threading.Event()
+        if not owner:
+            if not background:
+                event.wait()
+            return
+        if background:
+            threading.Thread(target=self._refresh_and_release, args=(key, event), name='m3u-channels', daemon=True).start()
+        else:
+            self._refresh_and_release(key, event, raise_errors=True)
+
+    def _refresh_and_release(self, key, event, raise_errors=False):
+        try:
+            self.refresh(key)
+        except Exception as e:
+            logger.warning("⚠️ Aggiornamento dei canali fallito per %s: %s", key[:100], e)
+            if raise_errors:
+                raise
+        finally:
+            with self._lock:
+                self._building.pop(key, None)
+            event.set()
+
+    def _playlist_chunks(self, key, stats):
+        # Dallo spool se il playlist combinato è già pronto, altrimenti generandolo
+        spooled = merged_spool.lookup(key) if merged_spool is not None else None
+        if spooled is not None:
+            with open(spooled.path, 'rb') as f:
+                yield from iter(lambda: f.read(UPSTREAM_CHUNK_SIZE), b'')
+            return
+        yield from admitted_combined_playlist(key.split(';'), stats=stats)
+
+    def refresh(self, key):
+        """Riallinea i canali del dataset all'output corrente del playlist combinato."""
+        started_at = time.monotonic()
+        stats = {'errors': 0}
+        digest = hashlib.sha256()
+        # Il playlist passa da un file temporaneo: memoria costante e lock di scrittura
+        # tenuto solo durante l'aggiornamento, non durante i download
+        with tempfile.TemporaryFile() as playlist_file:
+            for chunk in self._playlist_chunks(key, stats):
+                digest.update(chunk)
+                playlist_file.write(chunk)
+            playlist_file.seek(0)
+            channels = iter_playlist_channels(iter(lambda: playlist_file.read(UPSTREAM_CHUNK_SIZE), b''))
+            self._store(key, digest.hexdigest(), channels, stats, started_at)
+        self._evict()
+
+    def _store(self, key, digest, channels, stats, started_at):
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            dataset = self._dataset(key)
+            if dataset is None and stats['errors']:
+                # Primo caricamento con playlist in errore: nessun dataset (vuoto o parziale) da servire per ttl secondi
+                raise Exception(f"{stats['errors']} playlist in errore, canali non disponibili")
+            if dataset is not None and stats['errors']:
+                # Con playlist in errore si tengono i canali precedenti
+                connection.execute('UPDATE datasets SET refreshed_at = ? WHERE id = ?', (time.time(), dataset['id']))
+                connection.execute('COMMIT')
+                logger.warning("⚠️ %s playlist in errore: canali di %s non aggiornati", stats['errors'], key[:100])
+                return
+            if dataset is not None and dataset['digest'] == digest:
+                connection.execute('UPDATE datasets SET refreshed_at = ? WHERE id = ?', (time.time(), dataset['id']))
+                connection.execute('COMMIT')
+                logger.info("📇 Canali invariati per %s (%s)", key[:100], dataset['channel_count'])
+                return
+            if dataset is None:
+                dataset_id = connection.execute('INSERT INTO datasets(key) VALUES (?)', (key,)).lastrowid
+            else:
+                dataset_id = dataset['id']
+            count, inserted, removed = self._apply_channels(connection, dataset_id, channels)
+            connection.execute(
+                'UPDATE datasets SET digest = ?, refreshed_at = ?, channel_count = ? WHERE id = ?',
+                (digest, time.time(), count, dataset_id)
+            )
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        logger.info("📇 Canali aggiornati per %s: %s totali, %s nuovi, %s rimossi "
+                    "in %.2fs",
+                    key[:100], count, inserted, removed, time.monotonic() - started_at)
+
+    def _evict(self):
+        # Dataset scaduti (non più richiesti) e, oltre il limite, i meno recenti
+        connection = self._connection()
+        stale = []
+        if self.max_age > 0:
+            stale += [row['id'] for row in connection.execute(
+                'SELECT id FROM datasets WHERE refreshed_at < ?', (time.time() - self.max_age,)
+            )]
+        if self.max_datasets > 0:
+            stale += [row['id'] for row in connection.execute(
+                'SELECT id FROM datasets ORDER BY refreshed_at DESC LIMIT -1 OFFSET ?', (self.max_datasets,)
+            )]
+        for dataset_id in dict.fromkeys(stale):
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                connection.execute('DELETE FROM channels WHERE dataset_id = ?', (dataset_id,))
+                connection.execute('DELETE FROM datasets WHERE id = ?', (dataset_id,))
+                connection.execute('COMMIT')
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+        if stale:
+            logger.info("🧹 Archivio canali: %s dataset eliminati", len(set(stale)))
+
+    @staticmethod
+    def _channel_uid(block):
+        return int.from_bytes(hashlib.blake2b(block, digest_size=8).digest(), 'big', signed=True)
+
+    def _apply_channels(self, connection, dataset_id, channels):
+        # Aggiornamento incrementale: canali identici (stesse linee) restano,
+        # cambia al più la posizione; gli altri vengono inseriti o rimossi.
+        # Le scritture avvengono a blocchi mentre i canali vengono letti.
+        existing = {}
+        for row in connection.execute('SELECT id, uid, position FROM channels WHERE dataset_id = ? ORDER BY position', (dataset_id,)):
+            existing.setdefault(row['uid'], []).append((row['id'], row['position']))
+        moved, inserts = [], []
+        count = inserted = 0
+
+        def flush():
+            connection.executemany('UPDATE channels SET position = ? WHERE id = ?', moved)
+            connection.executemany(
+                'INSERT INTO channels(dataset_id, uid, position, name, grp, logo, tvg_id, url, headers) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                inserts
+            )
+            moved.clear()
+            inserts.clear()
+
+        for position, channel in enumerate(channels):
+            count += 1
+            uid = self._channel_uid(channel['block'])
+            matches = existing.get(uid)
+            if matches:
+                row_id, old_position = matches.pop(0)
+                if old_position != position:
+                    moved.append((position, row_id))
+            else:
+                inserts.append((
+                    dataset_id, uid, position, channel['name'], channel['group'], channel['logo'], channel['tvg_id'],
+                    channel['url'], json.dumps(channel['headers']) if channel['headers'] else None
+                ))
+                inserted += 1
+            if len(moved) + len(inserts) >= self.WRITE_BATCH:
+                flush()
+        flush()
+        stale = [(row_id,) for matches in existing.values() for row_id, _ in matches]
+        connection.executemany('DELETE FROM channels WHERE id = ?', stale)
+        return count, inserted, len(stale)
+
+    @staticmethod
+    def _channel_json(row):
+        return {
+            'position': row['position'], 'name': row['name'], 'group': row['grp'], 'logo': row['logo'],
+            'tvg_id': row['tvg_id'], 'url': row['url'], 'headers': json.loads(row['headers']) if row['headers'] else {},
+        }
+
+    def _page(self, page, per_page):
+        per_page = max(1, min(per_page, self.MAX_PAGE_SIZE))
+        page = max(1, page)
+        return page, per_page, (page - 1) * per_page
+
+    def channels(self, dataset, page=1, per_page=100, group=None):
+        page, per_page, offset = self._page(page, per_page)
+        connection = self._connection()
+        if group is None:
+            # Le posizioni sono contigue: la pagina è un intervallo dell'indice, senza OFFSET
+            total = dataset['channel_count']
+            rows = connection.execute(
+                'SELECT * FROM channels WHERE dataset_id = ? AND position >= ? ORDER BY position LIMIT ?',
+                (dataset['id'], offset, per_page)
+            ).fetchall()
+        else:
+            total = connection.execute(
+                'SELECT COUNT(*) FROM channels WHERE dataset_id = ? AND grp = ?', (dataset['id'], group)
+            ).fetchone()[0]
+            rows = connection.execute(
+                'SELECT * FROM channels WHERE dataset_id = ? AND grp = ? ORDER BY position LIMIT ? OFFSET ?',
+                (dataset['id'], group, per_page, offset)
+            ).fetchall()
+        return {'total': total, 'page': page, 'per_page': per_page, 'channels': [self._channel_json(row) for row in rows]}
+
+    def groups(self, dataset):
+        rows = self._connection().execute(
+            'SELECT grp, COUNT(*) AS channels, MIN(position) AS first FROM channels WHERE dataset_id = ? GROUP BY grp ORDER BY first',
+            (dataset['id'],)
+        ).fetchall()
+        return {'total': len(rows), 'groups': [{'name': row['grp'], 'channels': row['channels']} for row in rows]}
+
+    def search(self, dataset, text, page=1, per_page=100):
+        page, per_page, offset = self._page(page, per_page)
+        connection = self._connection()
+        terms = re.findall(r'\w+', text)
+        if not terms:
+            return {'total': 0, 'page': page, 'per_page': per_page, 'channels': []}
+        if self.fts:
+            # Ogni parola come prefisso ("sky spo" trova "Sky Sport"), in AND
+            match = ' '.join('"' + term.replace('"', '') + '"*' for term in terms)
+            where = 'channels_fts MATCH ? AND c.dataset_id = ?'
+            # CROSS JOIN: SQLite parte dall'indice full-text invece di scorrere i canali del dataset
+            source = 'channels_fts CROSS JOIN channels c ON c.id = channels_fts.rowid'
+            params = (match, dataset['id'])
+            order = 'channels_fts.rank, c.position'
+        else:
+            where = ' AND '.join(['c.name LIKE ?'] * len(terms)) + ' AND c.dataset_id = ?'
+            source = 'channels c'
+            params = tuple(f'%{term}%' for term in terms) + (dataset['id'],)
+            order = 'c.position'
+        total = connection.execute(f'SELECT COUNT(*) FROM {source} WHERE {where}', params).fetchone()[0]
+        rows = connection.execute(
+            f'SELECT c.* FROM {source} WHERE {where} ORDER BY {order} LIMIT ? OFFSET ?', params + (per_page, offset)
+        ).fetchall()
+        return {'total': total, 'page': page, 'per_page': per_page, 'channels': [self._channel_json(row) for row in rows]}
+
+channel_store = None
+if CHANNEL_STORE_PATH and not _IS_REWRITE_POOL_PROCESS:
+    try:
+        channel_store = ChannelStore(CHANNEL_STORE_PATH, CHANNEL_STORE_TTL, CHANNEL_STORE_MAX_DATASETS, CHANNEL_STORE_MAX_AGE)
+        os.register_at_fork(after_in_child=channel_store.reset_after_fork)
+    except sqlite3.Error as e:
+        logger.warning("⚠️ Archivio dei canali non disponibile (%s): %s", CHANNEL_STORE_PATH, e)
+
+def channel_api_response(action, args):
     """
-    Riscrive i link nel contenuto M3U secondo le regole specificate,
-    includendo gli headers da #EXTVLCOPT e #EXTHTTP.
+    Esegue una chiamata delle API dei canali (channels, groups, search) con i
+    parametri della query string. Restituisce (stato HTTP, dizionario JSON).
     """
-    lines = m3u_content.split('\n')
-    rewritten_lines = []
-    current_ext_headers = {} # Dizionario per conservare gli headers dalle direttive
-    
-    for line in lines:
-        line = line.strip()
-        
-        is_header_tag = False
-        if line.startswith('#EXTVLCOPT:'):
-            is_header_tag = True
-            try:
-                option_str = line.split(':', 1)[1]
-                if '=' in option_str:
-                    key_vlc, value_vlc = option_str.split('=', 1)
-                    key_vlc = key_vlc.strip()
-                    value_vlc = value_vlc.strip()
- 
-                    # Gestione speciale per http-header che contiene "Key: Value"
-                    if key_vlc == 'http-header' and ':' in value_vlc:
-                        header_key, header_value = value_vlc.split(':', 1)
-                        header_key = header_key.strip()
-                        header_value = header_value.strip()
-                        current_ext_headers[header_key] = header_value
-                        print(f"ℹ️ Trovato header da #EXTVLCOPT (http-header): {{'{header_key}': '{header_value}'}}")
-                    elif key_vlc.startswith('http-'):
-                        # Gestisce http-user-agent, http-referer etc.
-                        header_key = '-'.join(word.capitalize() for word in key_vlc[len('http-'):].split('-'))
-
-                        current_ext_headers[header_key] = value_vlc
-                        print(f"ℹ️ Trovato header da #EXTVLCOPT: {{'{header_key}': '{value_vlc}'}}")
-            except Exception as e:
-                print(f"⚠️ Errore nel parsing di #EXTVLCOPT '{line}': {e}")
-        
-        elif line.startswith('#EXTHTTP:'):
-            is_header_tag = True
-            try:
-                json_str = line.split(':', 1)[1]
-                # Sostituisce tutti gli header correnti con quelli del JSON
-                current_ext_headers = json.loads(json_str)
-                print(f"ℹ️ Trovati headers da #EXTHTTP: {current_ext_headers}")
-            except Exception as e:
-                print(f"⚠️ Errore nel parsing di #EXTHTTP '{line}': {e}")
-                current_ext_headers = {} # Resetta in caso di errore
+    if channel_store is None:
+        return 404, {'error': 'API dei canali disattivate (CHANNEL_STORE_PATH vuoto)'}
+    defs = (args.get('defs') or '').strip()
+    if not defs:
+        return 400, {'error': "parametro 'defs' mancante (query string di /proxy, codificata)"}
+    try:
+        page = int(args.get('page', 1))
+        per_page = int(args.get('per_page', 100))
+    except ValueError:
+        return 400, {'error': "'page' e 'per_page' devono essere numeri interi"}
+    try:
+        dataset = channel_store.dataset(defs)
+    except AdmissionRejected as e:
+        return 429, {'error': admission_rejected_message(e)}
+    except Exception as e:
+        logger.exception("Errore nella costruzione dei canali per %s", defs[:100])
+        return 502, {'error': f"playlist non disponibile: {e}"}
+    if dataset is None:
+        # Costruzione avviata da un'altra richiesta e fallita
+        return 502, {'error': 'playlist non disponibile'}
+    if action == 'channels':
+        result = channel_store.channels(dataset, page, per_page, args.get('group'))
+    elif action == 'groups':
+        result = channel_store.groups(dataset)
+    else:
+        result = channel_store.search(dataset, args.get('q', ''), page, per_page)
+    result['refreshed_at'] = dataset['refreshed_at']
+    return 200, result
 
-        if is_header_tag:
-            rewritten_lines.append(line)
-            continue
-        
-        # Se la linea contiene un URL (non inizia con # e non è vuota)
-        if line and not line.startswith('#') and ('http://' in line or 'https://' in line):
-            print(f"Processando link: {line[:100]}...")
-            
-            processed_url = line # Inizializza con il link originale, verrà modificato se le regole corrispondono
-            
-            # Controlla PRIMA se il link contiene 'vixsrc.to' (priorità alta)
-            if 'vavoo.to' in line:
-                # Riscrive come extractor video per VixCloud
-                processed_url = f"{base_url}/proxy/hls/manifest.m3u8?api_password={api_password}&d={line}"
-                print(f"✅ Riscritto Vavoo: {line[:50]}... -> {processed_url[:50]}...")
-            
-            elif 'vixsrc.to' in line:
-                # Riscrive come extractor video per VixCloud
-                processed_url = f"{base_url}/extractor/video?host=VixCloud&redirect_stream=true&api_password={api_password}&d={line}"
-                print(f"✅ Riscritto VixCloud: {line[:50]}... -> {processed_url[:50]}...")
-            
-            # Controlla se è un link .m3u8 (anche con parametri)
-            elif '.m3u8' in line:
-                # Riscrive come proxy HLS
-                processed_url = f"{base_url}/proxy/hls/manifest.m3u8?api_password={api_password}&d={line}"
-                print(f"✅ Riscritto M3U8: {line[:50]}... -> {processed_url[:50]}...")
-            
-            # Controlla se è un link .mpd (anche con parametri)
-            elif '.mpd' in line:
-                # Riscrive come proxy MPD
-                processed_url = f"{base_url}/proxy/mpd/manifest.m3u8?api_password={api_password}&d={line}"
-                print(f"✅ Riscritto MPD: {line[:50]}... -> {processed_url[:50]}...")
-            
-            # Controlla se è un link .php (anche con parametri)
-            elif '.php' in line:
-                # Riscrive come extractor video
-                processed_url = f"{base_url}/extractor/video?host=DLHD&redirect_stream=true&api_password={api_password}&d={line}"
-                print(f"✅ Riscritto PHP: {line[:50]}... -> {processed_url[:50]}...")
-            
-            else:
-                # Link non modificato dalle regole di riscrittura specifiche
-                # 'processed_url' rimane il 'line' originale
-                print(f"⚠️ Link non modificato (pattern): {line[:50]}...")
+def send_spooled_playlist(spooled):
+    """Risposta /proxy dal file in spool: Range, ETag/304 e invio zero-copy (wsgi.file_wrapper)."""
+    path, encoding = spooled_playlist_variant(spooled, request.accept_encodings, ranged='Range' in request.headers)
+    logger.info("💾 /proxy servito dallo spool: %s (%s, Range: %s)", spooled.digest[:16], encoding or 'identity', request.headers.get('Range', '-'))
+    response = send_file(
+        path, mimetype='application/vnd.apple.mpegurl', as_attachment=True, download_name='playlist.m3u',
+        conditional=True, etag=spooled.etag(encoding), last_modified=spooled.created
+    )
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    response.headers['X-Spool'] = 'HIT'
+    return response
 
-            # Applica gli headers da current_ext_headers, se presenti, a processed_url
-            if current_ext_headers:
-                header_params_str = ""
-                for key, value in current_ext_headers.items():
-                    # Formato richiesto: &h_NOMEHEADER=VALOREHEADER. Applica URL encoding a chiave e valore.
-                    header_params_str += f"&h_{urllib.parse.quote(key)}={urllib.parse.quote(urllib.parse.quote(value))}" 
-                
-                if header_params_str: # Se sono stati formattati parametri header
-                    processed_url += header_params_str
-                    print(f"➕ Aggiunti headers a URL: {header_params_str} -> {processed_url[:150]}...")
-                
-                current_ext_headers = {} # Resetta gli headers dopo averli applicati a questa URL
+def negotiate_response_encoding(accept_encodings):
+    """Sceglie la compressione della risposta (br, gzip o None) in base ad Accept-Encoding."""
+    if not RESPONSE_COMPRESSION:
+        return None
+    if brotli is not None and accept_encodings.quality('br') > 0:
+        return 'br'
+    if accept_encodings.quality('gzip') > 0:
+        return 'gzip'
+    return None
 
-            rewritten_lines.append(processed_url)
+class StreamCompressor:
+    """
+    Compressore incrementale (br o gzip) del playlist. Il primo blocco viene
+    inviato subito (TTFB basso), poi si forza un flush ogni
+    COMPRESSION_FLUSH_BYTES byte in ingresso, così il client riceve dati
+    con regolarità senza perdere efficienza di compressione.
+    """
+
+    def __init__(self, encoding):
+        if encoding == 'br':
+            compressor = brotli.Compressor(mode=brotli.MODE_TEXT, quality=BROTLI_QUALITY)
+            self._compress, self._flush, self._finish = compressor.process, compressor.flush, compressor.finish
         else:
-            # Mantiene le linee di metadati (#EXTM3U, #EXTINF, etc.)
-            rewritten_lines.append(line)
-            # Non resettare current_exthttp_headers qui; devono persistere per la prossima URL se non ancora usati.
-    
-    return '\n'.join(rewritten_lines)
+            compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            self._compress = compressor.compress
+            self._flush = lambda: compressor.flush(zlib.Z_SYNC_FLUSH)
+            self._finish = compressor.flush
+        self._unflushed_bytes = 0
+        self._first_chunk = True
 
-def rewrite_m3u_links_streaming(m3u_lines_iterator, base_url, api_password):
+    def compress(self, chunk):
+        output = self._compress(chunk)
+        self._unflushed_bytes += len(chunk)
+        if self._first_chunk or self._unflushed_bytes >= COMPRESSION_FLUSH_BYTES:
+            output += self._flush()
+            self._unflushed_bytes = 0
+            self._first_chunk = False
+        return output
+
+    def finish(self):
+        return self._finish()
+
+def compress_stream(chunks, encoding):
+    """Comprime in streaming i blocchi del playlist (vedi StreamCompressor)."""
+    compressor = StreamCompressor(encoding)
+    for chunk in chunks:
+        output = compressor.compress(chunk)
+        if output:
+            yield output
+    yield compressor.finish()
+
+_profile_lock = threading.Lock() # Una sola richiesta profilata per worker
+
+def format_profile_report(profiler):
+    """Le funzioni più costose (tempo proprio) come commenti '# PROFILE' da accodare al playlist."""
+    output = io.StringIO()
+    pstats.Stats(profiler, stream=output).sort_stats('tottime').print_stats(PROFILE_TOP_FUNCTIONS)
+    report = output.getvalue().strip()
+    logger.info("🔬 Profilo della richiesta /proxy:\n%s", report)
+    return ''.join(f"# PROFILE {line}\n" for line in report.splitlines() if line.strip()).encode('utf-8')
+
+def traced_body(body, trace, profiler=None, measure_write=False):
     """
-    Riscrive i link da un iteratore di linee M3U secondo le regole specificate,
-    includendo gli headers da #EXTVLCOPT e #EXTHTTP. Yields rewritten lines.
+    Avvolge il corpo della risposta: (opzionale) profila la generazione dei
+    blocchi, misura la scrittura verso il client se il generatore non lo fa
+    già e, a fine stream, accoda il riepilogo dei tempi e il profilo.
     """
-    current_ext_headers = {} # Dizionario per conservare gli headers dalle direttive
-    
-    for line_with_newline in m3u_lines_iterator:
-        line_content = line_with_newline.rstrip('\n')
-        logical_line = line_content.strip()
-        
-        is_header_tag = False
-        if logical_line.startswith('#EXTVLCOPT:'):
-            is_header_tag = True
-            try:
-                option_str = logical_line.split(':', 1)[1]
-                if '=' in option_str:
-                    key_vlc, value_vlc = option_str.split('=', 1)
-                    key_vlc = key_vlc.strip()
-                    value_vlc = value_vlc.strip()
- 
-                    # Gestione speciale per http-header che contiene "Key: Value"
-                    if key_vlc == 'http-header' and ':' in value_vlc:
-                        header_key, header_value = value_vlc.split(':', 1)
-                        header_key = header_key.strip()
-                        header_value = header_value.strip()
-                        current_ext_headers[header_key] = header_value
-                        print(f"ℹ️ Trovato header da #EXTVLCOPT (http-header): {{'{header_key}': '{header_value}'}}")
-                    elif key_vlc.startswith('http-'):
-                        # Gestisce http-user-agent, http-referer etc.
-                        header_key = '-'.join(word.capitalize() for word in key_vlc[len('http-'):].split('-'))
-                    
-                        current_ext_headers[header_key] = value_vlc
-                        print(f"ℹ️ Trovato header da #EXTVLCOPT: {{'{header_key}': '{value_vlc}'}}")
-            except Exception as e:
-                print(f"⚠️ Errore nel parsing di #EXTVLCOPT '{logical_line}': {e}")
-        
-        elif logical_line.startswith('#EXTHTTP:'):
-            is_header_tag = True
+    try:
+        while True:
+            if profiler is not None:
+                profiler.enable()
             try:
-                json_str = logical_line.split(':', 1)[1]
-                # Sostituisce tutti gli header correnti con quelli del JSON
-                current_ext_headers = json.loads(json_str)
-                print(f"ℹ️ Trovati headers da #EXTHTTP: {current_ext_headers}")
-            except Exception as e:
-                print(f"⚠️ Errore nel parsing di #EXTHTTP '{logical_line}': {e}")
-                current_ext_headers = {} # Resetta in caso di errore
-
-        if is_header_tag:
-            yield line_with_newline
-            continue
-        
-        if logical_line and not logical_line.startswith('#') and \
-           ('http://' in logical_line or 'https://' in logical_line):
-            print(f"Processando link: {logical_line[:100]}...")
-            
-            # Decide la logica di riscrittura in base alla presenza della password
-            if api_password is not None:
-                # --- LOGICA CON PASSWORD (ESISTENTE) ---
-                processed_url_content = logical_line
-                
-                if 'vixsrc.to' in logical_line:
-                    processed_url_content = f"{base_url}/extractor/video?host=VixCloud&redirect_stream=true&api_password={api_password}&d={logical_line}"
-                    print(f"✅ Riscritto VixCloud: {logical_line[:50]}... -> {processed_url_content[:50]}...")
-                elif '.m3u8' in logical_line:
-                    processed_url_content = f"{base_url}/proxy/hls/manifest.m3u8?api_password={api_password}&d={logical_line}"
-                    print(f"✅ Riscritto M3U8: {logical_line[:50]}... -> {processed_url_content[:50]}...")
-                elif '.mpd' in logical_line:
-                    processed_url_content = f"{base_url}/proxy/mpd/manifest.m3u8?api_password={api_password}&d={logical_line}"
-                    print(f"✅ Riscritto MPD: {logical_line[:50]}... -> {processed_url_content[:50]}...")
-                elif '.php' in logical_line:
-                    processed_url_content = f"{base_url}/extractor/video?host=DLHD&redirect_stream=true&api_password={api_password}&d={logical_line}"
-                    print(f"✅ Riscritto PHP: {logical_line[:50]}... -> {processed_url_content[:50]}...")
-                else:
-                    # Link non modificato dalle regole, ma gli header potrebbero essere aggiunti
-                    print(f"⚠️ Link non modificato (pattern): {logical_line[:50]}...")
+                chunk = next(body, None)
+            finally:
+                if profiler is not None:
+                    profiler.disable()
+            if chunk is None:
+                break
+            if measure_write:
+                write_started = time.monotonic()
+                yield chunk
+                trace.write += time.monotonic() - write_started
             else:
-                # --- NUOVA LOGICA SENZA PASSWORD ---
-                processed_url_content = f"{base_url}/proxy/m3u?url={logical_line}"
-                print(f"✅ Riscritto (senza password): {logical_line[:50]}... -> {processed_url_content[:50]}...")
-            # Applica gli header raccolti, indipendentemente dalla modalità
-            if current_ext_headers:
-                header_params_str = "".join([f"&h_{urllib.parse.quote(key)}={urllib.parse.quote(urllib.parse.quote(value))}" for key, value in current_ext_headers.items()])
-                processed_url_content += header_params_str
-                print(f"➕ Aggiunti headers a URL: {header_params_str} -> {processed_url_content[:150]}...")
-                current_ext_headers = {}
-            
-            yield processed_url_content + '\n'
-        else:
-            yield line_with_newline
-            
-def download_m3u_playlist_streaming(url):
+                yield chunk
+        logger.info("⏱️ Tempi /proxy: %s", trace.server_timing_header())
+        if REQUEST_TIMING:
+            yield trace.comment_lines()
+        if profiler is not None:
+            yield format_profile_report(profiler)
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+        if profiler is not None:
+            _profile_lock.release()
+
+def _prepend_chunk(first_chunk, body):
     try:
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-            'Accept': '*/*',
-            'Accept-Language': 'en-US,en;q=0.9',
-            'Accept-Encoding': 'gzip, deflate',
-            'Connection': 'keep-alive'
-        }
-        
-        print(f"Scaricamento (streaming) da: {url}")
-        # verify=False is generally not recommended for production
-        with requests.get(url, headers=headers, timeout=30, verify=False, stream=True) as response:
-            print(f"Status code: {response.status_code}")
-            print(f"Headers risposta (prime parti): {{k: v[:100] for k, v in dict(response.headers).items()}}") # Log snippet of headers
-            response.raise_for_status()
-            for line_bytes in response.iter_lines():
-                decoded_line = line_bytes.decode('utf-8', errors='replace')
-                # Explicitly check for and skip empty lines after decoding
-                yield decoded_line + '\n' if decoded_line else ''
-        
-    except requests.RequestException as e:
-        print(f"Errore download (streaming): {str(e)}")
-        raise Exception(f"Errore nel download (streaming) della playlist: {str(e)}")
-    except Exception as e:
-        print(f"Errore generico durante lo streaming del download da {url}: {str(e)}")
-        raise
+        if first_chunk is not None:
+            yield first_chunk
+        yield from body
+    finally:
+        body.close()
+
+def _profiling_requested():
+    # X-Profile: 1 è ignorato se ADMIN_TOKEN non è configurato
+    if not ADMIN_TOKEN or request.headers.get('X-Profile', '').lower() not in ('1', 'true', 'yes', 'on'):
+        return False
+    return True
 
 @app.route('/proxy')
 def proxy_handler():
+    merge_slot = None
     try:
         query_string = request.query_string.decode('utf-8')
-        print(f"=== DEBUG PROXY ===")
-        print(f"Query string: {query_string}")
+        logger.info("=== Richiesta /proxy === Query string: %s", query_string)
 
         if not query_string:
             return "Query string mancante", 400
 
-        playlist_definitions = query_string.split(';')
+        profiler = None
+        if _profiling_requested():
+            if not hmac.compare_digest(request.headers.get('X-Admin-Token', ''), ADMIN_TOKEN):
+                return "Token amministratore non valido", 403
+            if _profile_lock.acquire(blocking=False):
+                profiler = cProfile.Profile()
+            else:
+                logger.warning("⚠️ Profilazione già in corso in questo worker: richiesta servita senza profilo")
 
-        def generate_combined_playlist():
-            first_playlist_header_handled = False # Tracks if the main #EXTM3U header context is done
-            total_bytes_yielded = 0
-            log_interval_bytes = 10 * 1024 * 1024 # Log every 10MB
-            last_log_bytes_milestone = 0
+        if merged_spool is not None and profiler is None:
+            spooled = merged_spool.lookup(query_string)
+            if spooled is not None:
+                return send_spooled_playlist(spooled)
 
-            for definition_idx, definition in enumerate(playlist_definitions):
-                if '&' not in definition:
-                    print(f"[{definition_idx}] Skipping invalid playlist definition (manca '&'): {definition}")
-                    yield f"# SKIPPED Invalid Definition: {definition}\n"
-                    continue
+        # Anche la richiesta profilata occupa un posto: il profilo misura la generazione entro i limiti
+        if merge_admission is not None:
+            try:
+                merge_admission.acquire()
+            except AdmissionRejected as e:
+                if profiler is not None:
+                    _profile_lock.release()
+                return admission_rejected_response(e)
+            merge_slot = AdmissionSlot(merge_admission)
 
-                parts = definition.split('&', 1)
-                creds_part, playlist_url_str = parts
-                
-                api_password = None
-                base_url_part = creds_part
-
-                # Heuristics to distinguish domain:port or scheme:// from domain:password
-                if ':' in creds_part:
-                    possible_base, possible_pass = creds_part.rsplit(':', 1)
-                    
-                    # A password is assumed if the part after the last colon is not a port (all digits)
-                    # and does not start with '//' (which would mean we split a URL scheme like http://)
-                    if not possible_pass.startswith('//') and not possible_pass.isdigit():
-                        base_url_part = possible_base
-                        api_password = possible_pass
-                
-                if api_password is not None:
-                    print(f"  [{definition_idx}] Base URL: {base_url_part}, Password: {'*' * len(api_password)}")
-                else:
-                    # Nessuna password fornita (o la parte dopo ':' era una porta/scheme)
-                    print(f"  [{definition_idx}] Base URL: {base_url_part}, Modalità senza password.")
+        playlist_definitions = query_string.split(';')
+        trace = RequestTrace() if REQUEST_TIMING or profiler is not None else None
+        spool_tag = merged_spool.new_tag() if merged_spool is not None and profiler is None else None
 
-                base_url_part = base_url_part.rstrip('/')
-                print(f"[{definition_idx}] Processing Playlist (streaming): {playlist_url_str}")
+        response_headers = {
+            'Content-Disposition': 'attachment; filename="playlist.m3u"',
+            'Access-Control-Allow-Origin': '*'
+        }
+        if merged_playlists is not None and profiler is None:
+            # Richieste identiche condividono la stessa generazione (e il risultato in cache)
+            flight, cache_status = merged_playlists.get(query_string, playlist_definitions, slot=merge_slot)
+            if merge_slot is not None and cache_status != 'MISS':
+                # Risultato in cache o generazione già avviata: la risposta non genera nulla
+                # (l'eventuale rigenerazione in background di STALE ha trattenuto il posto)
+                merge_slot.release()
+                merge_slot = None
+            body = flight.iter_chunks()
+            if merged_spool is not None:
+                body = merged_spool.record(query_string, body, flight.stats, slot=merge_slot, tag=spool_tag)
+            response_headers['X-Cache'] = cache_status
+            if trace is not None:
+                if flight.trace is not None and cache_status == 'MISS':
+                    # Solo chi avvia la generazione ne riporta i tempi; HIT e richieste unite
+                    # a una generazione in corso riportano cache, scrittura e durata propria
+                    trace.definitions = flight.trace.definitions
+                trace.cache_status = cache_status
+                body = traced_body(body, trace, measure_write=True)
+        else:
+            # Con il profilo attivo la generazione resta nel thread della richiesta
+            stats = {'errors': 0}
+            body = generate_combined_playlist(
+                playlist_definitions, stats=stats, trace=trace, parallel=False if profiler is not None else None
+            )
+            if merged_spool is not None and profiler is None:
+                # Il commento # TIMING è aggiunto dopo: il file contiene solo il playlist
+                body = merged_spool.record(query_string, body, stats, slot=merge_slot, tag=spool_tag)
+            if trace is not None:
+                body = traced_body(body, trace, profiler=profiler)
 
-                current_playlist_had_lines = False
-                first_line_of_this_segment = True
-                lines_processed_for_current_playlist = 0
-                try:
-                    downloaded_lines_iter = download_m3u_playlist_streaming(playlist_url_str)
-                    print(f"  [{definition_idx}] Download stream initiated for {playlist_url_str}")
-                    rewritten_lines_iter = rewrite_m3u_links_streaming(
-                        downloaded_lines_iter, base_url_part, api_password
-                    )
-                    
-                    for line in rewritten_lines_iter:
-                        current_playlist_had_lines = True
-                        is_extm3u_line = line.strip().startswith('#EXTM3U')
-                        lines_processed_for_current_playlist += 1
-
-                        if not first_playlist_header_handled: # Still in the context of the first playlist's header
-                            yield line
-                            if is_extm3u_line:
-                                first_playlist_header_handled = True  # Main header yielded
-                            
-                            line_bytes = len(line.encode('utf-8', 'replace')) # Use 'replace' for safety
-                            total_bytes_yielded += line_bytes
-                            
-                            if total_bytes_yielded // log_interval_bytes > last_log_bytes_milestone:
-                                last_log_bytes_milestone = total_bytes_yielded // log_interval_bytes
-                                print(f"ℹ️ [{definition_idx}] Total data yielded: {total_bytes_yielded / (1024*1024):.2f} MB. Current playlist lines: {lines_processed_for_current_playlist}")
-
-                            if len(line) > 10000: 
-                                print(f"⚠️ [{definition_idx}] VERY LONG LINE encountered (length={len(line)}, lines in current playlist={lines_processed_for_current_playlist}): {line[:100]}...")
-
-
-                        else: # Main header already handled (or first playlist didn't have one)
-                            if first_line_of_this_segment and is_extm3u_line:
-                                # Skip #EXTM3U if it's the first line of a subsequent segment
-                                pass
-                            else:
-                                yield line
-                        first_line_of_this_segment = False
-
-                        # This block for logging and length check was duplicated, ensure it's correctly placed for all yielded lines
-                        if first_playlist_header_handled: # If not the first header part, calculate bytes and log here too
-                            line_bytes = len(line.encode('utf-8', 'replace'))
-                            total_bytes_yielded += line_bytes
-                            if total_bytes_yielded // log_interval_bytes > last_log_bytes_milestone:
-                                last_log_bytes_milestone = total_bytes_yielded // log_interval_bytes
-                                print(f"ℹ️ [{definition_idx}] Total data yielded: {total_bytes_yielded / (1024*1024):.2f} MB. Current playlist lines: {lines_processed_for_current_playlist}")
-                            if len(line) > 10000:
-                                print(f"⚠️ [{definition_idx}] VERY LONG LINE encountered (length={len(line)}, lines in current playlist={lines_processed_for_current_playlist}): {line[:100]}...")
-
-                except Exception as e:
-                    print(f"💥 [{definition_idx}] Error processing playlist {playlist_url_str} (after ~{lines_processed_for_current_playlist} lines yielded for it): {str(e)}")
-                    yield f"# ERROR processing playlist {playlist_url_str}: {str(e)}\n"
-                
-                print(f"✅ [{definition_idx}] Finished processing playlist {playlist_url_str}. Lines processed in this segment: {lines_processed_for_current_playlist}")
-                if current_playlist_had_lines and not first_playlist_header_handled:
-                    # This playlist (which was effectively the first with content) finished,
-                    # and no #EXTM3U was found to mark as the main header.
-                    # Mark header as handled so subsequent playlists skip their #EXTM3U.
-                    first_playlist_header_handled = True
-        
-        print(f"🏁 Avvio streaming del contenuto combinato... (Total definitions: {len(playlist_definitions)})")
+        if trace is not None:
+            # Il primo blocco viene prodotto prima degli header: Server-Timing
+            # riporta così connessione e TTFB della prima playlist.
+            body = _prepend_chunk(next(body, None), body)
+            response_headers['Server-Timing'] = trace.server_timing_header()
+
+        encoding = negotiate_response_encoding(request.accept_encodings)
+        if encoding is not None:
+            body = compress_stream(body, encoding)
+            response_headers['Content-Encoding'] = encoding
+        response_headers['Vary'] = 'Accept-Encoding'
+        if spool_tag is not None:
+            # Stesso ETag del file in spool: chi riprende il download (Range + If-Range) lo riceve da lì
+            response_headers['ETag'] = spool_stream_etag(spool_tag, encoding)
+
+        logger.info("🏁 Avvio streaming del contenuto combinato... (Total definitions: %s)", len(playlist_definitions))
         # The final total_bytes_yielded will be known only if the generator completes fully.
-        return Response(
-            generate_combined_playlist(),
+        response = Response(
+            body,
             mimetype='application/vnd.apple.mpegurl',
-            headers={
-                'Content-Disposition': 'attachment; filename="playlist.m3u"',
-                'Access-Control-Allow-Origin': '*'
-            }
+            headers=response_headers
         )
+        if merge_slot is not None:
+            # Il posto resta occupato fino alla fine dello streaming (o del completamento dello spool)
+            response.call_on_close(merge_slot.release)
+        return response
         
     except Exception as e:
-        print(f"ERRORE GENERALE: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        if merge_slot is not None:
+            merge_slot.release()
+        logger.exception("ERRORE GENERALE: %s", e)
         return f"Errore: {str(e)}", 500
 
+def collect_upstream_stats():
+    """Statistiche del worker corrente su riuso connessioni, cache DNS e circuit breaker."""
+    return {
+        'pid': os.getpid(),
+        'pools': upstream_sessions.stats(),
+        'dns_cache': dns_cache.stats() if dns_cache is not None else None,
+        'playlist_cache': upstream_cache.stats() if upstream_cache is not None else None,
+        'circuit_breaker': circuit_breaker.stats() if circuit_breaker is not None else None,
+        'merged_spool': merged_spool.stats() if merged_spool is not None else None,
+        'refresher': refresher.stats() if refresher is not None else None,
+        'admission': {
+            'merges': merge_admission.stats() if merge_admission is not None else None,
+            'upstream_fetches': upstream_admission.stats() if upstream_admission is not None else None,
+        },
+    }
+
+_EXTM3U_EPG_URL_RE = re.compile(rb'(?:x-tvg-url|url-tvg)="([^"]*)"', re.IGNORECASE)
+XMLTV_CHUNK_BYTES = 64 * 1024 # Blocchi dell'output /epg
+XMLTV_DECOMPRESS_BYTES = 1024 * 1024 # Byte decompressi per volta dalle sorgenti .gz
+
+def collect_epg_targets(playlist_definitions, deadline=None):
+    """
+    Scarica e filtra le playlist delle definizioni come /proxy e raccoglie i
+    tvg-id dei canali (in minuscolo) e le sorgenti XMLTV: l'opzione
+    'epg=url1,url2' della richiesta e gli attributi x-tvg-url / url-tvg
+    dell'header #EXTM3U di ogni playlist. Restituisce (tvg_ids, sorgenti).
+    """
+    definitions, request_options = split_request_options(playlist_definitions)
+    sources = [url.strip() for url in request_options.get('epg', '').split(',') if url.strip()]
+    tvg_ids = set()
+    for definition_idx, definition in enumerate(definitions):
+        if not definition or '&' not in definition:
+            continue
+        try:
+            base_url, api_password, playlist_url, options = parse_playlist_definition(definition)
+            segment = open_playlist_segment(base_url, api_password, playlist_url, None, deadline, options)
+            for line in iter_lines_from_chunks(segment):
+                if line.startswith(b'#EXTINF'):
+                    match = _TVG_ID_RE.search(line)
+                    if match and match.group(1).strip():
+                        tvg_ids.add(match.group(1).strip().decode('utf-8', errors='replace').lower())
+                elif line.startswith(b'#EXTM3U'):
+                    for urls in _EXTM3U_EPG_URL_RE.findall(line):
+                        sources.extend(url.strip().decode('utf-8', errors='replace') for url in urls.split(b',') if url.strip())
+        except Exception as e:
+            logger.warning("⚠️ [%s] Playlist saltata per l'EPG: %s", definition_idx, e)
+    return tvg_ids, list(dict.fromkeys(sources))
+
+def parse_xmltv_time(value):
+    """Orario XMLTV ('YYYYMMDDHHMMSS +HHMM', fuso opzionale) in secondi epoch, o None."""
+    value = (value or '').strip()
+    try:
+        timestamp = calendar.timegm(datetime.strptime(value[:14].ljust(14, '0'), '%Y%m%d%H%M%S').timetuple())
+    except ValueError:
+        return None
+    offset = value[14:].strip()
+    if len(offset) == 5 and offset[0] in '+-' and offset[1:].isdigit():
+        seconds = int(offset[1:3]) * 3600 + int(offset[3:5]) * 60
+        timestamp -= seconds if offset[0] == '+' else -seconds
+    return timestamp
+
+def iter_xmltv_elements(url, deadline=None):
+    """
+    Legge una sorgente XMLTV (semplice o .gz) con un parser incrementale e
+    restituisce (tag, elemento) per ogni <channel> e <programme>. Ogni
+    elemento viene rimosso dall'albero dopo l'uso: la memoria non cresce con
+    la dimensione del file.
+    """
+    parser = ET.XMLPullParser(events=('start', 'end'))
+    decompressor = None
+    first_chunk = True
+    depth = 0
+    root = None
+    chunks = fetch_upstream_chunks(url, deadline=deadline)
+    try:
+        for chunk in chunks:
+            if first_chunk:
+                first_chunk = False
+                if chunk[:2] == b'\x1f\x8b': # File gzip (non Content-Encoding)
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            data = chunk
+            while data:
+                if decompressor is not None:
+                    # Decompressione a blocchi limitati anche per sorgenti molto comprimibili
+                    data, pending = decompressor.decompress(data, XMLTV_DECOMPRESS_BYTES), decompressor.unconsumed_tail
+                else:
+                    pending = b''
+                parser.feed(data)
+                for event, element in parser.read_events():
+                    if event == 'start':
+                        depth += 1
+                        if depth == 1:
+                            root = element
+                        continue
+                    depth -= 1
+                    if depth == 1:
+                        if element.tag in ('channel', 'programme'):
+                            yield element.tag, element
+                        root.clear()
+                data = pending
+        parser.close()
+    finally:
+        chunks.close()
+
+def _xmltv_bytes(element):
+    element.tail = None
+    return ET.tostring(element, encoding='unicode').encode('utf-8') + b'\n'
+
+def generate_epg(playlist_definitions):
+    """
+    Genera (streaming) l'XMLTV per le definizioni: solo i <channel> e i
+    <programme> dei tvg-id presenti nel playlist combinato, con i programmi
+    nella finestra EPG_PAST_HOURS / EPG_FUTURE_HOURS. Un canale presente in
+    più sorgenti prende i programmi dalla prima che lo contiene. I programmi
+    passano da un file temporaneo, così tutti i <channel> precedono i
+    <programme> come richiesto dal DTD XMLTV.
+    """
+    started_at = time.monotonic()
+    deadline = started_at + PROXY_DEADLINE if PROXY_DEADLINE > 0 else None
+    tvg_ids, sources = collect_epg_targets(playlist_definitions, deadline)
+    logger.info("📺 EPG: %s tvg-id da %s sorgenti XMLTV", len(tvg_ids), len(sources))
+    yield b'<?xml version="1.0" encoding="UTF-8"?>\n<!DOCTYPE tv SYSTEM "xmltv.dtd">\n<tv generator-info-name="m3u-proxy">\n'
+    now = time.time()
+    window_start = now - EPG_PAST_HOURS * 3600
+    window_end = now + EPG_FUTURE_HOURS * 3600
+    owners = {} # tvg-id -> indice della sorgente che lo fornisce
+    channels = programmes = 0
+    buffer = bytearray()
+    with tempfile.TemporaryFile() as programme_file:
+        for source_idx, url in enumerate(sources):
+            try:
+                logger.info("📺 [%s] Lettura XMLTV da %s", source_idx, url)
+                for tag, element in iter_xmltv_elements(url, deadline):
+                    if tag == 'channel':
+                        channel_id = (element.get('id') or '').strip().lower()
+                        if channel_id not in tvg_ids or channel_id in owners:
+                            continue
+                        owners[channel_id] = source_idx
+                        buffer += _xmltv_bytes(element)
+                        channels += 1
+                        if len(buffer) >= XMLTV_CHUNK_BYTES:
+                            yield bytes(buffer)
+                            buffer.clear()
+                        continue
+                    # Solo i programmi dei canali che la sorgente stessa ha dichiarato (<channel> prima dei <programme>)
+                    channel_id = (element.get('channel') or '').strip().lower()
+                    if owners.get(channel_id) != source_idx:
+                        continue
+                    start = parse_xmltv_time(element.get('start'))
+                    stop = parse_xmltv_time(element.get('stop')) or start
+                    if start is not None and (stop < window_start or start >= window_end):
+                        continue
+                    programme_file.write(_xmltv_bytes(element))
+                    programmes += 1
+            except Exception as e:
+                logger.warning("⚠️ [%s] Sorgente XMLTV saltata %s: %s", source_idx, url, e)
+                comment = f"{url}: {e}".replace('--', '- -')
+                buffer += f"<!-- SKIPPED EPG Source: {comment} -->\n".encode('utf-8')
+        if buffer:
+            yield bytes(buffer)
+        programme_file.seek(0)
+        while True:
+            chunk = programme_file.read(XMLTV_CHUNK_BYTES)
+            if not chunk:
+                break
+            yield chunk
+    yield b'</tv>\n'
+    logger.info("🏁 EPG completato: %s canali, %s programmi in %.2fs", channels, programmes, time.monotonic() - started_at)
+
+@app.route('/epg')
+def epg_handler():
+    """XMLTV filtrato per i canali delle definizioni (stessa sintassi di /proxy, opzione epg=url per sorgenti aggiuntive)."""
+    query_string = request.query_string.decode('utf-8')
+    logger.info("=== Richiesta /epg === Query string: %s", query_string)
+    if not query_string:
+        return "Query string mancante", 400
+    if merge_admission is not None:
+        try:
+            merge_admission.acquire()
+        except AdmissionRejected as e:
+            return admission_rejected_response(e)
+    body = generate_epg(query_string.split(';'))
+    response_headers = {
+        'Content-Disposition': 'attachment; filename="epg.xml"',
+        'Access-Control-Allow-Origin': '*',
+        'Vary': 'Accept-Encoding',
+    }
+    encoding = negotiate_response_encoding(request.accept_encodings)
+    if encoding is not None:
+        body = compress_stream(body, encoding)
+        response_headers['Content-Encoding'] = encoding
+    response = Response(body, mimetype='application/xml', headers=response_headers)
+    if merge_admission is not None:
+        response.call_on_close(merge_admission.release)
+    return response
+
+@app.route('/stats/upstream')
+def upstream_stats_handler():
+    return Response(json.dumps(collect_upstream_stats(), indent=2), mimetype='application/json')
+
+@app.route('/api/channels')
+def api_channels_handler():
+    """Canali del playlist combinato indicato da 'defs', a pagine (page, per_page, group opzionale)."""
+    status, result = channel_api_response('channels', request.args)
+    return Response(json.dumps(result), status=status, mimetype='application/json', headers={'Access-Control-Allow-Origin': '*'})
+
+@app.route('/api/groups')
+def api_groups_handler():
+    status, result = channel_api_response('groups', request.args)
+    return Response(json.dumps(result), status=status, mimetype='application/json', headers={'Access-Control-Allow-Origin': '*'})
+
+@app.route('/api/search')
+def api_search_handler():
+    """Ricerca per nome (parametro q, prefissi delle parole) nei canali di 'defs'."""
+    status, result = channel_api_response('search', request.args)
+    return Response(json.dumps(result), status=status, mimetype='application/json', headers={'Access-Control-Allow-Origin': '*'})
+
+@app.route('/metrics')
+def metrics_handler():
+    """Metriche per host upstream in formato Prometheus, sommate su tutti i worker."""
+    if upstream_metrics is None:
+        return "Metriche disattivate (METRICS_ENABLED=false)", 404
+    hosts, workers = upstream_metrics.aggregate()
+    return Response(render_prometheus_metrics(hosts, workers), mimetype='text/plain; version=0.0.4')
+
 @app.route('/') # Imposta /builder come pagina iniziale
 @app.route('/builder')
 def url_builder():
@@ -411,6 +4492,15 @@ def url_builder():
             </div>
 
             <button type="button" class="btn btn-add" onclick="addPlaylistEntry()">Aggiungi Playlist</button>
+
+            <div class="form-group" style="margin-top: 15px;">
+                <label for="dedup-mode">Rimuovi canali duplicati</label>
+                <select id="dedup-mode" style="padding: 10px; border: 1px solid #ccc; border-radius: 4px;">
+                    <option value="">No</option>
+                    <option value="url">Stesso URL</option>
+                    <option value="tvg_id">Stesso tvg-id</option>
+                </select>
+            </div>
             <hr style="margin: 20px 0;">
 
             <button type="button" class="btn" onclick="generateUrl()">Genera URL</button>
@@ -444,6 +4534,12 @@ def url_builder():
                     <label>URL della Playlist M3U</label>
                     <input type="url" class="playlist-url" placeholder="Es: http://provider.com/playlist.m3u">
                 </div>
+                <div class="form-group">
+                    <label>Filtri (opzionali)</label>
+                    <input type="text" class="filters" placeholder="Es: group=Sport,News|exclude_name=adult|type=m3u8">
+                    <small style="color: #6c757d; display: block; margin-top: 4px;">
+                        <b>group</b>, <b>tvg_id</b>, <b>name</b> (regex), <b>type</b> (m3u8, mpd, php, other); prefisso <b>exclude_</b> per escludere. Separati da |</small>
+                </div>
             </div>
         </template>
 
@@ -474,13 +4570,22 @@ def url_builder():
                     const dominio = entry.querySelector('.dominio').value.trim();
                     const password = entry.querySelector('.password').value.trim();
                     const playlistUrl = entry.querySelector('.playlist-url').value.trim();
+                    const filters = entry.querySelector('.filters').value.trim().replace(/^\\|+/, '');
 
                     if (dominio && playlistUrl) {
                         let credsPart = dominio;
                         if (password) {
                             credsPart += ':' + password;
                         }
-                        definitions.push(credsPart + '&' + playlistUrl);
+                        let definition = credsPart + '&' + playlistUrl;
+                        if (filters) {
+                            // Valori codificati: virgole e spazi nei nomi dei gruppi restano intatti
+                            definition += '|' + filters.split('|').filter(option => option.trim()).map(option => {
+                                const [key, ...value] = option.split('=');
+                                return key.trim() + '=' + encodeURIComponent(value.join('=').trim()).replace(/%2C/g, ',');
+                            }).join('|');
+                        }
+                        definitions.push(definition);
                     }
                 });
 
@@ -489,6 +4594,10 @@ def url_builder():
                     return;
                 }
 
+                const dedupMode = document.getElementById('dedup-mode').value;
+                if (dedupMode) {
+                    definitions.push('dedup=' + dedupMode);
+                }
                 const finalUrl = serverAddress + '/proxy?' + definitions.join(';');
                 document.getElementById('generated-url').textContent = finalUrl;
             }
@@ -511,15 +4620,625 @@ def url_builder():
     """
     return html_content
 
+# --- Modalità asincrona (aiohttp) ---
+# Stessa pipeline di /proxy (cache, circuit breaker, tempo massimo, metriche,
+# M3UChunkRewriter) con download non bloccanti: un worker non resta occupato
+# mentre attende upstream o client lenti. Avvio: ASYNC_SERVER=true python app.py
+# oppure gunicorn app:create_async_app --worker-class aiohttp.GunicornWebWorker
+
+_ASYNC_NETWORK_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError) if aiohttp is not None else ()
+# Client che chiude la connessione: errore in scrittura oppure cancellazione dell'handler
+_ASYNC_DISCONNECT_ERRORS = (ConnectionResetError, aiohttp.ClientConnectionError, asyncio.CancelledError) if aiohttp is not None else ()
+
+def _upstream_http_error(response):
+    # Stesso messaggio di requests.raise_for_status, così i marcatori di errore non cambiano
+    kind = 'Client' if response.status < 500 else 'Server'
+    return requests.HTTPError(f"{response.status} {kind} Error: {response.reason} for url: {response.url}")
+
+async def _send_upstream_request_async(session, url, headers, deadline):
+    connect_timeout, read_timeout = _upstream_timeout(deadline)
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=connect_timeout, sock_read=read_timeout)
+    return await asyncio.wait_for(
+        session.get(url, headers=headers, timeout=timeout, ssl=False), _remaining_time(deadline)
+    )
+
+def _close_losing_response_async(task):
+    if not task.cancelled() and task.exception() is None:
+        task.result().close()
+
+async def _hedged_upstream_request_async(session, url, headers, deadline):
+    """Versione asincrona di _hedged_upstream_request."""
+    primary = asyncio.ensure_future(_send_upstream_request_async(session, url, headers, deadline))
+    done, _ = await asyncio.wait({primary}, timeout=UPSTREAM_HEDGE_AFTER)
+    if done:
+        return primary.result()
+    remaining = _remaining_time(deadline)
+    if remaining is not None and remaining <= UPSTREAM_HEDGE_AFTER:
+        return await primary
+    log_sampled('upstream_hedge', logging.INFO, "🪃 Nessuna risposta da %s dopo %.1fs: richiesta duplicata", url, UPSTREAM_HEDGE_AFTER)
+    pending = {primary, asyncio.ensure_future(_send_upstream_request_async(session, url, headers, deadline))}
+    last_error = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            winner = None
+            for task in done:
+                try:
+                    response = task.result()
+                except _ASYNC_NETWORK_ERRORS as e:
+                    last_error = e
+                    continue
+                if winner is None:
+                    winner = response
+                else:
+                    response.close() # Risposte arrivate insieme: si tiene la prima
+            if winner is not None:
+                for other in pending:
+                    other.add_done_callback(_close_losing_response_async)
+                pending = set()
+                return winner
+    finally:
+        for task in pending:
+            task.cancel()
+    raise last_error
+
+async def open_upstream_response_async(session, url, headers, deadline=None):
+    """Versione asincrona di open_upstream_response (hedging e tentativi ripetuti)."""
+    attempts = 1 + max(0, UPSTREAM_RETRIES)
+    for attempt in range(attempts):
+        last_attempt = attempt == attempts - 1
+        try:
+            if UPSTREAM_HEDGE_AFTER > 0:
+                response = await _hedged_upstream_request_async(session, url, headers, deadline)
+            else:
+                response = await _send_upstream_request_async(session, url, headers, deadline)
+        except _ASYNC_NETWORK_ERRORS as e:
+            if last_attempt:
+                raise
+            error = str(e) or type(e).__name__
+        else:
+            if response.status < 500 or last_attempt:
+                return response
+            response.close()
+            error = f"HTTP {response.status}"
+        await asyncio.sleep(_retry_backoff(attempt, attempts, url, error, deadline))
+
+async def _upstream_cache_call(func, *args):
+    # Con lo spool su disco le operazioni della cache leggono e scrivono file: fuori dall'event loop
+    if upstream_cache.directory:
+        return await asyncio.to_thread(func, *args)
+    return func(*args)
+
+async def _iter_cache_entry_async(entry):
+    """Blocchi di una voce della cache; quelle su disco sono lette in un thread."""
+    chunks = entry.iter_chunks()
+    if entry.body is not None:
+        for chunk in chunks:
+            yield chunk
+        return
+    try:
+        while True:
+            chunk = await asyncio.to_thread(next, chunks, None)
+            if chunk is None:
+                break
+            yield chunk
+    finally:
+        await asyncio.to_thread(chunks.close)
+        entry.close() # Anche se la lettura non è mai iniziata
+
+async def _anext_or_none(iterator):
+    try:
+        return await iterator.__anext__()
+    except StopAsyncIteration:
+        return None
+
+async def fetch_upstream_chunks_async(session, url, timing=None, deadline=None):
+    """Versione asincrona di fetch_upstream_chunks (stessa cache e stesso circuit breaker)."""
+    started_at = time.monotonic()
+    entry = await _upstream_cache_call(upstream_cache.lookup, url) if upstream_cache is not None else None
+    if _serve_cached_entry(url, entry):
+        async for chunk in _iter_cache_entry_async(entry):
+            yield chunk
+        return
+
+    host = _upstream_host(url)
+
+    # Posto tra i download upstream del worker, tenuto fino alla fine del corpo
+    if upstream_admission is not None:
+        await upstream_admission.acquire_async()
+    try:
+        try:
+            response = await open_upstream_response_async(session, url, _upstream_request_headers(entry), deadline)
+        except _ASYNC_NETWORK_ERRORS:
+            _record_upstream_failure(host)
+            raise
+        writer = None
+        try:
+            if timing is not None:
+                timing['connect'] = time.monotonic() - started_at
+            logger.info("Status code %s da %s", response.status, url)
+            _record_upstream_status(host, response.status)
+            if response.status == 304 and entry is not None:
+                await _upstream_cache_call(_revalidate_cached_entry, url, entry)
+                async for chunk in _iter_cache_entry_async(entry):
+                    yield chunk
+                return
+            if response.status >= 400:
+                raise _upstream_http_error(response)
+
+            if upstream_cache is not None:
+                upstream_cache.count('misses')
+                writer = await _upstream_cache_call(upstream_cache.writer, url, response.headers)
+            # Corpo già decompresso da aiohttp (gzip, deflate e br se è installato brotli)
+            async for chunk in response.content.iter_chunked(UPSTREAM_CHUNK_SIZE):
+                if deadline is not None and time.monotonic() > deadline:
+                    raise DeadlineExceeded(f"Tempo massimo della richiesta esaurito durante il download da {host}")
+                if writer is not None:
+                    await _upstream_cache_call(writer.write, chunk)
+                yield chunk
+            if writer is not None:
+                await _upstream_cache_call(writer.commit)
+                writer = None
+        except _ASYNC_NETWORK_ERRORS:
+            _record_upstream_failure(host)
+            raise
+        finally:
+            if writer is not None:
+                await _upstream_cache_call(writer.discard)
+            response.release()
+    finally:
+        if entry is not None:
+            entry.close()
+        if upstream_admission is not None:
+            upstream_admission.release()
+
+async def download_m3u_playlist_chunks_async(session, url, timing=None, deadline=None):
+    """Versione asincrona di download_m3u_playlist_chunks (stessi messaggi di errore)."""
+    try:
+        logger.info("Scaricamento (streaming) da: %s", url)
+        async for chunk in fetch_upstream_chunks_async(session, url, timing, deadline):
+            yield chunk
+    except (requests.RequestException, aiohttp.ClientError) as e:
+        logger.error("Errore download (streaming): %s", e)
+        raise Exception(f"Errore nel download (streaming) della playlist: {str(e)}")
+    except asyncio.TimeoutError:
+        logger.error("Errore download (streaming): timeout da %s", url)
+        raise Exception(f"Errore nel download (streaming) della playlist: timeout dell'upstream {url}")
+    except (UpstreamUnavailable, DeadlineExceeded, AdmissionRejected) as e:
+        logger.warning("⏭️ Playlist saltata %s: %s", url, e)
+        raise
+    except Exception as e:
+        logger.error("Errore generico durante lo streaming del download da %s: %s", url, e)
+        raise
+
+async def open_playlist_segment_async(session, base_url, api_password, playlist_url, timing=None, deadline=None, options=None, deduplicator=None):
+    """
+    Versione asincrona di open_playlist_segment: stesse misure (PlaylistSegmentMeter);
+    la riscrittura gira nel thread pool dell'event loop, che intanto serve le altre richieste.
+    """
+    rewriter = create_playlist_rewriter(base_url, api_password, options, deduplicator)
+    meter = PlaylistSegmentMeter(playlist_url, timing)
+    loop = asyncio.get_running_loop()
+    rewrite_time = 0.0
+    failed = False
+    upstream = download_m3u_playlist_chunks_async(session, playlist_url, meter.fetch_timing, deadline)
+    try:
+        while True:
+            wait_started = time.monotonic()
+            chunk = await _anext_or_none(upstream)
+            meter.received(chunk, wait_started)
+            rewrite_started = time.monotonic()
+            if chunk is None:
+                rewritten = await loop.run_in_executor(None, rewriter.flush)
+            else:
+                rewritten = await loop.run_in_executor(None, rewriter.feed, chunk)
+            rewrite_time += time.monotonic() - rewrite_started
+            if rewritten:
+                yield rewritten
+            if chunk is None:
+                break
+        logger.info("✅ Riscrittura completata: %s", rewriter.summary())
+    except Exception:
+        failed = True
+        raise
+    finally:
+        await upstream.aclose()
+        meter.finish(rewrite_time, rewriter.rules.hits, failed)
+
+class AsyncPlaylistPrefetcher:
+    """
+    Versione asincrona di PlaylistPrefetcher: un task per playlist (al massimo
+    PARALLEL_DOWNLOADS_WORKERS attivi) con una coda limitata ciascuno.
+    """
+
+    def __init__(self, session, segments, timings=None, deadline=None):
+        max_chunks = max(1, PARALLEL_DOWNLOADS_BUFFER_BYTES // UPSTREAM_CHUNK_SIZE)
+        timings = timings or {}
+        self._slots = asyncio.Semaphore(max(1, PARALLEL_DOWNLOADS_WORKERS))
+        self._buffers = {}
+        self._tasks = []
+        for definition_idx, segment in segments.items():
+            buffer = asyncio.Queue(maxsize=max_chunks)
+            self._buffers[definition_idx] = buffer
+            self._tasks.append(asyncio.ensure_future(
+                self._produce(session, buffer, *segment, timings.get(definition_idx), deadline)
+            ))
+
+    async def _produce(self, session, buffer, base_url, api_password, playlist_url, options, timing, deadline):
+        async with self._slots:
+            segment = open_playlist_segment_async(session, base_url, api_password, playlist_url, timing, deadline, options)
+            try:
+                async for chunk in segment:
+                    await buffer.put(chunk) # Coda piena: il download attende il consumatore
+                await buffer.put(_PREFETCH_DONE)
+            except Exception as e:
+                await buffer.put(e)
+            finally:
+                await segment.aclose()
+
+    async def chunks(self, definition_idx):
+        buffer = self._buffers[definition_idx]
+        while True:
+            item = await buffer.get()
+            if item is _PREFETCH_DONE:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def close(self):
+        for task in self._tasks:
+            task.cancel()
+
+async def generate_combined_playlist_async(session, playlist_definitions, stats=None, trace=None):
+    """Versione asincrona di generate_combined_playlist: stesso output (CombinedPlaylistMerge), blocco per blocco."""
+    merge = CombinedPlaylistMerge(playlist_definitions, stats, trace)
+    parsed_definitions = merge.parsed_definitions
+
+    prefetcher = None
+    if PARALLEL_DOWNLOADS and merge.deduplicator is None and len(parsed_definitions) > 1:
+        logger.info("⚡ Download paralleli attivi per %s playlist (max %s contemporanei)", len(parsed_definitions), PARALLEL_DOWNLOADS_WORKERS)
+        prefetcher = AsyncPlaylistPrefetcher(session, parsed_definitions, merge.timings, merge.deadline)
+
+    try:
+        for definition_idx, definition in enumerate(merge.playlist_definitions):
+            if definition_idx not in parsed_definitions:
+                yield merge.skipped(definition_idx, definition)
+                continue
+
+            base_url_part, api_password, playlist_url_str, options = parsed_definitions[definition_idx]
+            logger.info("[%s] Processing Playlist (streaming, async): %s", definition_idx, playlist_url_str)
+
+            merge.start_playlist()
+            if prefetcher is not None:
+                rewritten_chunks_iter = prefetcher.chunks(definition_idx)
+            else:
+                rewritten_chunks_iter = open_playlist_segment_async(
+                    session, base_url_part, api_password, playlist_url_str, merge.timings.get(definition_idx), merge.deadline, options, merge.deduplicator
+                )
+            try:
+                async for chunk in rewritten_chunks_iter:
+                    chunk = merge.accept(definition_idx, chunk)
+                    if not chunk:
+                        continue
+                    if trace is None:
+                        yield chunk
+                    else:
+                        write_started = time.monotonic()
+                        yield chunk
+                        trace.add(definition_idx, 'write', time.monotonic() - write_started)
+
+            except Exception as e:
+                yield merge.failed(definition_idx, playlist_url_str, e)
+            finally:
+                await rewritten_chunks_iter.aclose()
+
+            merge.finish_playlist(definition_idx, playlist_url_str)
+
+        for chunk in merge.trailer():
+            yield chunk
+    finally:
+        if prefetcher is not None:
+            prefetcher.close()
+
+if aiohttp is not None:
+    class SpooledFileResponse(web.FileResponse):
+        """
+        FileResponse (Range, sendfile) con l'ETag dello spool al posto di quello
+        basato su mtime e dimensione; request_headers sostituiscono gli header
+        della richiesta (condizioni già valutate da _spooled_response).
+        """
+
+        def __init__(self, path, etag, request_headers, **kwargs):
+            super().__init__(path, **kwargs)
+            self._spool_etag = etag
+            self._request_headers = request_headers
+
+        async def prepare(self, request):
+            return await super().prepare(request.clone(headers=self._request_headers))
+
+        @property
+        def etag(self):
+            return web.FileResponse.etag.fget(self)
+
+        @etag.setter
+        def etag(self, value):
+            self.headers['ETag'] = self._spool_etag
+
+class AsyncProxyServer:
+    """
+    Applicazione aiohttp con le stesse route della versione Flask (/proxy, /epg,
+    /builder, /metrics, /stats/upstream). Le scritture verso il client
+    attendono lo svuotamento del buffer di invio: con un client lento il
+    download upstream si ferma (backpressure) invece di accumulare memoria.
+    """
+
+    def __init__(self):
+        self.session = None
+
+    async def _session_context(self, async_app):
+        connector = aiohttp.TCPConnector(
+            limit=ASYNC_UPSTREAM_CONNECTIONS,
+            use_dns_cache=UPSTREAM_DNS_CACHE_TTL > 0,
+            ttl_dns_cache=UPSTREAM_DNS_CACHE_TTL or None,
+        )
+        self.session = aiohttp.ClientSession(connector=connector)
+        yield
+        await self.session.close()
+
+    async def proxy(self, request):
+        query_string = request.rel_url.raw_query_string
+        logger.info("=== Richiesta /proxy (async) === Query string: %s", query_string)
+        if not query_string:
+            return web.Response(text="Query string mancante", status=400)
+
+        # Le operazioni sullo spool (file e directory) avvengono fuori dall'event loop
+        if merged_spool is not None:
+            spooled = await asyncio.to_thread(merged_spool.lookup, query_string)
+            if spooled is not None:
+                return await self._spooled_response(request, spooled)
+
+        if merge_admission is not None:
+            try:
+                await merge_admission.acquire_async()
+            except AdmissionRejected as e:
+                return self._admission_rejected(e)
+
+        playlist_definitions = query_string.split(';')
+        trace = RequestTrace() if REQUEST_TIMING else None
+        stats = {'errors': 0}
+        body = generate_combined_playlist_async(self.session, playlist_definitions, stats=stats, trace=trace)
+        spool_writer = await asyncio.to_thread(merged_spool.writer, query_string) if merged_spool is not None else None
+        try:
+            # Come in /proxy: il primo blocco viene prodotto prima degli header
+            chunk = await _anext_or_none(body)
+            response = web.StreamResponse(headers={
+                'Content-Disposition': 'attachment; filename="playlist.m3u"',
+                'Access-Control-Allow-Origin': '*',
+                'Vary': 'Accept-Encoding',
+            })
+            response.content_type = 'application/vnd.apple.mpegurl'
+            if trace is not None:
+                response.headers['Server-Timing'] = trace.server_timing_header()
+            encoding = negotiate_response_encoding(parse_accept_header(request.headers.get('Accept-Encoding')))
+            compressor = None
+            if encoding is not None:
+                compressor = StreamCompressor(encoding)
+                response.headers['Content-Encoding'] = encoding
+            if spool_writer is not None:
+                response.headers['ETag'] = spool_stream_etag(spool_writer.tag, encoding)
+        except Exception as e:
+            await body.aclose()
+            if spool_writer is not None:
+                await asyncio.to_thread(merged_spool.abort, spool_writer)
+            if merge_admission is not None:
+                merge_admission.release()
+            logger.exception("ERRORE GENERALE: %s", e)
+            return web.Response(text=f"Errore: {str(e)}", status=500)
+
+        try:
+            await response.prepare(request)
+            while chunk is not None:
+                if spool_writer is not None:
+                    await asyncio.to_thread(spool_writer.write, chunk)
+                data = compressor.compress(chunk) if compressor is not None else chunk
+                if data:
+                    await response.write(data) # Attende il client se il buffer di invio è pieno
+                chunk = await _anext_or_none(body)
+            if trace is not None:
+                logger.info("⏱️ Tempi /proxy: %s", trace.server_timing_header())
+                if REQUEST_TIMING:
+                    data = trace.comment_lines()
+                    data = compressor.compress(data) if compressor is not None else data
+                    await response.write(data)
+            if compressor is not None:
+                await response.write(compressor.finish())
+            if spool_writer is not None:
+                await asyncio.to_thread(merged_spool.finish, spool_writer, stats)
+                spool_writer = None
+            await response.write_eof()
+        except _ASYNC_DISCONNECT_ERRORS as e:
+            logger.info("🔌 Client disconnesso durante lo streaming di /proxy")
+            if spool_writer is not None:
+                # Il playlist viene completato in background per lo spool
+                asyncio.ensure_future(self._drain_to_spool(spool_writer, body, stats))
+                spool_writer = body = None
+            if isinstance(e, asyncio.CancelledError):
+                raise
+        finally:
+            if spool_writer is not None:
+                await asyncio.to_thread(merged_spool.abort, spool_writer)
+            if body is not None:
+                await body.aclose()
+                # Con il completamento in background il posto viene liberato da _drain_to_spool
+                if merge_admission is not None:
+                    merge_admission.release()
+        return response
+
+    async def _drain_to_spool(self, spool_writer, body, stats):
+        try:
+            # L'ultimo blocco letto è già nello spool: si prosegue dal successivo
+            async for chunk in body:
+                await asyncio.to_thread(spool_writer.write, chunk)
+        except Exception as e:
+            logger.warning("⚠️ Generazione in background per lo spool interrotta: %s", e)
+            await asyncio.to_thread(merged_spool.abort, spool_writer)
+            return
+        finally:
+            await body.aclose()
+            if merge_admission is not None:
+                merge_admission.release()
+        logger.info("💾 Spool completato in background: %s", spool_writer.key[:100])
+        await asyncio.to_thread(merged_spool.finish, spool_writer, stats)
+
+    async def _spooled_response(self, request, spooled):
+        # Come send_spooled_playlist: ETag dello spool (If-None-Match / If-Range) e Range solo sul file originale
+        accept_encodings = parse_accept_header(request.headers.get('Accept-Encoding'))
+        ranged = 'Range' in request.headers
+        path, encoding = await asyncio.to_thread(spooled_playlist_variant, spooled, accept_encodings, ranged)
+        etag = f'"{spooled.etag(encoding)}"'
+        logger.info("💾 /proxy servito dallo spool (async): %s (%s, Range: %s)", spooled.digest[:16], encoding or 'identity', request.headers.get('Range', '-'))
+        headers = {
+            'Content-Type': 'application/vnd.apple.mpegurl',
+            'Content-Disposition': 'attachment; filename="playlist.m3u"',
+            'Access-Control-Allow-Origin': '*',
+            'Vary': 'Accept-Encoding',
+            'X-Spool': 'HIT',
+        }
+        if_none_match = request.headers.get('If-None-Match')
+        if if_none_match is not None:
+            candidates = {tag.strip().removeprefix('W/') for tag in if_none_match.split(',')}
+            if etag in candidates or '*' in candidates:
+                return web.Response(status=304, headers={**headers, 'ETag': etag})
+        # I controlli condizionali di FileResponse usano mtime e dimensione: la richiesta
+        # vista da FileResponse contiene solo il Range da applicare, se ancora valido
+        forwarded = {name: value for name, value in request.headers.items() if name.lower() not in (
+            'if-none-match', 'if-modified-since', 'if-match', 'if-unmodified-since', 'if-range', 'range', 'accept-encoding'
+        )}
+        if ranged and request.headers.get('If-Range', etag) == etag:
+            forwarded['Range'] = request.headers['Range']
+        forwarded['Accept-Encoding'] = 'identity' # Il file da inviare è già stato scelto
+        if encoding is not None:
+            headers['Content-Encoding'] = encoding
+        return SpooledFileResponse(path, etag, forwarded, headers=headers)
+
+    async def builder(self, request):
+        return web.Response(text=url_builder(), content_type='text/html')
+
+    async def metrics(self, request):
+        if upstream_metrics is None:
+            return web.Response(text="Metriche disattivate (METRICS_ENABLED=false)", status=404)
+        # Legge gli snapshot di tutti i worker dal disco
+        hosts, workers = await asyncio.to_thread(upstream_metrics.aggregate)
+        return web.Response(
+            body=render_prometheus_metrics(hosts, workers).encode('utf-8'),
+            headers={'Content-Type': 'text/plain; version=0.0.4'}
+        )
+
+    async def stats(self, request):
+        return web.json_response(collect_upstream_stats(), dumps=lambda data: json.dumps(data, indent=2))
+
+    async def epg(self, request):
+        query_string = request.rel_url.raw_query_string
+        logger.info("=== Richiesta /epg (async) === Query string: %s", query_string)
+        if not query_string:
+            return web.Response(text="Query string mancante", status=400)
+        if merge_admission is not None:
+            try:
+                await merge_admission.acquire_async()
+            except AdmissionRejected as e:
+                return self._admission_rejected(e)
+        # Download e parsing XMLTV sono sincroni: ogni blocco è prodotto in un thread
+        body = generate_epg(query_string.split(';'))
+        response = web.StreamResponse(headers={
+            'Content-Disposition': 'attachment; filename="epg.xml"',
+            'Access-Control-Allow-Origin': '*',
+            'Vary': 'Accept-Encoding',
+        })
+        response.content_type = 'application/xml'
+        encoding = negotiate_response_encoding(parse_accept_header(request.headers.get('Accept-Encoding')))
+        compressor = None
+        if encoding is not None:
+            compressor = StreamCompressor(encoding)
+            response.headers['Content-Encoding'] = encoding
+        try:
+            await response.prepare(request)
+            while True:
+                chunk = await asyncio.to_thread(next, body, None)
+                if chunk is None:
+                    break
+                data = compressor.compress(chunk) if compressor is not None else chunk
+                if data:
+                    await response.write(data)
+            if compressor is not None:
+                await response.write(compressor.finish())
+            await response.write_eof()
+        except _ASYNC_DISCONNECT_ERRORS as e:
+            logger.info("🔌 Client disconnesso durante lo streaming di /epg")
+            if isinstance(e, asyncio.CancelledError):
+                raise
+        finally:
+            await asyncio.to_thread(body.close)
+            if merge_admission is not None:
+                merge_admission.release()
+        return response
+
+    @staticmethod
+    def _admission_rejected(error):
+        return web.Response(
+            text=admission_rejected_message(error), status=429,
+            headers={'Retry-After': str(ADMISSION_RETRY_AFTER)}
+        )
+
+    def channel_api(self, action):
+        async def handler(request):
+            # SQLite e l'eventuale prima costruzione del dataset girano fuori dall'event loop
+            status, result = await asyncio.to_thread(channel_api_response, action, request.query)
+            return web.json_response(result, status=status, headers={'Access-Control-Allow-Origin': '*'})
+        return handler
+
+    def create_app(self):
+        async_app = web.Application()
+        async_app.cleanup_ctx.append(self._session_context)
+        async_app.router.add_get('/proxy', self.proxy)
+        async_app.router.add_get('/', self.builder)
+        async_app.router.add_get('/builder', self.builder)
+        async_app.router.add_get('/metrics', self.metrics)
+        async_app.router.add_get('/stats/upstream', self.stats)
+        async_app.router.add_get('/epg', self.epg)
+        for action in ('channels', 'groups', 'search'):
+            async_app.router.add_get(f'/api/{action}', self.channel_api(action))
+        return async_app
+
+async def create_async_app():
+    """Factory dell'applicazione aiohttp (anche per gunicorn con aiohttp.GunicornWebWorker)."""
+    if aiohttp is None:
+        raise RuntimeError("Modalità asincrona non disponibile: installare aiohttp")
+    if PROXY_COALESCING:
+        # La coalescenza usa thread e generatori sincroni (MergedPlaylistFlight): non disponibile qui
+        raise RuntimeError("PROXY_COALESCING non è supportato in modalità asincrona: disattivarlo o usare il server sincrono")
+    return AsyncProxyServer().create_app()
+
 if __name__ == '__main__':
     # Gestione della porta tramite variabile d'ambiente
     PORT = int(os.environ.get('PORT', 7860))
     
-    print("Avvio del server proxy M3U...")
-    print(f"Formato URL per singola playlist (esempio): http://localhost:{PORT}/proxy?https://mfp.com:pass123&http://provider.com/playlist.m3u")
-    print(f"Formato URL per multiple playlist (esempio misto): http://localhost:{PORT}/proxy?https://dom1.com:pass1&url1.m3u;https://dom2.com&url2.m3u")
-    print(f"Server in ascolto sulla porta: {PORT}")
+    logger.info("Avvio del server proxy M3U...")
+    logger.info("Formato URL per singola playlist (esempio): http://localhost:%s/proxy?https://mfp.com:pass123&http://provider.com/playlist.m3u", PORT)
+    logger.info("Formato URL per multiple playlist (esempio misto): http://localhost:%s/proxy?https://dom1.com:pass1&url1.m3u;https://dom2.com&url2.m3u", PORT)
+    logger.info("Server in ascolto sulla porta: %s", PORT)
     # Rimosso print per /test
+    start_shard_executor() # Pool di riscrittura pronto prima delle richieste (se attivo)
     
     # Avvia il server
-    app.run(host='0.0.0.0', port=PORT, debug=False)
+    if ASYNC_SERVER:
+        if aiohttp is None:
+            logger.error("ASYNC_SERVER richiede aiohttp (pip install aiohttp)")
+            sys.exit(1)
+        if PROXY_COALESCING:
+            logger.error("ASYNC_SERVER e PROXY_COALESCING non possono essere attivi insieme")
+            sys.exit(1)
+        logger.info("⚡ Modalità asincrona (aiohttp) attiva")
+        web.run_app(create_async_app(), host='0.0.0.0', port=PORT, access_log=None, print=None)
+    else:
+        app.run(host='0.0.0.0', port=PORT, debug=False)
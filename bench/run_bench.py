@@ -0,0 +1,251 @@
+"""
+Benchmark del proxy M3U: microbenchmark delle funzioni di riscrittura e
+download, più test end-to-end di /proxy con più playlist e client concorrenti
+contro un upstream simulato locale.
+
+I risultati (linee/s, MB/s, latenze p50/p99, picco RSS cumulativo del processo
+per i microbenchmark, del server per l'end-to-end) vengono salvati in
+JSON; con --compare si confrontano con un'esecuzione precedente.
+
+Esempi:
+    python bench/run_bench.py
+    python bench/run_bench.py --entries 200000 --clients 16 --output /tmp/after.json --compare /tmp/before.json
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import socket
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+os.environ.setdefault('LOG_LEVEL', 'WARNING') # I log per richiesta falserebbero le misure
+
+from synthetic import generate_playlist
+from upstream_server import start_upstream_server
+
+import app as proxy_app
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+def peak_rss_mb(pid=None):
+    """Picco di memoria residente (VmHWM) del processo, in MB."""
+    if pid is None:
+        # ru_maxrss è in KB su Linux, in byte su macOS
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss / (1024 * 1024) if sys.platform == 'darwin' else maxrss / 1024
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+def summarize(durations, lines, size_bytes):
+    """Statistiche di una serie di esecuzioni con lo stesso input."""
+    total = sum(durations)
+    return {
+        'runs': len(durations),
+        'lines_per_sec': round(lines * len(durations) / total) if total else None,
+        'mb_per_sec': round(size_bytes * len(durations) / total / (1024 * 1024), 2) if total else None,
+        'p50_ms': round(percentile(durations, 50) * 1000, 2),
+        'p99_ms': round(percentile(durations, 99) * 1000, 2),
+    }
+
+def time_runs(func, repeat):
+    durations = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - started)
+    return durations
+
+def run_microbenchmarks(playlist, upstream_url, repeat):
+    lines = playlist.count(b'\n')
+    text = playlist.decode('utf-8')
+    text_lines = text.splitlines(keepends=True)
+    chunk_size = proxy_app.UPSTREAM_CHUNK_SIZE
+    chunks = [playlist[offset:offset + chunk_size] for offset in range(0, len(playlist), chunk_size)]
+    base_url, api_password = 'http://mfp.example.com', 'benchpass'
+
+    benchmarks = {
+        'rewrite_m3u_links': lambda: proxy_app.rewrite_m3u_links(text, base_url, api_password),
+        'rewrite_m3u_links_streaming': lambda: sum(
+            1 for _ in proxy_app.rewrite_m3u_links_streaming(iter(text_lines), base_url, api_password)
+        ),
+        'rewrite_m3u_chunks': lambda: sum(
+            len(chunk) for chunk in proxy_app.rewrite_m3u_chunks(iter(chunks), base_url, api_password)
+        ),
+        'download_m3u_playlist_streaming': lambda: sum(
+            1 for _ in proxy_app.download_m3u_playlist_streaming(upstream_url)
+        ),
+    }
+    results = {}
+    for name, func in benchmarks.items():
+        func() # Riscaldamento (connessioni, cache delle regex)
+        results[name] = summarize(time_runs(func, repeat), lines, len(playlist))
+        # ru_maxrss è cumulativo: picco del processo fino a questo benchmark (compresi i
+        # precedenti e il playlist in memoria), non la memoria del singolo benchmark
+        results[name]['cumulative_peak_rss_mb'] = round(peak_rss_mb(), 1)
+        print(f"  {name}: {results[name]}")
+    return results
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def start_proxy_server(server_cmd, port):
+    """Avvia il proxy in un processo separato e attende che accetti connessioni."""
+    env = dict(os.environ, PORT=str(port))
+    cmd = server_cmd.format(port=port, python=sys.executable).split() if server_cmd else [sys.executable, os.path.join(REPO_DIR, 'app.py')]
+    process = subprocess.Popen(cmd, cwd=REPO_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError(f"Il proxy non risponde sulla porta {port}: {cmd}")
+
+def run_end_to_end(upstream_base, args):
+    import requests
+
+    port = _free_port()
+    process = start_proxy_server(args.server_cmd, port)
+    try:
+        definitions = []
+        for idx in range(args.playlists):
+            upstream_url = (f"{upstream_base}/playlist.m3u?entries={args.entries}&tag=p{idx}"
+                            f"&directive_density={args.directive_density}&exthttp_ratio={args.exthttp_ratio}"
+                            f"&latency={args.latency}&bandwidth={args.bandwidth}&fail_rate={args.fail_rate}")
+            definitions.append(f"http://mfp.example.com:benchpass&{upstream_url}")
+        proxy_url = f"http://127.0.0.1:{port}/proxy?" + ';'.join(definitions)
+        # requests chiede gzip di default: senza --accept-encoding si misura la risposta non compressa
+        headers = {'Accept-Encoding': args.accept_encoding or 'identity'}
+
+        def one_request(_):
+            started = time.perf_counter()
+            size = lines = 0
+            with requests.get(proxy_url, headers=headers, stream=True, timeout=300) as response:
+                for chunk in response.raw.stream(64 * 1024, decode_content=False):
+                    size += len(chunk)
+                    lines += chunk.count(b'\n')
+                encoded = 'Content-Encoding' in response.headers
+            return time.perf_counter() - started, size, None if encoded else lines, response.status_code
+
+        one_request(None) # Riscaldamento
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.clients) as pool:
+            results = list(pool.map(one_request, range(args.clients * args.requests_per_client)))
+        wall_time = time.perf_counter() - started
+
+        latencies = [duration for duration, _, _, _ in results]
+        total_bytes = sum(size for _, size, _, _ in results)
+        if all(lines is not None for _, _, lines, _ in results):
+            total_lines = sum(lines for _, _, lines, _ in results)
+        else: # Risposta compressa: stima dal playlist sintetico
+            total_lines = len(results) * args.playlists * generate_playlist(args.entries, args.directive_density, args.exthttp_ratio).count(b'\n')
+        summary = {
+            'requests': len(results),
+            'clients': args.clients,
+            'errors': sum(1 for _, _, _, status in results if status != 200),
+            'wall_time_s': round(wall_time, 3),
+            'requests_per_sec': round(len(results) / wall_time, 2),
+            'lines_per_sec': round(total_lines / wall_time),
+            'mb_per_sec': round(total_bytes / wall_time / (1024 * 1024), 2),
+            'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+            'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+            'server_peak_rss_mb': round(peak_rss_mb(process.pid) or 0, 1),
+        }
+        print(f"  /proxy: {summary}")
+        return summary
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+def compare(current, baseline_path):
+    """Stampa la variazione percentuale rispetto a un risultato precedente."""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    print(f"\nConfronto con {baseline_path}:")
+    for section in ('micro', 'end_to_end'):
+        current_section = current.get(section) or {}
+        baseline_section = baseline.get(section) or {}
+        if section == 'end_to_end':
+            current_section, baseline_section = {'/proxy': current_section}, {'/proxy': baseline_section}
+        for name, metrics in current_section.items():
+            for metric in ('lines_per_sec', 'mb_per_sec', 'p50_ms', 'p99_ms'):
+                old, new = baseline_section.get(name, {}).get(metric), metrics.get(metric)
+                if old and new:
+                    print(f"  {name:32} {metric:14} {old:>12} -> {new:>12} ({(new - old) / old * 100:+.1f}%)")
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark del proxy M3U')
+    parser.add_argument('--entries', type=int, default=50000, help='Canali per playlist')
+    parser.add_argument('--directive-density', type=float, default=0.3)
+    parser.add_argument('--exthttp-ratio', type=float, default=0.3)
+    parser.add_argument('--repeat', type=int, default=5, help='Ripetizioni dei microbenchmark')
+    parser.add_argument('--playlists', type=int, default=4, help='Playlist per richiesta /proxy')
+    parser.add_argument('--clients', type=int, default=4, help='Client concorrenti')
+    parser.add_argument('--requests-per-client', type=int, default=3)
+    parser.add_argument('--latency', type=float, default=0.1, help='Latenza simulata degli upstream (s)')
+    parser.add_argument('--bandwidth', type=int, default=0, help='Banda per upstream in byte/s (0 = illimitata)')
+    parser.add_argument('--fail-rate', type=float, default=0.0)
+    parser.add_argument('--accept-encoding', default='', help='Accept-Encoding dei client (es. gzip)')
+    parser.add_argument('--server-cmd', default='',
+                        help='Comando per avviare il proxy, es. "gunicorn -c gunicorn.conf.py --bind 127.0.0.1:{port} app:app"')
+    parser.add_argument('--skip-micro', action='store_true')
+    parser.add_argument('--skip-e2e', action='store_true')
+    parser.add_argument('--output', default=os.path.join(BENCH_DIR, 'results', time.strftime('%Y%m%d-%H%M%S') + '.json'))
+    parser.add_argument('--compare', help='JSON di un risultato precedente')
+    args = parser.parse_args()
+
+    upstream_server, upstream_base = start_upstream_server()
+    playlist = generate_playlist(args.entries, args.directive_density, args.exthttp_ratio)
+    results = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'params': vars(args),
+        'playlist': {'entries': args.entries, 'lines': playlist.count(b'\n'), 'bytes': len(playlist)},
+    }
+    print(f"Playlist sintetico: {args.entries} canali, {len(playlist) / (1024 * 1024):.1f} MB")
+
+    if not args.skip_micro:
+        print("Microbenchmark:")
+        micro_url = (f"{upstream_base}/playlist.m3u?entries={args.entries}"
+                     f"&directive_density={args.directive_density}&exthttp_ratio={args.exthttp_ratio}")
+        results['micro'] = run_microbenchmarks(playlist, micro_url, args.repeat)
+    if not args.skip_e2e:
+        print("End-to-end:")
+        results['end_to_end'] = run_end_to_end(upstream_base, args)
+    upstream_server.shutdown()
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"\nRisultati salvati in {args.output}")
+    if args.compare:
+        compare(results, args.compare)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""
+Generatore di playlist M3U sintetiche per i benchmark.
+
+Uso da riga di comando:
+    python bench/synthetic.py --entries 200000 --output /tmp/playlist.m3u
+"""
+import argparse
+import json
+import random
+
+HOSTS = ['cdn.example.com', 'vavoo.to', 'vixsrc.to', 'live.provider.tv', 'edge1.stream.net']
+EXTENSIONS = ['.m3u8', '.mpd', '.php', '.ts']
+GROUPS = ['Sport', 'News', 'Cinema', 'Kids', 'Music', 'Documentari', 'Serie TV', 'Intrattenimento']
+
+def generate_playlist(entries=10000, directive_density=0.3, exthttp_ratio=0.3,
+                      url_length=80, name_length=20, seed=0, tag='ch'):
+    """
+    Restituisce il playlist come bytes.
+    - directive_density: frazione di canali con direttive header prima dell'URL
+    - exthttp_ratio: tra i canali con direttive, frazione che usa #EXTHTTP invece di #EXTVLCOPT
+    - url_length / name_length: lunghezza (circa) di URL e nomi canale
+    """
+    rng = random.Random(seed)
+    lines = ['#EXTM3U x-tvg-url="http://epg.example.com/guide.xml.gz"']
+    for idx in range(entries):
+        group = rng.choice(GROUPS)
+        name = f"{tag} {idx} " + 'x' * max(0, name_length - len(f"{tag} {idx} "))
+        lines.append(
+            f'#EXTINF:-1 tvg-id="{tag}{idx}.example" tvg-name="{name}" '
+            f'tvg-logo="http://logo.example.com/{idx}.png" group-title="{group}",{name}'
+        )
+        if rng.random() < directive_density:
+            if rng.random() < exthttp_ratio:
+                lines.append('#EXTHTTP:' + json.dumps({'User-Agent': 'Mozilla/5.0', 'Referer': f'https://{rng.choice(HOSTS)}/'}))
+            else:
+                lines.append('#EXTVLCOPT:http-user-agent=Mozilla/5.0 (SMART-TV)')
+                lines.append(f'#EXTVLCOPT:http-referrer=https://{rng.choice(HOSTS)}/')
+        url = f"http://{rng.choice(HOSTS)}/live/{tag}/{idx}/"
+        url += 'p' * max(0, url_length - len(url) - 16)
+        url += f"/index{rng.choice(EXTENSIONS)}?t={idx % 97}"
+        lines.append(url)
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+def main():
+    parser = argparse.ArgumentParser(description='Genera un playlist M3U sintetico')
+    parser.add_argument('--entries', type=int, default=10000)
+    parser.add_argument('--directive-density', type=float, default=0.3)
+    parser.add_argument('--exthttp-ratio', type=float, default=0.3)
+    parser.add_argument('--url-length', type=int, default=80)
+    parser.add_argument('--name-length', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', required=True)
+    args = parser.parse_args()
+
+    data = generate_playlist(args.entries, args.directive_density, args.exthttp_ratio,
+                             args.url_length, args.name_length, args.seed)
+    with open(args.output, 'wb') as f:
+        f.write(data)
+    print(f"Scritti {len(data)} byte ({args.entries} canali) in {args.output}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""
+Server HTTP locale che simula i provider upstream.
+
+Ogni richiesta genera (e mette in cache) un playlist sintetico; il
+comportamento si controlla con i parametri della query:
+    entries, directive_density, exthttp_ratio, seed, tag  -> contenuto
+    latency       secondi di attesa prima della risposta
+    bandwidth     byte/secondo massimi in invio (0 = illimitato)
+    fail_rate     probabilità di rispondere 500
+    gzip=1        comprime il corpo se il client accetta gzip
+
+Uso da riga di comando:
+    python bench/upstream_server.py --port 8900
+"""
+import argparse
+import gzip
+import random
+import threading
+import time
+import urllib.parse
+import zlib
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from synthetic import generate_playlist
+
+@lru_cache(maxsize=32)
+def _playlist(entries, directive_density, exthttp_ratio, seed, tag, compressed):
+    body = generate_playlist(entries, directive_density, exthttp_ratio, seed=seed, tag=tag)
+    return gzip.compress(body, 6) if compressed else body
+
+class UpstreamHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        params = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+
+        def param(name, default, cast):
+            return cast(params[name][0]) if name in params else default
+
+        time.sleep(param('latency', 0.0, float))
+        if random.random() < param('fail_rate', 0.0, float):
+            self.send_response(500)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        compressed = param('gzip', 0, int) == 1 and 'gzip' in (self.headers.get('Accept-Encoding') or '')
+        body = _playlist(param('entries', 1000, int), param('directive_density', 0.3, float),
+                         param('exthttp_ratio', 0.3, float), param('seed', 0, int),
+                         param('tag', 'ch', str), compressed)
+        etag = f'"{zlib.crc32(body):08x}"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/vnd.apple.mpegurl')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        if compressed:
+            self.send_header('Content-Encoding', 'gzip')
+        self.end_headers()
+
+        bandwidth = param('bandwidth', 0, int)
+        block = 64 * 1024
+        for offset in range(0, len(body), block):
+            self.wfile.write(body[offset:offset + block])
+            if bandwidth:
+                time.sleep(block / bandwidth)
+
+def start_upstream_server(host='127.0.0.1', port=0):
+    """Avvia il server in un thread; restituisce (server, base_url)."""
+    server = ThreadingHTTPServer((host, port), UpstreamHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='bench-upstream', daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+def main():
+    parser = argparse.ArgumentParser(description='Server upstream simulato per i benchmark')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8900)
+    args = parser.parse_args()
+    server = ThreadingHTTPServer((args.host, args.port), UpstreamHandler)
+    print(f"Upstream simulato su http://{args.host}:{args.port}/playlist.m3u?entries=10000&latency=0.2")
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main()
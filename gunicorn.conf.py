@@ -0,0 +1,56 @@
+# gunicorn.conf.py
+#
+# Configurazione di Gunicorn letta dalle variabili d'ambiente: il modello dei
+# worker si regola per l'hardware senza ricostruire l'immagine.
+# Avvio: gunicorn -c gunicorn.conf.py
+#
+# Esempi:
+#   GUNICORN_WORKERS=8 GUNICORN_THREADS=4         -> 8 processi gthread da 4 thread
+#   ASYNC_SERVER=true GUNICORN_WORKERS=2          -> worker aiohttp (app:create_async_app)
+#   GUNICORN_MAX_REQUESTS=5000 GUNICORN_PRELOAD=1 -> riciclo dei worker e import nel master
+#
+# I limiti di ammissione di app.py (ADMISSION_*) valgono per ogni worker:
+# il totale del servizio è workers x limite. Anche il pool di riscrittura
+# (SHARDED_REWRITE_WORKERS) è per worker: di default core / GUNICORN_WORKERS.
+
+import os
+
+def _env_bool(name, default):
+    return os.environ.get(name, str(default)).lower() in ('1', 'true', 'yes', 'on')
+
+ASYNC_SERVER = _env_bool('ASYNC_SERVER', False)
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 7860)}"
+# Applicazione: Flask (WSGI) oppure la factory aiohttp in modalità asincrona
+wsgi_app = 'app:create_async_app' if ASYNC_SERVER else 'app:app'
+
+# --- Modello dei worker ---
+workers = int(os.environ.get('GUNICORN_WORKERS', 4))
+threads = int(os.environ.get('GUNICORN_THREADS', 1)) # > 1: più richieste per processo (gthread)
+_default_worker_class = 'aiohttp.GunicornWebWorker' if ASYNC_SERVER else ('gthread' if threads > 1 else 'sync')
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', _default_worker_class)
+
+# --- Tempi ---
+# Il timeout resta sopra PROXY_DEADLINE (90s): la richiesta termina da sola prima che il worker venga ucciso
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 120))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))
+
+# --- Coda delle connessioni ---
+backlog = int(os.environ.get('GUNICORN_BACKLOG', 2048))
+
+# --- Preload e riciclo dei worker ---
+# Con il preload l'app viene importata nel master prima del fork (avvio più rapido, memoria condivisa);
+# i singleton di app.py si reinizializzano nei worker tramite os.register_at_fork.
+preload_app = _env_bool('GUNICORN_PRELOAD', False)
+# Riavvio di un worker dopo N richieste (0 = mai), con una variazione casuale per non riavviarli tutti insieme
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 0))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', 0))
+
+loglevel = os.environ.get('LOG_LEVEL', 'info').lower()
+
+# --- Hook ---
+def post_worker_init(worker):
+    # Pool di riscrittura (SHARDED_REWRITE_*, se attivo) avviato con il worker invece che alla prima playlist grande
+    import app
+    app.start_shard_executor()
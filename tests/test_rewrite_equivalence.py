@@ -0,0 +1,83 @@
+"""
+Equivalenza tra i motori di riscrittura: rewrite_m3u_links_streaming sulle
+linee di decode_m3u_lines (motore a stringhe) e M3UChunkRewriter (motore a
+byte), sui playlist di bench/synthetic.py con fine linea CRLF e CR, linee
+vuote o di soli spazi e tagli dei blocchi in punti arbitrari.
+"""
+import os
+import sys
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [REPO_DIR, os.path.join(REPO_DIR, 'bench')]
+
+import app as proxy_app # noqa: E402
+from synthetic import generate_playlist # noqa: E402
+
+CREDENTIALS = [('http://mfp.example.com', 'benchpass'), ('http://mfp.example.com', None)]
+CHUNK_SIZES = [1, 2, 7, 64, 4096, 1 << 30]
+
+def _chunks(data, chunk_size):
+    return [data[offset:offset + chunk_size] for offset in range(0, len(data), chunk_size)]
+
+def str_engine(data, base_url, api_password, chunk_size):
+    lines = proxy_app.decode_m3u_lines(iter(_chunks(data, chunk_size)))
+    return ''.join(proxy_app.rewrite_m3u_links_streaming(lines, base_url, api_password)).encode('utf-8')
+
+def byte_engine(data, base_url, api_password, chunk_size):
+    return b''.join(proxy_app.rewrite_m3u_chunks(iter(_chunks(data, chunk_size)), base_url, api_password))
+
+def _with_blank_lines(data):
+    # Linee vuote e di soli spazi tra i canali, spazi prima dei link e alla fine del file
+    lines = data.split(b'\n')
+    output = []
+    for idx, line in enumerate(lines):
+        if idx % 5 == 1:
+            output.append(b'')
+        if idx % 7 == 2:
+            output.append(b' \t ')
+        output.append(b'  ' + line if line.startswith(b'http') and idx % 3 == 0 else line)
+    return b'\n'.join(output) + b'\n  \n'
+
+PLAYLIST = generate_playlist(entries=300, directive_density=0.5, seed=7)
+VARIANTS = {
+    'lf': PLAYLIST,
+    'crlf': PLAYLIST.replace(b'\n', b'\r\n'),
+    'cr': PLAYLIST.replace(b'\n', b'\r'),
+    'mixed': b''.join(line + (b'\r\n', b'\r', b'\n')[idx % 3] for idx, line in enumerate(PLAYLIST.split(b'\n'))),
+    'blank_lines': _with_blank_lines(PLAYLIST),
+    'blank_lines_crlf': _with_blank_lines(PLAYLIST).replace(b'\n', b'\r\n'),
+    'no_final_newline': PLAYLIST.rstrip(b'\n'),
+    'no_final_newline_cr': PLAYLIST.rstrip(b'\n').replace(b'\n', b'\r') + b'\r',
+}
+
+@pytest.mark.parametrize('chunk_size', CHUNK_SIZES)
+@pytest.mark.parametrize('variant', sorted(VARIANTS))
+@pytest.mark.parametrize('base_url,api_password', CREDENTIALS)
+def test_byte_engine_matches_str_engine(variant, chunk_size, base_url, api_password):
+    data = VARIANTS[variant]
+    expected = str_engine(data, base_url, api_password, 1 << 30)
+    assert str_engine(data, base_url, api_password, chunk_size) == expected
+    assert byte_engine(data, base_url, api_password, chunk_size) == expected
+
+@pytest.mark.parametrize('data', [
+    b'#EXTM3U\rhttp://x/c\r',
+    b'#EXTM3U\n  \n\t\nhttp://x/c\n',
+    b'#EXTM3U\r\n#EXTVLCOPT:http-user-agent=UA\r\r\n  http://x/c  \r\n',
+    b'  \n\r\n\r',
+    b'#EXTINF:-1,A\rhttp://x/a\r#EXTVLCOPT:http-referrer=http://r/\rhttp://x/b',
+])
+@pytest.mark.parametrize('chunk_size', CHUNK_SIZES)
+def test_line_endings_and_blank_lines(data, chunk_size):
+    base_url, api_password = CREDENTIALS[0]
+    expected = str_engine(data, base_url, api_password, 1 << 30)
+    assert b'\r' not in expected
+    assert all(line.strip() for line in expected.split(b'\n')[:-1])
+    assert byte_engine(data, base_url, api_password, chunk_size) == expected
+
+def test_shard_boundaries_ignore_lone_cr():
+    # Un CR isolato chiude la linea: la direttiva dopo il link vale per il canale successivo
+    data = b'http://x/a\r#EXTVLCOPT:http-user-agent=UA\nhttp://x/b\n'
+    assert proxy_app._first_entry_boundary(data) == len(data)
+    assert proxy_app._last_entry_boundary(data) == len(data)